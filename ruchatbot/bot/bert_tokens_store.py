@@ -0,0 +1,77 @@
+"""
+Хранилище результатов токенизации текстов для моделей на базе rubert.
+
+Токены фактов базы знаний вычисляются один раз при загрузке профиля и хранятся в виде numpy-массивов int32.
+Токены запросов хранятся в ограниченном LRU-кэше, так как запросы часто повторяются.
+
+18.10.2026 Начальная реализация
+18.10.2026 Готовые токены фактов можно добавить из скомпилированного кэша профиля (add_fact_tokens)
+18.10.2026 Хранилище разделяется детекторами, работающими в разных потоках, поэтому доступ к словарям под своей блокировкой
+"""
+
+import collections
+import threading
+
+import numpy as np
+
+
+class BertTokensStore(object):
+    def __init__(self, bert_tokenizer, max_queries=10000):
+        """
+        :param bert_tokenizer: токенизатор rubert, желательно быстрый (BertTokenizerFast)
+        :param max_queries: сколько токенизированных запросов хранить в LRU-кэше
+        """
+        self.bert_tokenizer = bert_tokenizer
+        self.max_queries = max_queries
+        self.fact2tokens = dict()
+        self.query2tokens = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def tokenize(self, texts):
+        return [np.asarray(ids, dtype=np.int32) for ids in self.bert_tokenizer(texts, add_special_tokens=True)['input_ids']]
+
+    def add_facts(self, texts):
+        """Токенизируем факты, которых еще нет в хранилище"""
+        with self.lock:
+            missing = list(set(text for text in texts if text not in self.fact2tokens))
+        if missing:
+            text2tokens = dict(zip(missing, self.tokenize(missing)))
+            with self.lock:
+                self.fact2tokens.update(text2tokens)
+
+    def add_fact_tokens(self, text2tokens):
+        """Добавляем готовые токены фактов, например из скомпилированного кэша профиля"""
+        with self.lock:
+            self.fact2tokens.update(text2tokens)
+
+    def encode_batch(self, texts):
+        """Возвращаем список массивов токенов для texts, незнакомые тексты токенизируются одним батчем"""
+        res = [None] * len(texts)
+        missing = []
+        with self.lock:
+            for i, text in enumerate(texts):
+                tokens = self.fact2tokens.get(text)
+                if tokens is None:
+                    tokens = self.query2tokens.get(text)
+                    if tokens is None:
+                        missing.append(i)
+                        continue
+                    self.query2tokens.move_to_end(text)
+                res[i] = tokens
+
+        if missing:
+            # Токенизация идет вне блокировки, чтобы не задерживать другие потоки
+            missing_texts = list(set(texts[i] for i in missing))
+            text2tokens = dict(zip(missing_texts, self.tokenize(missing_texts)))
+            with self.lock:
+                for text, tokens in text2tokens.items():
+                    self.query2tokens[text] = tokens
+                while len(self.query2tokens) > self.max_queries:
+                    self.query2tokens.popitem(last=False)
+            for i in missing:
+                res[i] = text2tokens[texts[i]]
+
+        return res
+
+    def encode(self, text):
+        return self.encode_batch([text])[0]
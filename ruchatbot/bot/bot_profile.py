@@ -11,6 +11,7 @@ class BotProfile(object):
     def __init__(self, bot_id=''):
         self.bot_id = bot_id
         self.profile = None
+        self.profile_path = None
         self.premises_path = None
         self.faq_path = None
         self.smalltalk_generative_rules = None
@@ -23,6 +24,7 @@ class BotProfile(object):
         return path_str.replace('$DATA', data_dir).replace('$MODELS', models_dir)
 
     def load(self, profile_path, data_dir, models_dir):
+        self.profile_path = profile_path
         with open(profile_path, 'r') as f:
             self.profile = json.load(f)
 
@@ -64,6 +66,33 @@ class BotProfile(object):
     def confabulator_enabled(self):
         return self.profile.get('confabulator_enabled', True)
 
+    @property
+    def relevancy_prefilter_candidates(self):
+        # Сколько фактов, лексически похожих на вопрос, оценивать моделью релевантности. 0 - оценивать все факты.
+        return self.profile.get('relevancy_prefilter_candidates', 0)
+
+    @property
+    def synonymy_ann_candidates(self):
+        # Сколько ближайших по векторам предложений фактов проверять моделью синонимичности. 0 - проверять все факты.
+        return self.profile.get('synonymy_ann_candidates', 0)
+
+    @property
+    def confabulation_target_samples(self):
+        # Сколько различных конфабуляций достаточно получить от генеративной модели за один вызов.
+        # По умолчанию генерируются все 10 вариантов, как и раньше, адаптивная остановка включается в профиле.
+        return self.profile.get('confabulation_target_samples', 10)
+
+    @property
+    def chitchat_target_samples(self):
+        # Сколько различных реплик читчата достаточно получить от генеративной модели за один вызов.
+        # По умолчанию генерируются все 5 вариантов, как и раньше, адаптивная остановка включается в профиле.
+        return self.profile.get('chitchat_target_samples', 5)
+
+    @property
+    def turn_time_budget(self):
+        # Бюджет времени на обработку одной реплики собеседника в секундах, 0 - без ограничения
+        return self.profile.get('turn_time_budget', 0)
+
     @property
     def opposite_fact_comment_proba(self):
         return self.profile.get('opposite_fact_comment_proba', 0.2)
@@ -0,0 +1,149 @@
+"""
+Скомпилированный кэш фактов профиля - один бинарный файл, который читается через mmap вместо построчного
+разбора .dat файлов с подстановкой констант.
+
+В файле хранятся все варианты всех фактов (альтернативы через |) после канонизации и подстановки констант,
+разделы и файлы-источники фактов, а также токены rubert для каждого варианта. В заголовке записаны времена
+модификации исходных файлов (основной файл фактов, импортируемые файлы, json профиля); если какой-то из них
+изменился, кэш считается устаревшим и пересобирается.
+
+Формат файла:
+    MAGIC, длина заголовка (uint32), заголовок в json,
+    затем массивы с выравниванием на 8 байт, их смещения и размеры записаны в заголовке:
+    texts - тексты вариантов в utf-8 подряд, text_offsets (int64), entries (int32, 4 числа на факт:
+    первый вариант, число вариантов, раздел, файл-источник), tokens (int32), token_offsets (int64).
+
+Компиляция вручную (при загрузке бота кэш пересобирается автоматически):
+python compiled_profile_facts.py --profile ../../data/profile_1.json --data ../../data --models ../../tmp --bert ../../tmp/rubert-tiny
+
+18.10.2026 Начальная реализация
+"""
+
+import argparse
+import io
+import json
+import logging
+import mmap
+import os
+import struct
+
+import numpy as np
+
+
+MAGIC = b'RCPFACTS'
+FORMAT_VERSION = 1
+
+
+def get_compiled_facts_path(models_dir, bot_id):
+    return os.path.join(models_dir, 'profile_facts.{}.bin'.format(bot_id))
+
+
+def get_source_mtimes(paths):
+    """Времена модификации файлов, для отсутствующих файлов None"""
+    mtimes = dict()
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+
+def write_compiled_facts(output_path, header, arrays):
+    """
+    :param header: словарь с метаданными, будет дополнен описанием массивов
+    :param arrays: список пар (имя, numpy-массив или bytes)
+    """
+    layout = dict()
+    offset = 0
+    for name, data in arrays:
+        raw = data if isinstance(data, bytes) else data.tobytes()
+        layout[name] = {'offset': offset, 'nbytes': len(raw), 'dtype': None if isinstance(data, bytes) else data.dtype.str}
+        offset += (len(raw) + 7) // 8 * 8
+
+    header = dict(header, version=FORMAT_VERSION, layout=layout)
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    data_start = (len(MAGIC) + 4 + len(header_bytes) + 7) // 8 * 8
+
+    # Пишем во временный файл и переименовываем, чтобы параллельно стартующие процессы не прочитали недописанный кэш
+    tmp_path = output_path + '.tmp'
+    with io.open(tmp_path, 'wb') as wrt:
+        wrt.write(MAGIC)
+        wrt.write(struct.pack('<I', len(header_bytes)))
+        wrt.write(header_bytes)
+        wrt.write(b'\0' * (data_start - wrt.tell()))
+        for name, data in arrays:
+            raw = data if isinstance(data, bytes) else data.tobytes()
+            wrt.write(raw)
+            wrt.write(b'\0' * ((len(raw) + 7) // 8 * 8 - len(raw)))
+    os.replace(tmp_path, output_path)
+
+
+def read_compiled_header(input_path):
+    """Читаем только заголовок кэша, None если файла нет или формат не подходит"""
+    try:
+        with io.open(input_path, 'rb') as rdr:
+            if rdr.read(len(MAGIC)) != MAGIC:
+                return None
+            header_len = struct.unpack('<I', rdr.read(4))[0]
+            header = json.loads(rdr.read(header_len).decode('utf-8'))
+    except (OSError, ValueError, struct.error):
+        return None
+
+    if header.get('version') != FORMAT_VERSION:
+        return None
+    header['data_start'] = (len(MAGIC) + 4 + header_len + 7) // 8 * 8
+    return header
+
+
+def is_fresh(header):
+    """Кэш актуален, если ни один исходный файл не изменился с момента компиляции"""
+    return get_source_mtimes(header['sources']) == header['sources']
+
+
+def map_compiled_facts(input_path, header):
+    """Отображаем файл кэша в память, возвращаем объект mmap и словарь массивов-представлений без копирования"""
+    with io.open(input_path, 'rb') as rdr:
+        mm = mmap.mmap(rdr.fileno(), 0, access=mmap.ACCESS_READ)
+
+    arrays = dict()
+    for name, item in header['layout'].items():
+        start = header['data_start'] + item['offset']
+        if item['dtype'] is None:
+            arrays[name] = memoryview(mm)[start: start + item['nbytes']]
+        else:
+            dtype = np.dtype(item['dtype'])
+            arrays[name] = np.frombuffer(mm, dtype=dtype, count=item['nbytes'] // dtype.itemsize, offset=start)
+    return mm, arrays
+
+
+if __name__ == '__main__':
+    import transformers
+
+    from ruchatbot.bot.bot_profile import BotProfile
+    from ruchatbot.bot.text_utils import TextUtils
+    from ruchatbot.bot.profile_facts_reader import ProfileKnowledgeBase
+
+    parser = argparse.ArgumentParser(description='Компиляция фактов профиля в бинарный кэш')
+    parser.add_argument('--profile', type=str, default='../../data/profile_1.json')
+    parser.add_argument('--data', type=str, default='../../data')
+    parser.add_argument('--models', type=str, default='../../tmp')
+    parser.add_argument('--bert', type=str, default='../../tmp/rubert-tiny')
+    parser.add_argument('--bot_id', type=str, default='bot_v4')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    bot_profile = BotProfile(args.bot_id)
+    bot_profile.load(args.profile, args.data, args.models)
+
+    text_utils = TextUtils()
+    text_utils.load_dictionaries(args.data, args.models)
+
+    bert_tokenizer = transformers.BertTokenizerFast.from_pretrained(args.bert, do_lower_case=False)
+
+    knowledge_base = ProfileKnowledgeBase(bot_profile.premises_path, bot_profile.constants, profile_config_path=args.profile)
+    knowledge_base.load(text_utils)
+    output_path = get_compiled_facts_path(args.models, args.bot_id)
+    knowledge_base.save_compiled(output_path, bert_tokenizer)
+    print('{} facts compiled to "{}"'.format(len(knowledge_base.entries), output_path))
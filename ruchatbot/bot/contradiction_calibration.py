@@ -0,0 +1,105 @@
+"""
+Подбор калибровки оценок противоречия для RugptChitchat.predict_contradictions.
+
+predict_contradictions сравнивает массы отрицательных и утвердительных ответов генеративной модели, а логистическая
+функция с параметрами (a, b) переводит их отношение в вероятность противоречия. Параметры подбираются здесь
+по размеченным парам (предпосылка, утверждение) и сохраняются в contradiction_calibration.json в каталоге модели,
+откуда их подхватывает BotCore.load.
+
+Размеченные пары берутся из data/contradictions.txt (группы из двух строк, разделенные пустой строкой: предпосылка
+и противоречащее ей утверждение). Непротиворечащие пары - каждая фраза из этого файла в паре сама с собой.
+Дополнительные пары можно дать в tsv-файле со столбцами premise, assertion, label (1 - противоречие).
+
+Запуск:
+python contradiction_calibration.py --model ../../tmp/rugpt_chitchat --data ../../data
+
+18.10.2026 Начальная реализация
+"""
+
+import argparse
+import io
+import logging
+import os
+
+import numpy as np
+
+
+def load_contradiction_pairs(contradictions_path):
+    """Возвращаем списки пар (предпосылка, утверждение) и меток из файла contradictions.txt"""
+    pairs = []
+    labels = []
+    with io.open(contradictions_path, 'r', encoding='utf-8') as rdr:
+        buf = []
+        for line in list(rdr) + ['']:
+            line = line.strip()
+            if line:
+                buf.append(line)
+                continue
+
+            if len(buf) == 2:
+                premise, assertion = buf
+                pairs.append((premise, assertion))
+                labels.append(1)
+                pairs.append((premise, premise))
+                labels.append(0)
+                pairs.append((assertion, assertion))
+                labels.append(0)
+            buf = []
+
+    return pairs, labels
+
+
+def calc_log_loss(probs, labels):
+    p = np.clip(np.asarray(probs), 1e-8, 1.0 - 1e-8)
+    y = np.asarray(labels, dtype=np.float64)
+    return float(-np.mean(y * np.log(p) + (1.0 - y) * np.log(1.0 - p)))
+
+
+if __name__ == '__main__':
+    import pandas as pd
+
+    from ruchatbot.bot.rugpt_chitchat2 import RugptChitchat, get_contradiction_calibration_path
+
+    parser = argparse.ArgumentParser(description='Калибровка оценок противоречия для генеративной модели')
+    parser.add_argument('--model', type=str, default='../../tmp/rugpt_chitchat')
+    parser.add_argument('--data', type=str, default='../../data')
+    parser.add_argument('--dataset', type=str, default=None, help='tsv с дополнительными парами premise, assertion, label')
+    parser.add_argument('--threshold', type=float, default=0.5, help='порог для оценки точности, как contradiction_threshold в BotCore')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    pairs, labels = load_contradiction_pairs(os.path.join(args.data, 'contradictions.txt'))
+    if args.dataset:
+        df = pd.read_csv(args.dataset, delimiter='\t', encoding='utf-8')
+        pairs.extend(zip(df.premise.values, df.assertion.values))
+        labels.extend(df.label.values)
+
+    rng = np.random.RandomState(123456789)
+    indeces = rng.permutation(len(pairs))
+    nb_val = len(pairs) // 10
+    val_pairs = [pairs[i] for i in indeces[:nb_val]]
+    val_labels = [labels[i] for i in indeces[:nb_val]]
+    train_pairs = [pairs[i] for i in indeces[nb_val:]]
+    train_labels = [labels[i] for i in indeces[nb_val:]]
+    print('{} train pairs, {} validation pairs'.format(len(train_pairs), len(val_pairs)))
+
+    model = RugptChitchat()
+    model.load(args.model)
+
+    if val_pairs:
+        y_pred = model.predict_contradictions(val_pairs)
+        acc = np.mean((np.asarray(y_pred) >= args.threshold) == (np.asarray(val_labels) == 1))
+        print('uncalibrated: val log_loss={:.4f} accuracy={:.4f}'.format(calc_log_loss(y_pred, val_labels), acc))
+
+    a, b = model.fit_contradiction_calibration(train_pairs, train_labels)
+    print('calibration: a={:.4f} b={:.4f}'.format(a, b))
+
+    if val_pairs:
+        y_pred = model.predict_contradictions(val_pairs)
+        acc = np.mean((np.asarray(y_pred) >= args.threshold) == (np.asarray(val_labels) == 1))
+        print('calibrated: val log_loss={:.4f} accuracy={:.4f}'.format(calc_log_loss(y_pred, val_labels), acc))
+
+    calibration_path = get_contradiction_calibration_path(args.model)
+    model.save_contradiction_calibration(calibration_path)
+    print('Calibration saved to "{}"'.format(calibration_path))
@@ -7,6 +7,31 @@
 04.02.2022 Эксперимент - объединенная генеративная модель вместо отдельных для читчата, интерпретации, конфабуляции
 11.03.2022 Эксперимент - используем новую модель для pq-релевантность на базе rubert+классификатор
 28.03.2022 Эксперимент - переходим на новую модель детектора синонимичности фраз на базе rubert+классификатор
+18.10.2026 Кэш признаков фактов БЗ для детектора релевантности, один на профиль, с сохранением на диске
+18.10.2026 Индекс векторов предложений для отбора кандидатов при сопоставлении конфабуляций с фактами БЗ
+18.10.2026 Валидация реплик-кандидатов: вопросы и утверждения из top-K кандидатов оцениваются по БЗ одним батчем
+18.10.2026 Быстрый токенизатор rubert и хранилище готовых токенов фактов БЗ
+18.10.2026 Опциональная int8-квантизация моделей на базе rubert (ключ --quantize)
+18.10.2026 Если в каталоге моделей есть экспортированные в TorchScript rubert и классификаторы, используем их,
+           веса rubert в формате transformers при этом не загружаются
+18.10.2026 Общий для всех сессий LRU-кэш скоров пар (запрос, факт) для детекторов релевантности и синонимичности
+18.10.2026 Интерпретации для всех контекстов и PQA-ответы для всех наборов предпосылок генерируются батчами
+18.10.2026 KV-кэш общих префиксов промптов генеративной модели в пределах обработки одной реплики
+18.10.2026 Если рядом с rugpt_chitchat есть черновая модель rugpt_chitchat_draft, генерация идет спекулятивным декодированием
+18.10.2026 Проверка противоречий фактам БЗ - батчевый верификатор по вероятностям ответов вместо сэмплирования 5 ответов
+18.10.2026 Самоинтерпретации top-K реплик-кандидатов генерируются одним батчем
+18.10.2026 Легковесный классификатор необходимости интерпретации: для самодостаточных реплик gpt-интерпретатор не вызывается
+18.10.2026 Конфабуляции и реплики читчата генерируются волнами до набора заданного в профиле числа уникальных вариантов
+18.10.2026 Независимые ветки генерации ответа (клаузы интерпретации, читчат) выполняются параллельно в пуле потоков
+18.10.2026 Бюджет времени на ход: при его нехватке необязательные стадии пропускаются или сокращаются, это пишется в лог
+18.10.2026 DialogHistory инкрементно поддерживает ограниченный буфер шагов диалога для построения контекстов
+18.10.2026 БЗ профиля разбирается один раз на процесс, сессии хранят только выбор вариантов фактов и новые факты
+18.10.2026 БЗ профиля загружается из скомпилированного бинарного кэша с токенами rubert (compiled_profile_facts.py)
+18.10.2026 Число потоков torch задается один раз при загрузке моделей, а не переключается на время вызова детектора
+18.10.2026 Кэши фактов БЗ профиля готовятся в BotCore.load (или при первой реплике с профилем), а не только в __main__
+18.10.2026 Индекс векторов фактов БЗ для детектора синонимичности строится при подготовке профиля, а не при первой реплике
+18.10.2026 Новые факты сессий не добавляются в общие для процесса кэши и индексы, чтобы память не росла с числом диалогов
+18.10.2026 DialogHistory вынесена в отдельный модуль dialog_history.py
 """
 
 import sys
@@ -17,8 +42,10 @@ import logging.handlers
 import random
 import traceback
 import itertools
+import concurrent.futures
 import datetime
 import json
+import threading
 
 import terminaltables
 
@@ -42,169 +69,22 @@ from ruchatbot.bot.rubert_synonymy_detector import RubertSynonymyDetector
 from ruchatbot.bot.modality_detector import ModalityDetector
 from ruchatbot.bot.simple_modality_detector import SimpleModalityDetectorRU
 from ruchatbot.bot.bot_profile import BotProfile
-from ruchatbot.bot.profile_facts_reader import ProfileFactsReader
-from ruchatbot.bot.rugpt_chitchat2 import RugptChitchat
+from ruchatbot.bot.profile_facts_reader import ProfileFactsReader, get_profile_knowledge_base
+from ruchatbot.bot.compiled_profile_facts import get_compiled_facts_path
+from ruchatbot.bot.rugpt_chitchat2 import RugptChitchat, get_contradiction_calibration_path
 from ruchatbot.bot.rubert_relevancy_detector import RubertRelevancyDetector
+from ruchatbot.bot.sentence_vectors_index import SentenceVectorsIndex
+from ruchatbot.bot.bert_tokens_store import BertTokensStore
+from ruchatbot.bot.pair_scores_cache import PairScoresCache
+from ruchatbot.bot.req_interpretation_classifier import ReqInterpretationClassifier
+from ruchatbot.bot.turn_budget import TurnBudget
+from ruchatbot.bot.model_quantization import quantize_model
+from ruchatbot.bot.model_export import TRACED_BERT_FILENAME, get_traced_head_path, calc_file_hash
+from ruchatbot.bot.premise_features_cache import calc_module_hash
+from ruchatbot.bot.dialog_history import DialogHistory
 
 
 
-class Utterance:
-    def __init__(self, who, text, interpretation=None):
-        self.who = who
-        self.text = text
-        self.interpretation = interpretation
-
-    def get_text(self):
-        return self.text
-
-    def __repr__(self):
-        return '{}: {}'.format(self.who, self.text)
-
-    def is_command(self):
-        return self.who == 'X'
-
-    def get_interpretation(self):
-        return self.interpretation
-
-    def set_interpretation(self, text):
-        self.interpretation = text
-
-
-class DialogHistory(object):
-    def __init__(self, user_id):
-        self.user_id = user_id
-        self.messages = []
-        self.replies_queue = []
-
-    def get_interlocutor(self):
-        return self.user_id
-
-    def enqueue_replies(self, replies):
-        """Добавляем в очередь реплики для выдачи собеседнику."""
-        self.replies_queue.extend(replies)
-
-    def pop_reply(self):
-        if len(self.replies_queue) == 0:
-            return ''
-        else:
-            reply = self.replies_queue[0]
-            self.replies_queue = self.replies_queue[1:]
-            return reply
-
-    def add_human_message(self, text):
-        self.messages.append(Utterance('H', text))
-
-    def add_bot_message(self, text, self_interpretation=None):
-        self.messages.append(Utterance('B', text, self_interpretation))
-        self.replies_queue.append(text)
-
-    def add_command(self, command_text):
-        self.messages.append(Utterance('X', command_text))
-
-    def get_printable(self):
-        lines = []
-        for m in self.messages:
-            lines.append('{}: {}'.format(m.who, m.text))
-        return lines
-
-    def get_last_message(self):
-        return self.messages[-1]
-
-    def constuct_interpreter_contexts(self):
-        contexts = set()
-
-        max_history = 2
-
-        messages2 = [m for m in self.messages if not m.is_command()]
-
-        for n in range(2, max_history+2):
-            steps = []
-            for i, message in enumerate(messages2):
-                msg_text = message.get_interpretation()
-                if msg_text is None:
-                    msg_text = message.get_text()
-
-                prev_side = messages2[i-1].who if i > 0 else ''
-                if prev_side != message.who:
-                    steps.append(msg_text)
-                else:
-                    s = steps[-1]
-                    if s[-1] not in '.?!;:':
-                        s += '.'
-
-                    steps[-1] = s + ' ' + msg_text
-
-            last_steps = steps[-n:]
-            context = ' | '.join(last_steps)
-            contexts.add(context)
-
-        return sorted(list(contexts), key=lambda s: -len(s))
-
-    def construct_entailment_context(self):
-        steps = []
-        for i, message in enumerate(self.messages):
-            msg_text = message.get_text()
-            prev_side = self.messages[i-1].who if i > 0 else ''
-            if prev_side != message.who:
-                steps.append(msg_text)
-            else:
-                s = steps[-1]
-                if s[-1] not in '.?!;:':
-                    s += '.'
-
-                steps[-1] = s + ' ' + msg_text
-
-        return ' | '.join(steps[-2:])
-
-    def construct_chitchat_context(self, last_utterance_interpretation, last_utterance_labels, max_depth=10, include_commands=False):
-        labels2 = []
-        if last_utterance_labels:
-            for x in last_utterance_labels:
-                if x[-1] not in '.?!':
-                    labels2.append(x+'.')
-                else:
-                    labels2.append(x)
-
-        if labels2:
-            last_utterance_labels_txt = '[{}]'.format(' '.join(labels2))
-        else:
-            last_utterance_labels_txt = None
-
-        steps = []
-        for i, message in enumerate(self.messages):
-            if not include_commands and message.is_command():
-                continue
-
-            msg_text = message.get_text()
-            if i == len(self.messages)-1:
-                if last_utterance_interpretation:
-                    msg_text = last_utterance_interpretation
-                else:
-                    msg_text = msg_text
-
-            prev_side = self.messages[i-1].who if i > 0 else ''
-            if prev_side != message.who:
-                steps.append(msg_text)
-            else:
-                s = steps[-1]
-                if s[-1] not in '.?!;:':
-                    s += '.'
-
-                steps[-1] = s + ' ' + msg_text
-
-        if last_utterance_labels_txt:
-            return steps[-max_depth:] + [last_utterance_labels_txt]
-        else:
-            return steps[-max_depth:]
-
-
-    def set_last_message_interpretation(self, interpretation_text):
-        self.messages[-1].set_interpretation(interpretation_text)
-
-    def __len__(self):
-        return len(self.messages)
-
-
 class ConversationSession(object):
     def __init__(self, interlocutor_id, bot_profile, text_utils):
         self.interlocutor_id = interlocutor_id
@@ -277,16 +157,60 @@ class BotCore:
         self.logger = logging.getLogger('BotCore')
         self.min_nonsense_threshold = 0.50  # мин. значение синтаксической валидности сгенерированной моделями фразы, чтобы использовать ее дальше
         self.pqa_rel_threshold = 0.80  # порог отсечения нерелевантных предпосылок
+        self.validation_top_k = 5  # сколько реплик-кандидатов проверяется по базе знаний за один проход
+        self.contradiction_threshold = 0.5  # порог вероятности противоречия утверждения реплики факту из БЗ
+        self.req_interpretation_model = None
+        self.req_interpretation_threshold = 0.2  # ниже этой вероятности реплика считается не требующей интерпретации
+        self.nb_interpretation_checks = 0
+        self.nb_interpretations_skipped = 0
+        self.max_branch_workers = 4  # сколько независимых веток генерации ответа выполнять параллельно, 1 - последовательно
+        self.branch_pool = None
+        # Сколько секунд должно оставаться от бюджета хода (см. BotProfile.turn_time_budget), чтобы запускать необязательные стадии
+        self.stage_min_seconds = {'extra_interpretations': 2.0, 'confabulation': 1.5, 'scoring': 0.5, 'deep_validation': 0.5}
+        self.min_scored_responses = 5  # сколько кандидатов оценивается score_dialogues при нехватке времени
+        # Профили, для фактов БЗ которых уже подготовлены кэши, см. warmup_facts_cache
+        self.warmed_up_profiles = set()
+        self.warmup_lock = threading.Lock()
+
+
+    def load_bert(self, bert_path, quantize=False):
+        self.bert_tokenizer = transformers.BertTokenizerFast.from_pretrained(bert_path, do_lower_case=False)
+        self.bert_tokens_store = BertTokensStore(self.bert_tokenizer)
+        # Веса rubert загружаются в load_bert_model, когда известен каталог моделей
+        self.bert_path = bert_path
+        self.bert_quantize = quantize
+        self.bert_model = None
+
+    def load_bert_model(self, models_dir):
+        """
+        Загружаем веса rubert, если в каталоге моделей нет экспортированного в TorchScript rubert (см. model_export.py).
+        Иначе детекторы используют только трассированную модель, и вторая копия весов в памяти не нужна.
+        """
+        if os.path.exists(os.path.join(models_dir, TRACED_BERT_FILENAME)):
+            self.logger.info('Traced rubert found in "%s", skipping "%s"', models_dir, self.bert_path)
+            return
 
-
-    def load_bert(self, bert_path):
-        self.bert_tokenizer = transformers.BertTokenizer.from_pretrained(bert_path, do_lower_case=False)
-        self.bert_model = transformers.BertModel.from_pretrained(bert_path)
+        self.bert_model = transformers.BertModel.from_pretrained(self.bert_path)
         self.bert_model.to(self.device)
         self.bert_model.eval()
-
-    def load(self, models_dir, text_utils):
+        if self.bert_quantize:
+            # Динамическая int8-квантизация для инференса на CPU
+            quantize_model(self.bert_model, self.device)
+
+    def load(self, models_dir, text_utils, quantize=False, bot_profile=None):
+        """
+        Загружаем модели из models_dir. Если задан профиль бота, то сразу готовим кэши для фактов его БЗ,
+        иначе они будут подготовлены при обработке первой реплики с этим профилем.
+        """
+        self.models_dir = models_dir
         self.text_utils = text_utils
+        self.load_bert_model(models_dir)
+
+        if self.max_branch_workers > 1:
+            self.branch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_branch_workers, thread_name_prefix='branch')
+
+        # Скоры пар (запрос, факт) общие для всех сессий и обоих детекторов на базе rubert.
+        self.pair_scores_cache = PairScoresCache()
 
         # =============================
         # Грузим модели.
@@ -297,8 +221,13 @@ class BotCore:
             cfg = json.load(f)
             self.synonymy_detector = RubertSynonymyDetector(device=self.device, **cfg)
             self.synonymy_detector.load_weights(os.path.join(models_dir, 'rubert_synonymy_model.pt'))
+            if quantize:
+                quantize_model(self.synonymy_detector, self.device)
             self.synonymy_detector.bert_model = self.bert_model
             self.synonymy_detector.bert_tokenizer = self.bert_tokenizer
+            self.synonymy_detector.vectors_index = SentenceVectorsIndex()
+            self.synonymy_detector.tokens_store = self.bert_tokens_store
+            self.synonymy_detector.pair_scores_cache = self.pair_scores_cache
 
         #self.relevancy_detector = LGB_RelevancyDetector()
         #self.relevancy_detector.load(models_dir)
@@ -306,8 +235,21 @@ class BotCore:
             cfg = json.load(f)
             self.relevancy_detector = RubertRelevancyDetector(device=self.device, **cfg)
             self.relevancy_detector.load_weights(os.path.join(models_dir, 'pq_relevancy_rubert_model.pt'))
+            if quantize:
+                quantize_model(self.relevancy_detector, self.device)
             self.relevancy_detector.bert_model = self.bert_model
             self.relevancy_detector.bert_tokenizer = self.bert_tokenizer
+            self.relevancy_detector.tokens_store = self.bert_tokens_store
+            self.relevancy_detector.pair_scores_cache = self.pair_scores_cache
+
+        self.load_traced_models(models_dir)
+
+        # Число потоков torch внутри операций - настройка всего процесса, а ветки ответа работают с моделями
+        # одновременно. Поэтому число потоков из .cfg детекторов применяется один раз здесь, а не на время вызовов.
+        num_threads = max([detector.num_threads for detector in [self.synonymy_detector, self.relevancy_detector] if detector.num_threads] or [0])
+        if num_threads:
+            self.logger.info('Setting torch intra-op threads to %d', num_threads)
+            torch.set_num_threads(num_threads)
 
         # Модель определения модальности фраз собеседника
         self.modality_model = SimpleModalityDetectorRU()
@@ -321,14 +263,105 @@ class BotCore:
 
         self.generative_model = RugptChitchat()
         self.generative_model.load(os.path.join(models_dir, 'rugpt_chitchat'))
+        calibration_path = get_contradiction_calibration_path(os.path.join(models_dir, 'rugpt_chitchat'))
+        if os.path.exists(calibration_path):
+            # Калибровка оценок противоречий для predict_contradictions, см. contradiction_calibration.py
+            self.generative_model.load_contradiction_calibration(calibration_path)
+        else:
+            self.logger.warning('Contradiction calibration "%s" not found, uncalibrated scores will be used', calibration_path)
+        draft_model_path = os.path.join(models_dir, 'rugpt_chitchat_draft')
+        if os.path.exists(draft_model_path):
+            # Маленькая черновая модель для спекулятивного декодирования, см. rugpt_draft_model.py
+            self.logger.info('Loading draft generative model from "%s"', draft_model_path)
+            self.generative_model.load_draft_model(draft_model_path)
 
         self.base_interpreter = BaseUtteranceInterpreter2()
         self.base_interpreter.load(models_dir)
 
+        req_interpretation_path = os.path.join(models_dir, 'req_interpretation.npz')
+        if os.path.exists(req_interpretation_path):
+            # Классификатор необходимости интерпретации, см. req_interpretation_classifier.py
+            self.req_interpretation_model = ReqInterpretationClassifier()
+            self.req_interpretation_model.load(req_interpretation_path)
+
+        if bot_profile is not None:
+            self.warmup_facts_cache(bot_profile)
+
+    def load_traced_models(self, models_dir):
+        """
+        Подключаем экспортированные в TorchScript модели, если они есть (см. model_export.py).
+        Трассированный rubert один на оба детектора, головы классификаторов у каждого детектора свои.
+        Хэши реально используемых весов привязывают к моделям кэш признаков фактов и ключи в кэше скоров пар.
+        """
+        traced_bert_path = os.path.join(models_dir, TRACED_BERT_FILENAME)
+        if os.path.exists(traced_bert_path):
+            self.logger.info('Loading traced rubert from "%s"', traced_bert_path)
+            traced_bert = torch.jit.load(traced_bert_path, map_location=self.device)
+            self.synonymy_detector.traced_bert = traced_bert
+            self.relevancy_detector.traced_bert = traced_bert
+            bert_hash = calc_file_hash(traced_bert_path)
+        else:
+            bert_hash = calc_module_hash(self.bert_model)
+
+        for detector, model_name in [(self.synonymy_detector, 'rubert_synonymy_model'),
+                                     (self.relevancy_detector, 'pq_relevancy_rubert_model')]:
+            traced_head_path = get_traced_head_path(models_dir, model_name)
+            if os.path.exists(traced_head_path):
+                self.logger.info('Loading traced classifier from "%s"', traced_head_path)
+                detector.traced_head = torch.jit.load(traced_head_path, map_location=self.device)
+                head_hash = calc_file_hash(traced_head_path)
+            else:
+                head_hash = detector.calc_head_hash()
+            detector.set_model_id(bert_hash, head_hash)
+
+            if detector is self.relevancy_detector:
+                # Кэш признаков фактов должен соответствовать тем моделям, которые реально используются.
+                self.relevancy_detector.create_premises_cache(bert_hash, head_hash)
+
+    def warmup_facts_cache(self, bot_profile):
+        """
+        Заранее вычисляем признаки фактов из БЗ профиля, чтобы при обработке реплик прогонять через rubert только запросы.
+        Для каждого профиля работа выполняется один раз, повторные вызовы ничего не делают.
+        """
+        with self.warmup_lock:
+            if bot_profile.get_id() not in self.warmed_up_profiles:
+                self.warmup_facts_cache_0(bot_profile)
+                self.warmed_up_profiles.add(bot_profile.get_id())
+
+    def warmup_facts_cache_0(self, bot_profile):
+        cache_path = os.path.join(self.models_dir, 'pq_relevancy_premises_cache.{}.pt'.format(bot_profile.get_id()))
+        premises_cache = self.relevancy_detector.premises_cache
+        premises_cache.load(cache_path)
+
+        # Общая для всех сессий БЗ профиля, берем все варианты фактов, так как сессии выбирают их случайно.
+        # БЗ загружается из скомпилированного кэша вместе с токенами, при изменении исходных файлов кэш пересобирается.
+        knowledge_base = get_profile_knowledge_base(bot_profile.premises_path, bot_profile.constants, self.text_utils,
+                                                    compiled_path=get_compiled_facts_path(self.models_dir, bot_profile.get_id()),
+                                                    profile_config_path=bot_profile.profile_path,
+                                                    bert_tokenizer=self.bert_tokenizer)
+        profile_facts = sorted(set(knowledge_base.enumerate_all_texts()))
+        if knowledge_base.text_tokens is not None:
+            self.bert_tokens_store.add_fact_tokens(knowledge_base.text_tokens)
+        self.bert_tokens_store.add_facts(profile_facts)
+
+        nb_cached = len(premises_cache)
+        self.relevancy_detector.update_premises_cache(profile_facts)
+        if len(premises_cache) != nb_cached:
+            premises_cache.save(cache_path)
+
+        if bot_profile.relevancy_prefilter_candidates:
+            self.relevancy_detector.prefilter.add_texts(profile_facts)
+
+        if bot_profile.synonymy_ann_candidates:
+            # Индекс векторов фактов БЗ для отбора кандидатов в детекторе синонимичности тоже строим заранее,
+            # чтобы первая реплика не тратила время на прогон всех фактов через rubert.
+            self.synonymy_detector.update_vectors_index(profile_facts)
+            self.synonymy_detector.vectors_index.update_clusters()
+
     def print_dialog(self, dialog):
         logging.debug('='*70)
         table = [['turn', 'side', 'message', 'interpretation']]
-        for i, message in enumerate(dialog.messages, start=1):
+        for i, message in enumerate(dialog.messages, start=dialog.nb_messages-len(dialog.messages)+1):
             interp = message.get_interpretation()
             if interp is None:
                 interp = ''
@@ -341,6 +374,15 @@ class BotCore:
     def store_new_fact(self, fact_text, label, dialog, profile, facts):
         # TODO - проверка на непротиворечивость и неповторение
         self.logger.debug('Storing new fact 〚%s〛 in bot="%s" database', fact_text, profile.get_id())
+
+        # Факт с этим тэгом будет заменен новым, поэтому скоры для старого текста факта больше не нужны.
+        old_fact_text = facts.find_tagged_fact(dialog.get_interlocutor(), label)
+        if old_fact_text is not None and old_fact_text != fact_text:
+            self.pair_scores_cache.invalidate_facts([old_fact_text])
+
+        # Новый факт хранится только в сессии. Общие для процесса хранилища (токены и признаки фактов, индексы
+        # кандидатов) содержат только БЗ профиля, для фактов сессии все вычисляется на лету, так что память
+        # не растет с числом диалогов.
         facts.store_new_fact(dialog.get_interlocutor(), (fact_text, 'unknown', label), True)
 
     def start_greeting_scenario(self, session):
@@ -373,6 +415,26 @@ class BotCore:
         return self.base_interpreter.flip_person(utterance_text, self.text_utils)
 
     def process_human_message(self, session):
+        # Кэши фактов БЗ профиля готовятся при загрузке (BotCore.load с профилем), а если BotCore загружен
+        # без профиля - при первой реплике с этим профилем.
+        self.warmup_facts_cache(session.bot_profile)
+
+        # Все генерации и оценки диалогов в этом ходе используют одну и ту же историю диалога,
+        # поэтому KV-кэш общих префиксов промптов живет до конца обработки реплики. Параллельные ходы
+        # других сессий пользуются тем же кэшем, он выключается по окончании последнего из них.
+        # Бюджет времени на ход: при его нехватке необязательные дорогие стадии пропускаются или сокращаются.
+        budget = TurnBudget(session.bot_profile.turn_time_budget)
+        self.generative_model.start_prefix_cache()
+        try:
+            return self.process_human_message_0(session, budget)
+        finally:
+            self.generative_model.clear_prefix_cache()
+            if budget.degraded_stages:
+                self.logger.info('Turn budget exceeded: %s', budget)
+            else:
+                self.logger.debug('Turn budget: %s', budget)
+
+    def process_human_message_0(self, session, budget):
         # Начинаем обработку реплики собеседника
         dialog = session.dialog
         profile = session.bot_profile
@@ -397,10 +459,28 @@ class BotCore:
         #    must_answer_question = True
 
         # 16-02-2022 интерпретация реплики пользователя выполняется всегда, полагаемся на устойчивость генеративной gpt-модели интерпретатора.
+        # 18-10-2026 если легковесный классификатор уверен, что реплика самодостаточна, то gpt-интерпретатор не вызываем.
         all_interpretations = []
         interpreter_contexts = dialog.constuct_interpreter_contexts()
-        for interpreter_context in interpreter_contexts:
-            interpretations = self.generative_model.generate_interpretations([z.strip() for z in interpreter_context.split('|')], num_return_sequences=2)
+        if self.req_interpretation_model is not None:
+            self.nb_interpretation_checks += 1
+            p_req_interp = self.req_interpretation_model.predict(dialog.get_last_message().get_text())
+            self.logger.debug('Req interpretation@403: p=%5.3f', p_req_interp)
+            if p_req_interp < self.req_interpretation_threshold:
+                self.nb_interpretations_skipped += 1
+                interpreter_contexts = []
+                all_interpretations.append((dialog.get_last_message().get_text(), 1.0))
+            self.logger.debug('Interpretations skipped: %d of %d (%5.3f)', self.nb_interpretations_skipped, self.nb_interpretation_checks,
+                              self.nb_interpretations_skipped / float(self.nb_interpretation_checks))
+
+        if len(interpreter_contexts) > 1 and not budget.allows('extra_interpretations', self.stage_min_seconds['extra_interpretations']):
+            # Оставляем только самый длинный контекст, его интерпретация и так выбирается ниже первой.
+            interpreter_contexts = interpreter_contexts[:1]
+
+        # Все контексты интерпретатора обрабатываются одним батчем генеративной модели.
+        batch_interpretations = self.generative_model.generate_interpretations_batch([([z.strip() for z in interpreter_context.split('|')], 2)
+                                                                                      for interpreter_context in interpreter_contexts])
+        for interpreter_context, interpretations in zip(interpreter_contexts, batch_interpretations):
             self.logger.debug('Interpretation@404: context=〚%s〛 outputs=〚%s〛', interpreter_context, format_outputs(interpretations))
 
             # Оцениваем "разумность" получившихся интерпретаций, чтобы отсеять заведомо поломанные результаты
@@ -422,130 +502,35 @@ class BotCore:
         all_interpretations = all_interpretations[:1]
 
         # Кэш: найденные соответствия между конфабулированными предпосылками и реальными фактами в БД.
+        # Общий для всех клауз реплики, ветки пополняют его из разных потоков. Записи только добавляются,
+        # а одна и та же предпосылка всегда сопоставляется одинаково, поэтому блокировка не нужна.
         mapped_premises = dict()
         for interpretation, p_interp in all_interpretations:
             # Интерпретация может содержать 2 предложения, типа "я люблю фильмы. ты любишь фильмы?"
             # Каждую клаузу пытаемся обработать отдельно.
             assertionx, questionx = split_message_text(interpretation, self.text_utils)
 
+            # Независимые ветки генерации - обработка каждой клаузы и читчат - выполняются параллельно в пуле потоков.
+            # Результаты веток объединяются в порядке их запуска, поэтому состав и порядок responses не зависят от того,
+            # какая ветка закончится раньше.
+            chitchat_future = None
+            if len(questionx) == 0:
+                # Генеративный читчат делает свою основную работу - генерирует ответную реплику.
+                chitchat_future = self.run_branch(self.generate_chitchat_reply, dialog, profile, interpretation, p_interp)
+
+            clause_futures = []
             input_clauses = [(q, 1.0, True) for q in questionx] + [(a, 0.8, False) for a in assertionx]
             for question_text, question_w, use_confabulation in input_clauses:
-                # Ветка ответа на вопрос, в том числе выраженный неявно, например "хочу твое имя узнать!"
-                confab_premises = []
-
-                self.logger.debug('Question to process@427: 〚%s〛', question_text)
-                # Сначала поищем релевантную информацию в базе фактов
-                normalized_phrase_1 = self.normalize_person(question_text)
-                premises = []
-                rels = []
-                premises0, rels0 = self.relevancy_detector.get_most_relevant(normalized_phrase_1, memory_phrases, self.text_utils, nb_results=2)
-                for premise, premise_rel in zip(premises0, rels0):
-                    if premise_rel >= self.pqa_rel_threshold:
-                        # В базе знаний нашелся релевантный факт.
-                        premises.append(premise)
-                        rels.append(premise_rel)
-                        self.logger.debug('KB lookup@438: query=〚%s〛 premise=〚%s〛 rel=%f', normalized_phrase_1, premise, premise_rel)
-
-                dodged = False
-                if len(premises) > 0:
-                    # Нашлись релевантные предпосылки, значит мы попадем в ветку PQA.
-                    # С заданной вероятностью переходим на отдельную ветку "уклонения от ответа":
-                    if random.random() < profile.p_dodge1:
-                        for interpretation, p_interp in all_interpretations:
-                            dodge_replies = self.generate_dodge_reply(dialog, interpretation, p_interp)
-                            if dodge_replies:
-                                responses.extend(dodge_replies)
-                                dodged = True
-                                premises.clear()
-                                rels.clear()
-
-                # С помощью каждого найденного факта (предпосылки) будем генерировать варианты ответа, используя режим PQA читчата
-                for premise, premise_relevancy in zip(premises, rels):
-                    if premise_relevancy >= self.pqa_rel_threshold:  # Если найденная в БД предпосылка достаточно релевантна вопросу...
-                        confab_premises.append(([premise], premise_relevancy*question_w, 'knowledgebase'))
-
-                phrase_modality, phrase_person, raw_tokens = self.modality_model.get_modality(question_text, self.text_utils)
-
-                if len(confab_premises) == 0 and use_confabulation and not dodged:
-                    if phrase_person != '2':  # не будем выдумывать факты про собеседника!
-                        # В базе знаний ничего релевантного не нашлось.
-                        # Мы можем а) сгенерировать ответ с семантикой "нет информации" б) заболтать вопрос в) придумать факт и уйти в ветку PQA
-                        # Используем заданные константы профиля для выбора ветки.
-                        x = random.random()
-                        if x < profile.p_confab:
-                            # Просим конфабулятор придумать варианты предпосылок.
-                            confabul_context = [interpretation]  #[self.flip_person(interpretation)]
-                            # TODO - первый запуск делать с num_return_sequences=10, второй с num_return_sequences=100
-                            confabulations = self.generative_model.generate_confabulations(context_replies=confabul_context, num_return_sequences=10)
-                            self.logger.debug('Confabulation@471: context=〚%s〛 outputs=〚%s〛', ' | '.join(confabul_context), format_outputs(confabulations))
-
-                            for confab_text in confabulations:
-                                score = 1.0
-
-                                # Может быть несколько предпосылок, поэтому бьем на клаузы.
-                                premises = self.text_utils.split_clauses(confab_text)
-
-                                # Понижаем достоверность конфабуляций, относящихся к собеседнику.
-                                for premise in premises:
-                                    words = self.text_utils.tokenize(premise)
-                                    if any((w.lower() == 'ты') for w in words):
-                                        score *= 0.5
-
-                                confab_premises.append((premises, score, 'confabulation'))
-
-                processed_chitchat_contexts = set()
-
-                # Ищем сопоставление придуманных фактов на знания в БД.
-                for premises, premises_rel, source in confab_premises:
-                    premise_facts = []
-                    total_proba = 1.0
-                    unmapped_confab_facts = []
-
-                    if source == 'knowledgebase':
-                        premise_facts = premises
-                        total_proba = 1.0
-                    else:
-                        for confab_premise in premises:
-                            if confab_premise in mapped_premises:
-                                memory_phrase, rel = mapped_premises[confab_premise]
-                                premise_facts.append(memory_phrase)
-                            else:
-                                #memory_phrase, rel = self.synonymy_detector.get_most_similar(confab_premise, memory_phrases, self.text_utils, nb_results=1)
-                                fx, rels = self.synonymy_detector.get_most_similar(confab_premise, memory_phrases, self.text_utils, nb_results=1)
-                                memory_phrase = fx[0]
-                                rel = rels[0]
-                                if rel > 0.5:
-                                    if memory_phrase != confab_premise:
-                                        self.logger.debug('Synonymy@523 text1=〚%s〛 text2=〚%s〛 score=%5.3f', confab_premise, memory_phrase, rel)
-
-                                    total_proba *= rel
-                                    if memory_phrase[-1] not in '.?!':
-                                        memory_phrase2 = memory_phrase + '.'
-                                    else:
-                                        memory_phrase2 = memory_phrase
-
-                                    premise_facts.append(memory_phrase2)
-                                    mapped_premises[confab_premise] = (memory_phrase2, rel * premises_rel)
-                                else:
-                                    # Для этого придуманного факта нет подтверждения в БД. Попробуем его использовать,
-                                    # и потом в случае успеха генерации ответа внесем этот факт в БД.
-                                    unmapped_confab_facts.append(confab_premise)
-                                    premise_facts.append(confab_premise)
-                                    mapped_premises[confab_premise] = (confab_premise, 0.80 * premises_rel)
-
-                    if len(premise_facts) == len(premises):
-                        # Нашли для всех конфабулированных предпосылок соответствия в базе знаний.
-                        if total_proba >= 0.3:
-                            # Пробуем сгенерировать ответ, опираясь на найденные в базе знаний предпосылки и заданный собеседником вопрос.
-                            pqa_responses = self.generate_pqa_reply(dialog,
-                                                                    interpretation,
-                                                                    p_interp,
-                                                                    processed_chitchat_contexts,
-                                                                    premise_facts=premise_facts,
-                                                                    premises_proba=total_proba,
-                                                                    unmapped_confab_facts=unmapped_confab_facts)
-                            responses.extend(pqa_responses)
+                # Случайные выборы веток разыгрываем здесь, чтобы они не зависели от порядка работы потоков.
+                x_dodge1 = random.random()
+                x_confab = random.random()
+                clause_futures.append(self.run_branch(self.process_input_clause, dialog, profile, memory_phrases, all_interpretations,
+                                                      interpretation, p_interp, question_text, question_w, use_confabulation,
+                                                      x_dodge1, x_confab, budget, mapped_premises))
 
+            for clause_future in clause_futures:
+                clause_responses, phrase_modality = clause_future.result()
+                responses.extend(clause_responses)
 
                 if len(responses) == 0 and phrase_modality == ModalityDetector.question:
                     # Собеседник задал вопрос, но мы не смогли ответить на него с помощью имеющейся в базе знаний
@@ -553,7 +538,7 @@ class BotCore:
                     dodged = False
                     if profile.p_dodge2:
                         # Пробуем заболтать вопрос.
-                        dodge_responses = self.generate_dodge_reply(dialog, interpretation, p_interp)
+                        dodge_responses = self.generate_dodge_reply(dialog, profile, interpretation, p_interp)
                         if dodge_responses:
                             responses.extend(dodge_responses)
                             dodged = True
@@ -563,10 +548,8 @@ class BotCore:
                         if noinfo_responses:
                             responses.extend(noinfo_responses)
 
-            if len(questionx) == 0:
-                # Генеративный читчат делает свою основную работу - генерирует ответную реплику.
-                chitchat_responses = self.generate_chitchat_reply(dialog, interpretation, p_interp)
-                responses.extend(chitchat_responses)
+            if chitchat_future is not None:
+                responses.extend(chitchat_future.result())
 
         # ===================================================
         # Генерация вариантов ответной реплики закончена.
@@ -575,14 +558,28 @@ class BotCore:
         # Делаем оценку сгенерированных реплик - насколько хорошо они вписываются в текущий контекст диалога
         chitchat_context0 = dialog.construct_chitchat_context(last_utterance_interpretation=None, last_utterance_labels=None, include_commands=False)
         #px_entail = self.entailment.predictN(' | '.join(chitchat_context0), [r.get_text() for r in responses])
-        px_entail = self.generative_model.score_dialogues([(chitchat_context0 + [r.get_text()]) for r in responses])
+        scored_responses = responses
+        if len(responses) > self.min_scored_responses and not budget.allows('scoring', self.stage_min_seconds['scoring']):
+            # Оцениваем только кандидатов с наибольшей априорной достоверностью, остальные получают худшую из оценок.
+            scored_responses = sorted(responses, key=lambda z: -z.p)[:self.min_scored_responses]
+        px_entail = self.generative_model.score_dialogues([(chitchat_context0 + [r.get_text()]) for r in scored_responses])
 
-        for r, p_entail in zip(responses, px_entail):
+        for r, p_entail in zip(scored_responses, px_entail):
             r.set_p_entail(p_entail)
+        if len(scored_responses) < len(responses):
+            min_p_entail = min(px_entail)
+            for r in responses:
+                if r not in scored_responses:
+                    r.set_p_entail(min_p_entail)
 
         # Сортируем по убыванию скора
         responses = sorted(responses, key=lambda z: -z.get_proba())
 
+        self.logger.debug('Pair scores cache: size=%d hit_rate=%5.3f relevancy_hit_rate=%5.3f synonymy_hit_rate=%5.3f', len(self.pair_scores_cache),
+                          self.pair_scores_cache.get_hit_rate(), self.pair_scores_cache.get_hit_rate(self.relevancy_detector.model_id),
+                          self.pair_scores_cache.get_hit_rate(self.synonymy_detector.model_id))
+        self.logger.debug('Adaptive sampling: generated=%d kept=%d yield=%5.3f', self.generative_model.nb_samples_generated,
+                          self.generative_model.nb_samples_kept, self.generative_model.get_sampling_yield())
         self.logger.debug('%d responses generated for input_message=〚%s〛 interlocutor="%s" bot="%s":', len(responses), dialog.get_last_message().get_text(), interlocutor, profile.get_id())
         table = [['i', 'text', 'p_entail', 'score', 'algo', 'context', 'confabulations']]
         for i, r in enumerate(responses, start=1):
@@ -600,77 +597,7 @@ class BotCore:
         # Выбираем лучший response, запоминаем интерпретацию последней фразы в истории диалога.
         # 16.02.2022 Идем по списку сгенерированных реплик, проверяем реплику на отсутствие противоречий или заеданий.
         # Если реплика плохая - отбрасываем и берем следующую в сортированном списке.
-        self_interpretation = None
-        for best_response in responses:
-            #memory_phrases2 = list(memory_phrases)
-            # Если входная обрабатываемая реплика содержит какой-то факт, то его надо учитывать сейчас при поиске
-            # релевантных предпосылок. Но так как мы еще не уверены, что именно данный вариант интерпретации входной
-            # реплики правильный, то просто соберем временный список с добавленной интерпретацией.
-            input_assertions, input_questions = split_message_text(best_response.prev_utterance_interpretation, self.text_utils)
-            memory_phrases2 = list(memory_phrases)
-            for assertion_text in input_assertions:
-                fact_text2 = self.flip_person(assertion_text)
-                memory_phrases2.append((fact_text2, '', '(((tmp@613)))'))
-
-            # Вполне может оказаться, что наша ответная реплика - краткая, и мы должны попытаться восстановить
-            # полную реплику перед семантическими и прагматическими проверками.
-            prevm = best_response.prev_utterance_interpretation # dialog.get_last_message().get_interpretation()
-            if prevm is None:
-                prevm = dialog.get_last_message().get_text()
-            interpreter_context = prevm + ' | ' + best_response.get_text()
-            self_interpretation = self.generative_model.generate_interpretations([z.strip() for z in interpreter_context.split('|')], num_return_sequences=1)[0]
-            self.logger.debug('Self interpretation@610: context=〚%s〛 output=〚%s〛', interpreter_context, self_interpretation)
-
-            is_good_reply = True
-
-            self_assertions, self_questions = split_message_text(self_interpretation, self.text_utils)
-            for question_text in self_questions:
-                # Реплика содержит вопрос. Проверим, что мы ранее не задавали такой вопрос, и что
-                # мы не знаем ответ на этот вопрос. Благодаря этому бот не будет спрашивать снова то, что уже
-                # спрашивал или что он просто знает.
-                self.logger.debug('Question to process@619: 〚%s〛', question_text)
-                premises, rels = self.relevancy_detector.get_most_relevant(question_text, memory_phrases2, self.text_utils, nb_results=1)
-                premise = premises[0]
-                rel = rels[0]
-                if rel >= self.pqa_rel_threshold:
-                    self.logger.debug('KB lookup@624: query=〚%s〛 premise=〚%s〛 rel=%f', question_text, premise, rel)
-                    # Так как в БД найден релевантный факт, то бот уже знает ответ на этот вопрос, и нет смысла задавать его
-                    # собеседнику снова.
-                    is_good_reply = False
-                    self.logger.debug('Output response 〚%s〛 contains a question 〚%s〛 with known answer, so skipping it @628', best_response.get_text(), question_text)
-                    break
-
-            if not is_good_reply:
-                continue
-
-            # проверяем по БД, нет ли противоречий с утвердительной частью.
-            # Генерации реплики, сделанные из предпосылки в БД, не будем проверять.
-            if best_response.get_algo() != 'pqa_response':
-                for assertion_text in self_assertions:
-                    # Ищем релевантный факт в БД
-                    premises, rels = self.relevancy_detector.get_most_relevant(assertion_text, memory_phrases2, self.text_utils, nb_results=1)
-                    premise = premises[0]
-                    rel = rels[0]
-                    if rel >= self.pqa_rel_threshold:
-                        self.logger.debug('KB lookup@642: query=〚%s〛 premise=〚%s〛 rel=%f', assertion_text, premise, rel)
-
-                        # Формируем запрос на генерацию ответа через gpt читчата...
-                        chitchat_context = '[' + premise + '.] ' + assertion_text + '?'
-                        chitchat_outputs = self.generative_model.generate_chitchat(context_replies=[chitchat_context], num_return_sequences=5)
-                        self.logger.debug('PQA@647: context=〚%s〛 outputs=〚%s〛', chitchat_context, format_outputs(chitchat_outputs))
-                        for chitchat_output in chitchat_outputs:
-                            # Заглушка - ищем отрицательные частицы
-                            words = self.text_utils.tokenize(chitchat_output)
-                            if any((w.lower() in ['нет', 'не']) for w in words):
-                                is_good_reply = False
-                                self.logger.debug('Output response 〚%s〛 contains assertion 〚%s〛 which contradicts the knowledge base', best_response.get_text(), assertion_text)
-                                break
-
-                        if not is_good_reply:
-                            break
-
-            if is_good_reply:
-                break
+        best_response, self_interpretation = self.select_best_response(dialog, responses, memory_phrases, budget)
 
         # Если для генерации этой ответной реплики использована интерпретация предыдущей реплики собеседника,
         # то надо запомнить эту интерпретацию в истории диалога.
@@ -764,11 +691,265 @@ class BotCore:
 
         return responses
 
-    def generate_dodge_reply(self, dialog, interpretation, p_interp):
+    def run_branch(self, fn, *args):
+        """Запускаем ветку генерации в пуле потоков. Если пул не создан, ветка выполняется сразу в текущем потоке."""
+        if self.branch_pool is None:
+            future = concurrent.futures.Future()
+            future.set_result(fn(*args))
+            return future
+        return self.branch_pool.submit(fn, *args)
+
+    def process_input_clause(self, dialog, profile, memory_phrases, all_interpretations, interpretation, p_interp,
+                             question_text, question_w, use_confabulation, x_dodge1, x_confab, budget, mapped_premises):
+        """
+        Ветка генерации ответных реплик для одной клаузы интерпретации: поиск в БЗ, уклонение от ответа,
+        конфабуляция и PQA. Случайные числа для выбора веток x_dodge1 и x_confab разыгрываются вызывающим кодом.
+        Если бюджет времени хода на исходе, конфабуляция не выполняется.
+        mapped_premises - общий для клауз реплики кэш сопоставлений конфабулированных предпосылок с фактами БЗ.
+        Возвращает список реплик и модальность клаузы.
+        """
+        responses = []
+
+        # Ветка ответа на вопрос, в том числе выраженный неявно, например "хочу твое имя узнать!"
+        confab_premises = []
+
+        self.logger.debug('Question to process@427: 〚%s〛', question_text)
+        # Сначала поищем релевантную информацию в базе фактов
+        normalized_phrase_1 = self.normalize_person(question_text)
+        premises = []
+        rels = []
+        premises0, rels0 = self.relevancy_detector.get_most_relevant(normalized_phrase_1, memory_phrases, self.text_utils, nb_results=2,
+                                                                     nb_candidates=profile.relevancy_prefilter_candidates)
+        for premise, premise_rel in zip(premises0, rels0):
+            if premise_rel >= self.pqa_rel_threshold:
+                # В базе знаний нашелся релевантный факт.
+                premises.append(premise)
+                rels.append(premise_rel)
+                self.logger.debug('KB lookup@438: query=〚%s〛 premise=〚%s〛 rel=%f', normalized_phrase_1, premise, premise_rel)
+
+        dodged = False
+        if len(premises) > 0:
+            # Нашлись релевантные предпосылки, значит мы попадем в ветку PQA.
+            # С заданной вероятностью переходим на отдельную ветку "уклонения от ответа":
+            if x_dodge1 < profile.p_dodge1:
+                for interpretation, p_interp in all_interpretations:
+                    dodge_replies = self.generate_dodge_reply(dialog, profile, interpretation, p_interp)
+                    if dodge_replies:
+                        responses.extend(dodge_replies)
+                        dodged = True
+                        premises.clear()
+                        rels.clear()
+
+        # С помощью каждого найденного факта (предпосылки) будем генерировать варианты ответа, используя режим PQA читчата
+        for premise, premise_relevancy in zip(premises, rels):
+            if premise_relevancy >= self.pqa_rel_threshold:  # Если найденная в БД предпосылка достаточно релевантна вопросу...
+                confab_premises.append(([premise], premise_relevancy*question_w, 'knowledgebase'))
+
+        phrase_modality, phrase_person, raw_tokens = self.modality_model.get_modality(question_text, self.text_utils)
+
+        if len(confab_premises) == 0 and use_confabulation and not dodged:
+            if phrase_person != '2':  # не будем выдумывать факты про собеседника!
+                # В базе знаний ничего релевантного не нашлось.
+                # Мы можем а) сгенерировать ответ с семантикой "нет информации" б) заболтать вопрос в) придумать факт и уйти в ветку PQA
+                # Используем заданные константы профиля для выбора ветки.
+                if x_confab < profile.p_confab and budget.allows('confabulation', self.stage_min_seconds['confabulation']):
+                    # Просим конфабулятор придумать варианты предпосылок.
+                    confabul_context = [interpretation]  #[self.flip_person(interpretation)]
+                    # TODO - первый запуск делать с num_return_sequences=10, второй с num_return_sequences=100
+                    # 18-10-2026 генерируем волнами до profile.confabulation_target_samples различных конфабуляций, но не более 10 вариантов
+                    confabulations = self.generative_model.generate_confabulations_adaptive(context_replies=confabul_context,
+                                                                                            target_unique=profile.confabulation_target_samples,
+                                                                                            max_samples=10)
+                    self.logger.debug('Confabulation@471: context=〚%s〛 outputs=〚%s〛', ' | '.join(confabul_context), format_outputs(confabulations))
+
+                    for confab_text in confabulations:
+                        score = 1.0
+
+                        # Может быть несколько предпосылок, поэтому бьем на клаузы.
+                        premises = self.text_utils.split_clauses(confab_text)
+
+                        # Понижаем достоверность конфабуляций, относящихся к собеседнику.
+                        for premise in premises:
+                            words = self.text_utils.tokenize(premise)
+                            if any((w.lower() == 'ты') for w in words):
+                                score *= 0.5
+
+                        confab_premises.append((premises, score, 'confabulation'))
+
+        processed_chitchat_contexts = set()
+        pqa_requests = []
+
+        # Ищем сопоставление придуманных фактов на знания в БД.
+        for premises, premises_rel, source in confab_premises:
+            premise_facts = []
+            total_proba = 1.0
+            unmapped_confab_facts = []
+
+            if source == 'knowledgebase':
+                premise_facts = premises
+                total_proba = 1.0
+            else:
+                for confab_premise in premises:
+                    if confab_premise in mapped_premises:
+                        memory_phrase, rel = mapped_premises[confab_premise]
+                        premise_facts.append(memory_phrase)
+                    else:
+                        #memory_phrase, rel = self.synonymy_detector.get_most_similar(confab_premise, memory_phrases, self.text_utils, nb_results=1)
+                        fx, rels = self.synonymy_detector.get_most_similar(confab_premise, memory_phrases, self.text_utils, nb_results=1,
+                                                                           nb_candidates=profile.synonymy_ann_candidates)
+                        # Пустой результат возможен, если в сессии нет ни одного факта, тогда считаем, что подтверждения нет
+                        memory_phrase = fx[0] if fx else None
+                        rel = rels[0] if rels else 0.0
+                        if rel > 0.5:
+                            if memory_phrase != confab_premise:
+                                self.logger.debug('Synonymy@523 text1=〚%s〛 text2=〚%s〛 score=%5.3f', confab_premise, memory_phrase, rel)
+
+                            total_proba *= rel
+                            if memory_phrase[-1] not in '.?!':
+                                memory_phrase2 = memory_phrase + '.'
+                            else:
+                                memory_phrase2 = memory_phrase
+
+                            premise_facts.append(memory_phrase2)
+                            mapped_premises[confab_premise] = (memory_phrase2, rel * premises_rel)
+                        else:
+                            # Для этого придуманного факта нет подтверждения в БД. Попробуем его использовать,
+                            # и потом в случае успеха генерации ответа внесем этот факт в БД.
+                            unmapped_confab_facts.append(confab_premise)
+                            premise_facts.append(confab_premise)
+                            mapped_premises[confab_premise] = (confab_premise, 0.80 * premises_rel)
+
+            if len(premise_facts) == len(premises):
+                # Нашли для всех конфабулированных предпосылок соответствия в базе знаний.
+                if total_proba >= 0.3:
+                    # Пробуем сгенерировать ответ, опираясь на найденные в базе знаний предпосылки и заданный собеседником вопрос.
+                    pqa_requests.append((premise_facts, total_proba, unmapped_confab_facts))
+
+        if pqa_requests:
+            # Ответы для всех наборов предпосылок генерируются одним батчем.
+            pqa_responses = self.generate_pqa_replies(dialog, profile, interpretation, p_interp, processed_chitchat_contexts, pqa_requests)
+            responses.extend(pqa_responses)
+
+        return responses, phrase_modality
+
+    def select_best_response(self, dialog, responses, memory_phrases, budget):
+        """
+        Проверяем отсортированные реплики-кандидаты и возвращаем первую прошедшую проверки вместе с ее самоинтерпретацией.
+        Кандидаты обрабатываются порциями по validation_top_k: самоинтерпретации кандидатов порции генерируются
+        одним батчем, вопросы и утверждения из всех кандидатов порции оцениваются по базе знаний одним вызовом score_matrix.
+        Если ни один кандидат не прошел проверки, возвращается последний проверенный. Если бюджет времени хода
+        на исходе, проверяется только первая порция.
+        """
+        best_response = None
+        self_interpretation = None
+        for i0 in range(0, len(responses), self.validation_top_k):
+            if i0 > 0 and not budget.allows('deep_validation', self.stage_min_seconds['deep_validation']):
+                break
+
+            chunk = responses[i0: i0+self.validation_top_k]
+
+            # Вполне может оказаться, что наша ответная реплика - краткая, и мы должны попытаться восстановить
+            # полную реплику перед семантическими и прагматическими проверками. Самоинтерпретации всех кандидатов
+            # порции генерируются одним батчем.
+            interpreter_contexts = []
+            for response in chunk:
+                prevm = response.prev_utterance_interpretation # dialog.get_last_message().get_interpretation()
+                if prevm is None:
+                    prevm = dialog.get_last_message().get_text()
+                interpreter_contexts.append(prevm + ' | ' + response.get_text())
+            batch_interpretations = self.generative_model.generate_interpretations_batch([([z.strip() for z in interpreter_context.split('|')], 1)
+                                                                                          for interpreter_context in interpreter_contexts])
+
+            candidates = []
+            for response, interpreter_context, interpretations in zip(chunk, interpreter_contexts, batch_interpretations):
+                # Пустые результаты генерации отбрасываются, и при остановке на первом переводе строки интерпретации
+                # может не оказаться. Тогда проверяем саму реплику-кандидата.
+                response_interpretation = interpretations[0] if interpretations else response.get_text()
+                self.logger.debug('Self interpretation@610: context=〚%s〛 output=〚%s〛', interpreter_context, response_interpretation)
+
+                self_assertions, self_questions = split_message_text(response_interpretation, self.text_utils)
+                if response.get_algo() == 'pqa_response':
+                    # Генерации реплики, сделанные из предпосылки в БД, не будем проверять на противоречия.
+                    self_assertions = []
+                candidates.append((response, response_interpretation, self_assertions, self_questions))
+
+            # Если входная обрабатываемая реплика содержит какой-то факт, то его надо учитывать сейчас при поиске
+            # релевантных предпосылок. Но так как мы еще не уверены, что именно данный вариант интерпретации входной
+            # реплики правильный, то такие временные факты видны только кандидатам, сделанным из этой интерпретации.
+            premises = list(memory_phrases)
+            premise_owners = [None] * len(premises)
+            for interpretation in set(response.prev_utterance_interpretation for response, _, _, _ in candidates):
+                input_assertions, input_questions = split_message_text(interpretation, self.text_utils)
+                for assertion_text in input_assertions:
+                    fact_text2 = self.flip_person(assertion_text)
+                    premises.append((fact_text2, '', '(((tmp@613)))'))
+                    premise_owners.append(interpretation)
+
+            queries = sorted(set(itertools.chain(*[q + a for _, _, a, q in candidates])))
+            query2rels = dict(zip(queries, self.relevancy_detector.score_matrix(queries, premises)))
+
+            def lookup(query, interpretation):
+                best_premise, best_rel = None, -1.0
+                for premise, owner, rel in zip(premises, premise_owners, query2rels[query]):
+                    if (owner is None or owner == interpretation) and rel > best_rel:
+                        best_premise, best_rel = premise[0], rel
+                return best_premise, best_rel
+
+            # Утверждения всех кандидатов порции, для которых в БД есть релевантная предпосылка, проверяем
+            # на противоречие одним батчем.
+            verification_pairs = set()
+            for response, _, self_assertions, _ in candidates:
+                for assertion_text in self_assertions:
+                    premise, rel = lookup(assertion_text, response.prev_utterance_interpretation)
+                    if rel >= self.pqa_rel_threshold:
+                        verification_pairs.add((premise, assertion_text))
+            verification_pairs = sorted(verification_pairs)
+            contradiction_probs = dict(zip(verification_pairs, self.generative_model.predict_contradictions(verification_pairs)))
+
+            for best_response, self_interpretation, self_assertions, self_questions in candidates:
+                if self.is_good_reply(best_response, self_assertions, self_questions, lookup, contradiction_probs):
+                    return best_response, self_interpretation
+
+        return best_response, self_interpretation
+
+    def is_good_reply(self, response, self_assertions, self_questions, lookup, contradiction_probs):
+        interpretation = response.prev_utterance_interpretation
+        for question_text in self_questions:
+            # Реплика содержит вопрос. Проверим, что мы ранее не задавали такой вопрос, и что
+            # мы не знаем ответ на этот вопрос. Благодаря этому бот не будет спрашивать снова то, что уже
+            # спрашивал или что он просто знает.
+            self.logger.debug('Question to process@619: 〚%s〛', question_text)
+            premise, rel = lookup(question_text, interpretation)
+            if rel >= self.pqa_rel_threshold:
+                self.logger.debug('KB lookup@624: query=〚%s〛 premise=〚%s〛 rel=%f', question_text, premise, rel)
+                # Так как в БД найден релевантный факт, то бот уже знает ответ на этот вопрос, и нет смысла задавать его
+                # собеседнику снова.
+                self.logger.debug('Output response 〚%s〛 contains a question 〚%s〛 with known answer, so skipping it @628', response.get_text(), question_text)
+                return False
+
+        # проверяем по БД, нет ли противоречий с утвердительной частью.
+        for assertion_text in self_assertions:
+            # Ищем релевантный факт в БД
+            premise, rel = lookup(assertion_text, interpretation)
+            if rel >= self.pqa_rel_threshold:
+                self.logger.debug('KB lookup@642: query=〚%s〛 premise=〚%s〛 rel=%f', assertion_text, premise, rel)
+
+                # Вероятность противоречия посчитана в select_best_response по массе отрицательных ответов gpt читчата
+                # на запрос "[предпосылка.] утверждение?"
+                p_contradiction = contradiction_probs[(premise, assertion_text)]
+                self.logger.debug('Contradiction check@647: premise=〚%s〛 assertion=〚%s〛 p=%5.3f', premise, assertion_text, p_contradiction)
+                if p_contradiction >= self.contradiction_threshold:
+                    self.logger.debug('Output response 〚%s〛 contains assertion 〚%s〛 which contradicts the knowledge base', response.get_text(), assertion_text)
+                    return False
+
+        return True
+
+    def generate_dodge_reply(self, dialog, profile, interpretation, p_interp):
         responses = []
         message_labels = ['уклониться от ответа']
         chitchat_context = dialog.construct_chitchat_context(interpretation, message_labels)
-        chitchat_outputs = self.generative_model.generate_chitchat(context_replies=chitchat_context, num_return_sequences=5)
+        chitchat_outputs = self.generative_model.generate_chitchat_adaptive(context_replies=chitchat_context,
+                                                                            target_unique=profile.chitchat_target_samples, max_samples=5)
         self.logger.debug('Chitchat_dodge@790: context=〚%s〛 outputs=〚%s〛', ' | '.join(chitchat_context), format_outputs(chitchat_outputs))
         for chitchat_output in chitchat_outputs:
             # Оценка синтаксической валидности реплики
@@ -814,12 +995,12 @@ class BotCore:
                                                context=' | '.join(chitchat_context)))
         return responses
 
-    def generate_chitchat_reply(self, dialog, interpretation, p_interp):
+    def generate_chitchat_reply(self, dialog, profile, interpretation, p_interp):
         responses = []
         message_labels = []
         chitchat_context = dialog.construct_chitchat_context(interpretation, message_labels)
-        chitchat_outputs = self.generative_model.generate_chitchat(context_replies=chitchat_context,
-                                                                   num_return_sequences=5)
+        chitchat_outputs = self.generative_model.generate_chitchat_adaptive(context_replies=chitchat_context,
+                                                                            target_unique=profile.chitchat_target_samples, max_samples=5)
         self.logger.debug('Chitchat@572: context=〚%s〛 outputs=〚%s〛', ' | '.join(chitchat_context),
                           format_outputs(chitchat_outputs))
         for chitchat_output in chitchat_outputs:
@@ -840,17 +1021,29 @@ class BotCore:
                                                context=' | '.join(chitchat_context)))
         return responses
 
-    def generate_pqa_reply(self, dialog, interpretation, p_interp, processed_chitchat_contexts, premise_facts, premises_proba, unmapped_confab_facts):
+    def generate_pqa_replies(self, dialog, profile, interpretation, p_interp, processed_chitchat_contexts, pqa_requests):
+        """
+        Генерация ответов, опирающихся на предпосылки, для нескольких наборов предпосылок одним батчем.
+        :param pqa_requests: список троек (предпосылки, достоверность предпосылок, непроверенные конфабуляции)
+        """
         responses = []
 
         # Пробуем сгенерировать ответ, опираясь на найденные в базе знаний предпосылки и заданный собеседником вопрос.
         # 07.03.2022 ограничиваем длину контекста
-        chitchat_context = dialog.construct_chitchat_context(interpretation, premise_facts, max_depth=1)
-        chitchat_context_str = '|'.join(chitchat_context)
-        if chitchat_context_str not in processed_chitchat_contexts:
-            processed_chitchat_contexts.add(chitchat_context_str)
-            chitchat_outputs = self.generative_model.generate_chitchat(context_replies=chitchat_context,
-                                                                       num_return_sequences=5)
+        batch = []
+        for premise_facts, premises_proba, unmapped_confab_facts in pqa_requests:
+            chitchat_context = dialog.construct_chitchat_context(interpretation, premise_facts, max_depth=1)
+            chitchat_context_str = '|'.join(chitchat_context)
+            if chitchat_context_str not in processed_chitchat_contexts:
+                processed_chitchat_contexts.add(chitchat_context_str)
+                batch.append((chitchat_context, premises_proba, unmapped_confab_facts))
+
+        if not batch:
+            return responses
+
+        batch_outputs = self.generative_model.generate_chitchat_adaptive_batch([chitchat_context for chitchat_context, _, _ in batch],
+                                                                               target_unique=profile.chitchat_target_samples, max_samples=5)
+        for (chitchat_context, premises_proba, unmapped_confab_facts), chitchat_outputs in zip(batch, batch_outputs):
             self.logger.debug('Chitchat_PQA@547: context=〚%s〛 outputs=〚%s〛', ' | '.join(chitchat_context),
                               format_outputs(chitchat_outputs))
             for chitchat_output in chitchat_outputs:
@@ -873,7 +1066,6 @@ class BotCore:
                                                    context=' | '.join(chitchat_context)))
         return responses
 
-
 def split_message_text(message, text_utils):
     assertions = []
     questions = []
@@ -1018,6 +1210,7 @@ if __name__ == '__main__':
     parser.add_argument('--log', type=str, default='../../../tmp/core_v4_for_debug.log')
     parser.add_argument('--profile', type=str, default='../../../data/profile_1.json')
     parser.add_argument('--bert', type=str, default='/media/inkoziev/corpora/EmbeddingModels/ruBert-base')
+    parser.add_argument('--quantize', action='store_true', help='int8-квантизация rubert и классификаторов для инференса на CPU')
 
     args = parser.parse_args()
 
@@ -1047,8 +1240,8 @@ if __name__ == '__main__':
         tf.config.experimental.set_memory_growth(gpu, True)
 
     bot = BotCore()
-    bot.load_bert(args.bert)
-    bot.load(models_dir, text_utils)
+    bot.load_bert(args.bert, quantize=args.quantize)
+    bot.load(models_dir, text_utils, quantize=args.quantize, bot_profile=bot_profile)
 
     # Фабрика для создания новых диалоговых сессий и хранения текущих сессий для всех онлайн-собеседников
     session_factory = SessionFactory(bot_profile, text_utils)
@@ -0,0 +1,171 @@
+"""
+История диалога с собеседником и построение из нее контекстов для интерпретатора, читчата и детектора релевантности.
+
+18.10.2026 DialogHistory инкрементно поддерживает ограниченный буфер шагов диалога для построения контекстов
+18.10.2026 Вынесено из core_v4_for_debug.py
+"""
+
+import collections
+
+
+class Utterance:
+    def __init__(self, who, text, interpretation=None):
+        self.who = who
+        self.text = text
+        self.interpretation = interpretation
+
+    def get_text(self):
+        return self.text
+
+    def __repr__(self):
+        return '{}: {}'.format(self.who, self.text)
+
+    def is_command(self):
+        return self.who == 'X'
+
+    def get_interpretation(self):
+        return self.interpretation
+
+    def set_interpretation(self, text):
+        self.interpretation = text
+
+
+def append_step(steps, utterance, prev_side):
+    """Подряд идущие реплики одной стороны склеиваются в один шаг диалога"""
+    if steps and prev_side == utterance.who:
+        steps[-1].append(utterance)
+    else:
+        steps.append([utterance])
+
+
+def join_step_texts(texts):
+    s = texts[0]
+    for text in texts[1:]:
+        if s[-1] not in '.?!;:':
+            s += '.'
+        s = s + ' ' + text
+    return s
+
+
+class DialogHistory(object):
+    max_messages = 100  # сколько последних реплик хранится для отладочной печати истории
+    max_context_depth = 10  # максимальное число шагов диалога, нужное для построения контекстов
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.messages = collections.deque(maxlen=self.max_messages)
+        self.nb_messages = 0
+        self.replies_queue = collections.deque()
+
+        # Шаги диалога поддерживаются инкрементно при добавлении реплик, хранятся только последние max_context_depth шагов.
+        self.all_steps = collections.deque(maxlen=self.max_context_depth)  # все реплики, включая команды
+        self.chitchat_steps = collections.deque(maxlen=self.max_context_depth)  # без команд, склейка по соседству в полной истории
+        self.interpreter_steps = collections.deque(maxlen=self.max_context_depth)  # без команд, склейка по соседству среди не-команд
+        self.last_dialog_side = ''
+
+    def get_interlocutor(self):
+        return self.user_id
+
+    def enqueue_replies(self, replies):
+        """Добавляем в очередь реплики для выдачи собеседнику."""
+        self.replies_queue.extend(replies)
+
+    def pop_reply(self):
+        if len(self.replies_queue) == 0:
+            return ''
+        else:
+            return self.replies_queue.popleft()
+
+    def add_message(self, utterance):
+        prev_side = self.messages[-1].who if self.messages else ''
+        append_step(self.all_steps, utterance, prev_side)
+        if not utterance.is_command():
+            append_step(self.chitchat_steps, utterance, prev_side)
+            append_step(self.interpreter_steps, utterance, self.last_dialog_side)
+            self.last_dialog_side = utterance.who
+
+        self.messages.append(utterance)
+        self.nb_messages += 1
+
+    def add_human_message(self, text):
+        self.add_message(Utterance('H', text))
+
+    def add_bot_message(self, text, self_interpretation=None):
+        self.add_message(Utterance('B', text, self_interpretation))
+        self.replies_queue.append(text)
+
+    def add_command(self, command_text):
+        self.add_message(Utterance('X', command_text))
+
+    def get_printable(self):
+        lines = []
+        for m in self.messages:
+            lines.append('{}: {}'.format(m.who, m.text))
+        return lines
+
+    def get_last_message(self):
+        return self.messages[-1]
+
+    def constuct_interpreter_contexts(self):
+        contexts = set()
+
+        max_history = 2
+
+        steps = []
+        for step in list(self.interpreter_steps)[-(max_history+1):]:
+            texts = []
+            for message in step:
+                msg_text = message.get_interpretation()
+                if msg_text is None:
+                    msg_text = message.get_text()
+                texts.append(msg_text)
+            steps.append(join_step_texts(texts))
+
+        for n in range(2, max_history+2):
+            last_steps = steps[-n:]
+            context = ' | '.join(last_steps)
+            contexts.add(context)
+
+        return sorted(list(contexts), key=lambda s: -len(s))
+
+    def construct_entailment_context(self):
+        steps = [join_step_texts([message.get_text() for message in step]) for step in list(self.all_steps)[-2:]]
+        return ' | '.join(steps)
+
+    def construct_chitchat_context(self, last_utterance_interpretation, last_utterance_labels, max_depth=10, include_commands=False):
+        """Контекст для читчата из последних max_depth шагов диалога (не больше max_context_depth)"""
+        labels2 = []
+        if last_utterance_labels:
+            for x in last_utterance_labels:
+                if x[-1] not in '.?!':
+                    labels2.append(x+'.')
+                else:
+                    labels2.append(x)
+
+        if labels2:
+            last_utterance_labels_txt = '[{}]'.format(' '.join(labels2))
+        else:
+            last_utterance_labels_txt = None
+
+        last_message = self.messages[-1] if self.messages else None
+        steps = []
+        for step in list(self.all_steps if include_commands else self.chitchat_steps)[-max_depth:]:
+            texts = []
+            for message in step:
+                if message is last_message and last_utterance_interpretation:
+                    texts.append(last_utterance_interpretation)
+                else:
+                    texts.append(message.get_text())
+            steps.append(join_step_texts(texts))
+
+        if last_utterance_labels_txt:
+            return steps + [last_utterance_labels_txt]
+        else:
+            return steps
+
+
+    def set_last_message_interpretation(self, interpretation_text):
+        self.messages[-1].set_interpretation(interpretation_text)
+
+    def __len__(self):
+        return self.nb_messages
@@ -0,0 +1,153 @@
+"""
+Экспорт моделей rubert+классификатор в TorchScript.
+
+rubert трассируется в отдельный модуль, общий для всех детекторов, чтобы не дублировать его веса в памяти.
+Голова каждого детектора трассируется со всеми методами, которые используются при поиске фактов,
+при этом ветвления по arch исчезают - в трассе остается только выбранная архитектура.
+Трассированные модули замораживаются (torch.jit.freeze).
+
+BotCore.load использует экспортированные модули, если находит их рядом с весами моделей.
+
+Запуск:
+python model_export.py --bert ruBert-base --models_dir ../../tmp [--quantize]
+
+18.10.2026 Начальная реализация
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+
+import torch
+import torch.nn as nn
+import transformers
+
+from ruchatbot.bot.rubert_relevancy_detector import RubertRelevancyDetector
+from ruchatbot.bot.rubert_synonymy_detector import RubertSynonymyDetector
+from ruchatbot.bot.model_quantization import quantize_model
+
+
+TRACED_BERT_FILENAME = 'rubert.traced.pt'
+
+
+def get_traced_head_path(models_dir, model_name):
+    return os.path.join(models_dir, model_name + '.traced.pt')
+
+
+def calc_file_hash(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class BertWrapper(nn.Module):
+    def __init__(self, bert_model):
+        super(BertWrapper, self).__init__()
+        self.bert_model = bert_model
+
+    def forward(self, input_ids, attention_mask):
+        return self.bert_model(input_ids, attention_mask=attention_mask)[0]
+
+
+class RelevancyHeadWrapper(nn.Module):
+    def __init__(self, detector):
+        super(RelevancyHeadWrapper, self).__init__()
+        self.detector = detector
+
+    def forward(self, b1, b2):
+        return self.detector.forward_0(b1, b2)
+
+    def premise_features(self, b1):
+        return self.detector.premise_features(b1)
+
+    def query_features(self, b2):
+        return self.detector.query_features(b2)
+
+    def merge_features(self, v1, v2):
+        return self.detector.merge_features(v1, v2)
+
+
+class SynonymyHeadWrapper(nn.Module):
+    def __init__(self, detector):
+        super(SynonymyHeadWrapper, self).__init__()
+        self.detector = detector
+
+    def forward(self, b1, b2):
+        return self.detector.forward_0(b1, b2)
+
+
+def export_bert(bert_path, max_len, output_path, quantize):
+    bert_model = transformers.BertModel.from_pretrained(bert_path, torchscript=True)
+    bert_model.eval()
+    if quantize:
+        quantize_model(bert_model, torch.device('cpu'))
+
+    input_ids = torch.ones((2, max_len), dtype=torch.long)
+    attention_mask = torch.ones((2, max_len), dtype=torch.long)
+    with torch.no_grad():
+        traced = torch.jit.trace(BertWrapper(bert_model).eval(), (input_ids, attention_mask))
+    traced = torch.jit.freeze(traced)
+    torch.jit.save(traced, output_path)
+    return bert_model.config.hidden_size
+
+
+def export_relevancy_head(models_dir, model_name, hidden_size, quantize):
+    with open(os.path.join(models_dir, model_name + '.cfg'), 'r') as f:
+        cfg = json.load(f)
+    detector = RubertRelevancyDetector(device=torch.device('cpu'), **cfg)
+    detector.load_weights(os.path.join(models_dir, model_name + '.pt'))
+    if quantize:
+        quantize_model(detector, torch.device('cpu'))
+
+    b = torch.zeros((2, detector.max_len, hidden_size))
+    with torch.no_grad():
+        v = detector.premise_features(b)
+        inputs = {'forward': (b, b),
+                  'premise_features': (b,),
+                  'query_features': (b,),
+                  'merge_features': (v, v)}
+        traced = torch.jit.trace_module(RelevancyHeadWrapper(detector).eval(), inputs)
+    traced = torch.jit.freeze(traced, preserved_attrs=['premise_features', 'query_features', 'merge_features'])
+    torch.jit.save(traced, get_traced_head_path(models_dir, model_name))
+
+
+def export_synonymy_head(models_dir, model_name, hidden_size, quantize):
+    with open(os.path.join(models_dir, model_name + '.cfg'), 'r') as f:
+        cfg = json.load(f)
+    detector = RubertSynonymyDetector(device=torch.device('cpu'), **cfg)
+    detector.load_weights(os.path.join(models_dir, model_name + '.pt'))
+    if quantize:
+        quantize_model(detector, torch.device('cpu'))
+
+    b = torch.zeros((2, detector.max_len, hidden_size))
+    with torch.no_grad():
+        traced = torch.jit.trace(SynonymyHeadWrapper(detector).eval(), (b, b))
+    traced = torch.jit.freeze(traced)
+    torch.jit.save(traced, get_traced_head_path(models_dir, model_name))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Экспорт rubert и классификаторов в TorchScript')
+    parser.add_argument('--bert', type=str, default='/media/inkoziev/corpora/EmbeddingModels/ruBert-base')
+    parser.add_argument('--models_dir', type=str, default='../../tmp')
+    parser.add_argument('--quantize', action='store_true', help='экспортировать int8-квантованные модели')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    with open(os.path.join(args.models_dir, 'pq_relevancy_rubert_model.cfg'), 'r') as f:
+        max_len = json.load(f)['max_len']
+
+    bert_output_path = os.path.join(args.models_dir, TRACED_BERT_FILENAME)
+    hidden_size = export_bert(args.bert, max_len, bert_output_path, args.quantize)
+    print('rubert exported to "{}"'.format(bert_output_path))
+
+    export_relevancy_head(args.models_dir, 'pq_relevancy_rubert_model', hidden_size, args.quantize)
+    print('Relevancy classifier exported to "{}"'.format(get_traced_head_path(args.models_dir, 'pq_relevancy_rubert_model')))
+
+    export_synonymy_head(args.models_dir, 'rubert_synonymy_model', hidden_size, args.quantize)
+    print('Synonymy classifier exported to "{}"'.format(get_traced_head_path(args.models_dir, 'rubert_synonymy_model')))
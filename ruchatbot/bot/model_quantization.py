@@ -0,0 +1,106 @@
+"""
+Динамическая int8-квантизация rubert и классификаторов для инференса на CPU.
+
+Веса Linear и LSTM слоев хранятся в int8, активации квантуются на лету. Квантизация поддерживается
+только на CPU, поэтому на GPU модели остаются в fp32.
+
+Запуск модуля как скрипта выполняет калибровочный прогон: скоры детекторов релевантности и синонимичности
+в fp32 и int8 сравниваются на отложенных парах текстов, печатается время инференса и отклонение скоров.
+Файл с парами - tsv с двумя колонками: предпосылка (или первый текст) и вопрос (или второй текст).
+
+18.10.2026 Начальная реализация
+"""
+
+import argparse
+import copy
+import io
+import json
+import logging
+import os
+import time
+
+import torch
+import torch.nn as nn
+import transformers
+
+from ruchatbot.bot.rubert_relevancy_detector import RubertRelevancyDetector
+from ruchatbot.bot.rubert_synonymy_detector import RubertSynonymyDetector
+
+
+def quantize_model(model, device):
+    """Квантизация in-place, возвращается тот же экземпляр модели"""
+    if device.type != 'cpu':
+        logging.getLogger('model_quantization').warning('Dynamic int8 quantization is supported only on CPU, %s model is kept in fp32', type(model).__name__)
+        return model
+
+    torch.quantization.quantize_dynamic(model, {nn.Linear, nn.LSTM}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def score_pairs(detector, pairs, batch_size=100):
+    """Скоры пар текстов, вычисляемые батчами. Возвращает список скоров и время работы в секундах"""
+    scores = []
+    t0 = time.time()
+    with torch.no_grad():
+        for i in range(0, len(pairs), batch_size):
+            batch = pairs[i: i+batch_size]
+            tokens1 = detector.encode_texts([text1 for text1, _ in batch])
+            tokens2 = detector.encode_texts([text2 for _, text2 in batch])
+            y = detector.forward_0(detector.run_bert(detector.pad_batch(tokens1)), detector.run_bert(detector.pad_batch(tokens2)))
+            scores.extend(y.view(-1).tolist())
+    return scores, time.time() - t0
+
+
+def load_detector(detector_class, models_dir, model_name, bert_model, bert_tokenizer, device, quantize):
+    with open(os.path.join(models_dir, model_name + '.cfg'), 'r') as f:
+        cfg = json.load(f)
+    detector = detector_class(device=device, **cfg)
+    detector.load_weights(os.path.join(models_dir, model_name + '.pt'))
+    if quantize:
+        quantize_model(detector, device)
+    detector.bert_model = bert_model
+    detector.bert_tokenizer = bert_tokenizer
+    return detector
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Сравнение fp32 и int8 моделей rubert+классификатор')
+    parser.add_argument('--bert', type=str, default='/media/inkoziev/corpora/EmbeddingModels/ruBert-base')
+    parser.add_argument('--models_dir', type=str, default='../../tmp')
+    parser.add_argument('--pairs', type=str, required=True, help='tsv файл с отложенными парами текстов')
+    parser.add_argument('--threshold', type=float, default=0.80, help='порог для подсчета изменившихся решений')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    device = torch.device('cpu')
+
+    pairs = []
+    with io.open(args.pairs, 'r', encoding='utf-8') as rdr:
+        for line in rdr:
+            fields = line.strip().split('\t')
+            if len(fields) >= 2:
+                pairs.append((fields[0], fields[1]))
+    print('{} pairs loaded from "{}"'.format(len(pairs), args.pairs))
+
+    bert_tokenizer = transformers.BertTokenizerFast.from_pretrained(args.bert, do_lower_case=False)
+    bert_fp32 = transformers.BertModel.from_pretrained(args.bert)
+    bert_fp32.eval()
+    bert_int8 = quantize_model(copy.deepcopy(bert_fp32), device)
+
+    for detector_class, model_name in [(RubertRelevancyDetector, 'pq_relevancy_rubert_model'),
+                                       (RubertSynonymyDetector, 'rubert_synonymy_model')]:
+        detector_fp32 = load_detector(detector_class, args.models_dir, model_name, bert_fp32, bert_tokenizer, device, False)
+        detector_int8 = load_detector(detector_class, args.models_dir, model_name, bert_int8, bert_tokenizer, device, True)
+
+        scores_fp32, time_fp32 = score_pairs(detector_fp32, pairs)
+        scores_int8, time_int8 = score_pairs(detector_int8, pairs)
+
+        drifts = [abs(y1 - y2) for y1, y2 in zip(scores_fp32, scores_int8)]
+        nb_flips = sum((y1 >= args.threshold) != (y2 >= args.threshold) for y1, y2 in zip(scores_fp32, scores_int8))
+
+        print('\n{}:'.format(model_name))
+        print('fp32 latency:  {:.2f} ms per pair'.format(1000.0 * time_fp32 / max(1, len(pairs))))
+        print('int8 latency:  {:.2f} ms per pair (speedup {:.2f}x)'.format(1000.0 * time_int8 / max(1, len(pairs)), time_fp32 / max(1e-6, time_int8)))
+        print('score drift:   mean={:.4f} max={:.4f}'.format(sum(drifts) / max(1, len(drifts)), max(drifts, default=0.0)))
+        print('decision flips at threshold {}: {} of {}'.format(args.threshold, nb_flips, len(pairs)))
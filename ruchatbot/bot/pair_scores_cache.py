@@ -0,0 +1,102 @@
+"""
+Общий для всех сессий кэш скоров пар (запрос, факт) для детекторов на базе rubert.
+
+Собеседники часто задают одни и те же вопросы ("как тебя зовут?", "сколько тебе лет?"), и одни и те же
+пары (запрос, факт) оцениваются классификатором заново в каждом ходе диалога. Кэш хранит скоры в ограниченном
+LRU, ключ - (идентификатор модели, нормализованный запрос, текст факта). Идентификатором факта служит его текст,
+так как скор детектора зависит только от текстов.
+
+При изменении фактов их записи удаляются из кэша, при смене весов моделей кэш полностью очищается.
+
+18.10.2026 Начальная реализация для RubertRelevancyDetector и RubertSynonymyDetector
+18.10.2026 Идентификатор модели включает хэши весов rubert и головы классификатора, см. BotCore.load_traced_models
+"""
+
+import collections
+import logging
+import threading
+
+
+def normalize_query(query):
+    # rubert-токенизатор чувствителен к регистру и пунктуации, поэтому убираем только лишние пробелы.
+    return ' '.join(query.split())
+
+
+class PairScoresCache(object):
+    def __init__(self, max_size=200000):
+        """
+        :param max_size: максимальное число хранимых скоров пар
+        """
+        self.max_size = max_size
+        self.scores = collections.OrderedDict()  # (model_id, query, fact) => score
+        self.fact2keys = collections.defaultdict(set)  # fact => ключи в self.scores, для инвалидации по факту
+        self.nb_hits = collections.Counter()  # model_id => число найденных в кэше скоров
+        self.nb_misses = collections.Counter()  # model_id => число вычисленных заново скоров
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('PairScoresCache')
+
+    def __len__(self):
+        return len(self.scores)
+
+    def get_scores(self, model_id, query, facts):
+        """Возвращаем список скоров для фактов facts, на месте отсутствующих в кэше скоров будет None"""
+        query = normalize_query(query)
+        res = [None] * len(facts)
+        with self.lock:
+            for i, fact in enumerate(facts):
+                key = (model_id, query, fact)
+                score = self.scores.get(key)
+                if score is not None:
+                    self.scores.move_to_end(key)
+                    res[i] = score
+                    self.nb_hits[model_id] += 1
+                else:
+                    self.nb_misses[model_id] += 1
+        return res
+
+    def put_scores(self, model_id, query, facts, scores):
+        query = normalize_query(query)
+        with self.lock:
+            for fact, score in zip(facts, scores):
+                key = (model_id, query, fact)
+                self.scores[key] = score
+                self.scores.move_to_end(key)
+                self.fact2keys[fact].add(key)
+
+            while len(self.scores) > self.max_size:
+                key, _ = self.scores.popitem(last=False)
+                self._forget_key(key)
+
+    def _forget_key(self, key):
+        fact = key[2]
+        keys = self.fact2keys.get(fact)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.fact2keys[fact]
+
+    def invalidate_facts(self, facts):
+        """Удаляем все скоры, вычисленные для указанных фактов"""
+        with self.lock:
+            for fact in facts:
+                for key in self.fact2keys.pop(fact, ()):
+                    self.scores.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.scores.clear()
+            self.fact2keys.clear()
+
+    def get_hit_rate(self, model_id=None):
+        """Доля скоров, взятых из кэша - для одной модели или в целом"""
+        if model_id is None:
+            nb_hits = sum(self.nb_hits.values())
+            nb_total = nb_hits + sum(self.nb_misses.values())
+        else:
+            nb_hits = self.nb_hits[model_id]
+            nb_total = nb_hits + self.nb_misses[model_id]
+        return nb_hits / float(max(1, nb_total))
+
+    def get_stats(self):
+        return dict((model_id, (self.nb_hits[model_id], self.nb_misses[model_id], self.get_hit_rate(model_id)))
+                    for model_id in set(self.nb_hits) | set(self.nb_misses))
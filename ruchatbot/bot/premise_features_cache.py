@@ -0,0 +1,117 @@
+"""
+Кэш признаков фактов базы знаний для детекторов на базе rubert+классификатор.
+
+Факты в БЗ меняются редко, а прогонять их через rubert приходится при каждом поиске релевантной предпосылки.
+Поэтому для каждого текста факта один раз запоминаем признаки, которые вычисляет "премисная" ветка головы
+классификатора. В кэш попадают только факты БЗ, временные предпосылки отдельного хода в нем не хранятся.
+
+Кэш привязан к хэшам весов rubert и головы классификатора. При загрузке сохраненного кэша с другими весами
+он отбрасывается и будет пересчитан.
+
+18.10.2026 Начальная реализация для RubertRelevancyDetector
+18.10.2026 Выходы rubert для фактов больше не хранятся, они занимали основную часть памяти кэша
+18.10.2026 Хэш головы классификатора считается только по весам ее подмодулей из явного списка
+"""
+
+import hashlib
+import logging
+import os
+
+import torch
+
+
+def update_hash(md5, value):
+    if isinstance(value, torch.Tensor):
+        if value.is_quantized:
+            # У квантованных моделей в state_dict лежат int8-тензоры и их параметры квантования
+            md5.update(str(value.qscheme()).encode('utf-8'))
+            value = value.int_repr()
+        md5.update(value.detach().cpu().contiguous().numpy().tobytes())
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            update_hash(md5, v)
+    elif isinstance(value, torch._C.ScriptObject):
+        # Упакованные веса квантованных LSTM
+        update_hash(md5, value.__getstate__())
+    else:
+        md5.update(repr(value).encode('utf-8'))
+
+
+def calc_module_hash(module, submodules=None):
+    """
+    Вычисляем md5 по всем тензорам в state_dict модуля, в фиксированном порядке ключей.
+    Если задан список имен подмодулей submodules, то хэшируются только их веса.
+    """
+    md5 = hashlib.md5()
+    if submodules is None:
+        state = module.state_dict()
+    else:
+        state = dict()
+        for name in submodules:
+            for key, value in getattr(module, name).state_dict().items():
+                state[name + '.' + key] = value
+
+    for key in sorted(state.keys()):
+        md5.update(key.encode('utf-8'))
+        update_hash(md5, state[key])
+    return md5.hexdigest()
+
+
+class PremiseFeaturesCache(object):
+    def __init__(self, bert_hash, head_hash):
+        self.bert_hash = bert_hash
+        self.head_hash = head_hash
+        self.features = dict()  # текст факта => признаки премисной ветки классификатора
+        self.logger = logging.getLogger('PremiseFeaturesCache')
+
+    def __len__(self):
+        return len(self.features)
+
+    def __contains__(self, text):
+        return text in self.features
+
+    def get_missing(self, texts):
+        """Возвращаем список уникальных текстов, для которых в кэше еще нет признаков"""
+        missing = []
+        seen = set()
+        for text in texts:
+            if text not in self.features and text not in seen:
+                missing.append(text)
+                seen.add(text)
+        return missing
+
+    def add(self, text, features):
+        self.features[text] = features
+
+    def stack_features(self, texts, device, extra_features=None):
+        """
+        Собираем тензор признаков для texts.
+        :param extra_features: признаки текстов, которых нет в кэше, например временных предпосылок
+        """
+        if extra_features:
+            return torch.stack([self.features.get(text, extra_features.get(text)) for text in texts]).to(device)
+        return torch.stack([self.features[text] for text in texts]).to(device)
+
+    def save(self, cache_path):
+        self.logger.debug('Saving %d premise features to "%s"', len(self.features), cache_path)
+        torch.save({'bert_hash': self.bert_hash,
+                    'head_hash': self.head_hash,
+                    'features': self.features}, cache_path)
+
+    def load(self, cache_path):
+        if not os.path.exists(cache_path):
+            return False
+
+        data = torch.load(cache_path, map_location='cpu')
+        if data['bert_hash'] != self.bert_hash:
+            self.logger.info('Premise features cache "%s" is outdated: rubert weights changed', cache_path)
+            return False
+
+        if data['head_hash'] != self.head_hash:
+            self.logger.info('Premise features cache "%s" is outdated: classifier weights changed', cache_path)
+            return False
+
+        self.features.update(data['features'])
+
+        self.logger.debug('%d premise features loaded from "%s"', len(self.features), cache_path)
+        return True
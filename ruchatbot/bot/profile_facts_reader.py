@@ -10,8 +10,14 @@
 
 29.01.2021 Генерируемые факты - при чтении строки из профиля она разбивается по символу | и выбирается одна из
            получившихся строк. Таким образом можно вводить вариативность в набор фактов.
+
+18.10.2026 Разобранные факты профиля хранятся в одном на весь процесс экземпляре ProfileKnowledgeBase,
+           сессия хранит только свой выбор вариантов и новые факты.
+18.10.2026 ProfileKnowledgeBase может загружаться из скомпилированного бинарного кэша (см. compiled_profile_facts.py),
+           при изменении исходных файлов БЗ перечитывается.
 """
 
+import array
 import io
 import itertools
 import os
@@ -19,15 +25,216 @@ import re
 import logging
 import random
 import collections
+import threading
+
+import numpy as np
 
+from ruchatbot.bot.compiled_profile_facts import get_source_mtimes, write_compiled_facts, read_compiled_header, is_fresh, map_compiled_facts
 from ruchatbot.bot.simple_facts_storage import SimpleFactsStorage
 from ruchatbot.utils.constant_replacer import replace_constant
 
 
+class ProfileKnowledgeBase(object):
+    """
+    Разобранные факты профиля. Для каждой строки хранятся все ее варианты (альтернативы через |) после
+    канонизации и подстановки констант. Экземпляр не меняется после загрузки и разделяется всеми сессиями,
+    см. get_profile_knowledge_base.
+    """
+
+    def __init__(self, profile_path, constants, profile_config_path=None):
+        """
+        :param profile_config_path: json-файл профиля, из которого взяты константы; его изменение делает БЗ устаревшей
+        """
+        self.profile_path = profile_path
+        self.constants = constants
+        self.profile_config_path = profile_config_path
+        self.entries = []  # [(кортеж вариантов текста факта, раздел, файл-источник)]
+        self.variant_entries = []  # индексы записей, у которых больше одного варианта
+        self.source_mtimes = dict()  # файл => время модификации на момент загрузки
+        self.text_tokens = None  # текст варианта факта => токены rubert, если БЗ загружена из скомпилированного кэша
+        self.compiled_mm = None
+        self.logger = logging.getLogger('ProfileKnowledgeBase')
+
+    def is_stale(self):
+        return get_source_mtimes(self.source_mtimes) != self.source_mtimes
+
+    def add_line(self, line, section, source_path, text_utils):
+        alternatives = []
+        for line1 in line.split('|'):
+            canonized_line = text_utils.canonize_text(line1.strip())
+            canonized_line = replace_constant(canonized_line, self.constants, text_utils)
+            alternatives.append(canonized_line)
+
+        if len(alternatives) > 1:
+            self.variant_entries.append(len(self.entries))
+        self.entries.append((tuple(alternatives), section, source_path))
+
+    def load(self, text_utils):
+        self.logger.info('Loading profile facts from "%s"', self.profile_path)
+        # Времена модификации берем до чтения, чтобы изменение файла во время чтения тоже привело к перезагрузке
+        source_mtimes = get_source_mtimes([path for path in [self.profile_config_path, self.profile_path] if path is not None])
+        if self.profile_path is not None:
+            with io.open(self.profile_path, 'r', encoding='utf=8') as rdr:
+                current_section = None
+                for line in rdr:
+                    line = line.strip()
+                    if line:
+                        if line.startswith('#'):
+                            if line.startswith('##'):
+                                if 'profile_section:' in line:
+                                    # Задается раздел баз знаний
+                                    current_section = line[line.index(':')+1:].strip()
+                                    if current_section not in ('1s', '2s', '3'):
+                                        msg = 'Unknown profile section {}'.format(current_section)
+                                        raise RuntimeError(msg)
+                                elif 'import' in line:
+                                    # Читаем факты из дополнительного файла
+                                    fn = re.search('import "(.+)"', line).group(1).strip()
+                                    add_path = os.path.join(os.path.dirname(self.profile_path), fn)
+                                    self.logger.debug('Loading facts from file "%s"...', add_path)
+                                    source_mtimes.update(get_source_mtimes([add_path]))
+                                    with io.open(add_path, 'rt', encoding='utf-8') as rdr2:
+                                        for line in rdr2:
+                                            line = line.strip()
+                                            if line and not line.startswith('#'):
+                                                self.add_line(line, current_section, add_path, text_utils)
+
+                            else:
+                                # Строки с одним # считаем комментариями.
+                                continue
+                        else:
+                            assert(current_section)
+                            self.add_line(line, current_section, self.profile_path, text_utils)
+        self.source_mtimes = source_mtimes
+        self.logger.debug('%d facts loaded from "%s"', len(self.entries), self.profile_path)
+
+    def save_compiled(self, output_path, bert_tokenizer):
+        """Сохраняем БЗ вместе с токенами rubert всех вариантов фактов в бинарный кэш"""
+        texts = [text for alternatives, _, _ in self.entries for text in alternatives]
+        sections = sorted(set(str(section) for _, section, _ in self.entries))
+        source_paths = sorted(set(source_path for _, _, source_path in self.entries))
+
+        encoded_texts = [text.encode('utf-8') for text in texts]
+        text_offsets = np.cumsum([0] + [len(z) for z in encoded_texts], dtype=np.int64)
+
+        entries = np.zeros((len(self.entries), 4), dtype=np.int32)
+        first = 0
+        for i, (alternatives, section, source_path) in enumerate(self.entries):
+            entries[i] = (first, len(alternatives), sections.index(str(section)), source_paths.index(source_path))
+            first += len(alternatives)
+
+        token_ids = bert_tokenizer(texts, add_special_tokens=True)['input_ids'] if texts else []
+        token_offsets = np.cumsum([0] + [len(z) for z in token_ids], dtype=np.int64)
+        tokens = np.asarray([t for z in token_ids for t in z], dtype=np.int32)
+
+        header = {'profile_path': self.profile_path,
+                  'constants': self.constants,
+                  'tokenizer': bert_tokenizer.name_or_path,
+                  'sources': self.source_mtimes,
+                  'sections': sections,
+                  'source_paths': source_paths}
+        write_compiled_facts(output_path, header, [('texts', b''.join(encoded_texts)),
+                                                   ('text_offsets', text_offsets),
+                                                   ('entries', entries),
+                                                   ('tokens', tokens),
+                                                   ('token_offsets', token_offsets)])
+        self.text_tokens = dict((text, tokens[token_offsets[i]: token_offsets[i+1]]) for i, text in enumerate(texts))
+        self.logger.info('Profile facts compiled to "%s"', output_path)
+
+    @staticmethod
+    def load_compiled(input_path, profile_path, constants, profile_config_path=None, bert_tokenizer=None):
+        """Загружаем БЗ из скомпилированного кэша; None, если кэша нет или он устарел"""
+        header = read_compiled_header(input_path)
+        if header is None or header['profile_path'] != profile_path or header['constants'] != constants \
+                or (bert_tokenizer is not None and header['tokenizer'] != bert_tokenizer.name_or_path) \
+                or (profile_config_path is not None and profile_config_path not in header['sources']) or not is_fresh(header):
+            return None
+
+        knowledge_base = ProfileKnowledgeBase(profile_path, constants, profile_config_path)
+        knowledge_base.compiled_mm, arrays = map_compiled_facts(input_path, header)
+        knowledge_base.source_mtimes = header['sources']
+
+        texts_blob = arrays['texts']
+        text_offsets = arrays['text_offsets']
+        texts = [texts_blob[text_offsets[i]: text_offsets[i+1]].tobytes().decode('utf-8') for i in range(len(text_offsets) - 1)]
+
+        sections = [(None if section == 'None' else section) for section in header['sections']]
+        source_paths = header['source_paths']
+        for first, nb_alternatives, isection, isource in arrays['entries'].reshape(-1, 4).tolist():
+            if nb_alternatives > 1:
+                knowledge_base.variant_entries.append(len(knowledge_base.entries))
+            knowledge_base.entries.append((tuple(texts[first: first+nb_alternatives]), sections[isection], source_paths[isource]))
+
+        # Токены - представления массива из отображенного в память файла, без копирования
+        tokens = arrays['tokens']
+        token_offsets = arrays['token_offsets']
+        knowledge_base.text_tokens = dict((text, tokens[token_offsets[i]: token_offsets[i+1]]) for i, text in enumerate(texts))
+
+        knowledge_base.logger.info('%d profile facts loaded from compiled cache "%s"', len(knowledge_base.entries), input_path)
+        return knowledge_base
+
+    def choose_variants(self):
+        """Случайный выбор варианта для каждой записи с несколькими вариантами"""
+        return array.array('H', (random.randrange(len(self.entries[i][0])) for i in self.variant_entries))
+
+    def enumerate_facts(self, variant_choices):
+        choices = iter(variant_choices)
+        for alternatives, section, source_path in self.entries:
+            if len(alternatives) > 1:
+                yield alternatives[next(choices)], section, source_path
+            else:
+                yield alternatives[0], section, source_path
+
+    def enumerate_all_texts(self):
+        """Тексты всех вариантов всех фактов"""
+        for alternatives, _, _ in self.entries:
+            for text in alternatives:
+                yield text
+
+
+_knowledge_bases = dict()
+_knowledge_bases_lock = threading.Lock()
+
+
+_compiled_settings = dict()  # ключ БЗ => (путь к скомпилированному кэшу, json профиля, токенизатор rubert)
+
+
+def get_profile_knowledge_base(profile_path, constants, text_utils, compiled_path=None, profile_config_path=None, bert_tokenizer=None):
+    """
+    Возвращаем общую для всего процесса БЗ профиля. При первом обращении или после изменения исходных файлов
+    БЗ загружается - из скомпилированного кэша compiled_path, если он актуален, иначе разбором текстовых файлов
+    с последующей пересборкой кэша. Параметры кэша запоминаются, так что обычные вызовы из сессий их не передают.
+    """
+    key = (profile_path, tuple(sorted(constants.items())) if constants else ())
+    with _knowledge_bases_lock:
+        if compiled_path is not None:
+            _compiled_settings[key] = (compiled_path, profile_config_path, bert_tokenizer)
+
+        knowledge_base = _knowledge_bases.get(key)
+        if knowledge_base is not None and knowledge_base.is_stale():
+            knowledge_base = None
+
+        if knowledge_base is None:
+            compiled_path, profile_config_path, bert_tokenizer = _compiled_settings.get(key, (None, profile_config_path, None))
+            if compiled_path is not None:
+                knowledge_base = ProfileKnowledgeBase.load_compiled(compiled_path, profile_path, constants, profile_config_path, bert_tokenizer)
+
+            if knowledge_base is None:
+                knowledge_base = ProfileKnowledgeBase(profile_path, constants, profile_config_path)
+                knowledge_base.load(text_utils)
+                if compiled_path is not None and bert_tokenizer is not None:
+                    knowledge_base.save_compiled(compiled_path, bert_tokenizer)
+
+            _knowledge_bases[key] = knowledge_base
+        return knowledge_base
+
+
 class ProfileFactsReader(SimpleFactsStorage):
     """
     Класс читает факты из одного файла. Новые факты (например, имя собеседника) хранятся только в памяти,
     таким образом персистентность не реализована.
+    Сами факты профиля берутся из общей ProfileKnowledgeBase, экземпляр класса хранит только выбранные
+    для этой сессии варианты фактов и новые факты.
     """
 
     def __init__(self, text_utils, profile_path, constants):
@@ -38,60 +245,29 @@ class ProfileFactsReader(SimpleFactsStorage):
         super(ProfileFactsReader, self).__init__(text_utils)
         self.text_utils = text_utils
         self.profile_path = profile_path
-        self.profile_facts = None
+        self.knowledge_base = None
+        self.variant_choices = None  # номера выбранных вариантов для фактов с несколькими вариантами
         self.constants = constants
         self.new_facts = collections.defaultdict(list)  # списки новых фактов в привязке к id собеса
         self.logger = logging.getLogger('ProfileFactsReader')
 
     def load_profile(self):
-        if self.profile_facts is None:
-            self.logger.info('Loading profile facts from "%s"', self.profile_path)
-            self.profile_facts = []
-            if self.profile_path is not None:
-                with io.open(self.profile_path, 'r', encoding='utf=8') as rdr:
-                    current_section = None
-                    for line in rdr:
-                        line = line.strip()
-                        if line:
-                            if line.startswith('#'):
-                                if line.startswith('##'):
-                                    if 'profile_section:' in line:
-                                        # Задается раздел баз знаний
-                                        current_section = line[line.index(':')+1:].strip()
-                                        if current_section not in ('1s', '2s', '3'):
-                                            msg = 'Unknown profile section {}'.format(current_section)
-                                            raise RuntimeError(msg)
-                                    elif 'import' in line:
-                                        # Читаем факты из дополнительного файла
-                                        fn = re.search('import "(.+)"', line).group(1).strip()
-                                        add_path = os.path.join(os.path.dirname(self.profile_path), fn)
-                                        self.logger.debug('Loading facts from file "%s"...', add_path)
-                                        with io.open(add_path, 'rt', encoding='utf-8') as rdr2:
-                                            for line in rdr2:
-                                                line = line.strip()
-                                                if line and not line.startswith('#'):
-                                                    line1 = random.choice(line.split('|')).strip()
-                                                    canonized_line = self.text_utils.canonize_text(line1)
-                                                    canonized_line = replace_constant(canonized_line, self.constants, self.text_utils)
-                                                    self.profile_facts.append((canonized_line, current_section, add_path))
-
-                                else:
-                                    # Строки с одним # считаем комментариями.
-                                    continue
-                            else:
-                                assert(current_section)
-                                line1 = random.choice(line.split('|')).strip()
-                                canonized_line = self.text_utils.canonize_text(line1)
-                                canonized_line = replace_constant(canonized_line, self.constants, self.text_utils)
-                                self.profile_facts.append((canonized_line, current_section, self.profile_path))
-            self.logger.debug('%d facts loaded from "%s"', len(self.profile_facts), self.profile_path)
+        if self.knowledge_base is None:
+            self.knowledge_base = get_profile_knowledge_base(self.profile_path, self.constants, self.text_utils)
+            self.variant_choices = self.knowledge_base.choose_variants()
+
+    @property
+    def profile_facts(self):
+        self.load_profile()
+        return list(self.knowledge_base.enumerate_facts(self.variant_choices))
 
     def reset_added_facts(self):
         self.new_facts = collections.defaultdict(list)
 
     def reset_all_facts(self):
         self.reset_added_facts()
-        self.profile_facts = None
+        self.knowledge_base = None
+        self.variant_choices = None
 
     def enumerate_facts(self, interlocutor):
         # Загрузим факты из профиля, если еще не загрузили.
@@ -100,7 +276,7 @@ class ProfileFactsReader(SimpleFactsStorage):
         # родительский класс добавит факты о текущем времени и т.д.
         parent_facts = list(super(ProfileFactsReader, self).enumerate_facts(interlocutor))
 
-        for f in itertools.chain(self.new_facts[interlocutor], self.profile_facts, parent_facts):
+        for f in itertools.chain(self.new_facts[interlocutor], self.knowledge_base.enumerate_facts(self.variant_choices), parent_facts):
             yield f
 
     def store_new_fact(self, interlocutor, fact, unique):
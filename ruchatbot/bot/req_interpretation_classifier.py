@@ -0,0 +1,132 @@
+"""
+Легковесный классификатор необходимости интерпретации (раскрытия анафоры, эллипсиса и т.д.) реплики собеседника.
+
+Если реплика самодостаточна ("я люблю кошек", "как тебя зовут?"), то генерация интерпретаций gpt-моделью
+не нужна, и BotCore использует текст реплики как есть. Модель - логистическая регрессия над хэшированными
+символьными n-граммами и словами, инференс на NumPy без обращения к torch.
+
+Датасет готовит preparation/prepare_req_interpretation_classif.py (файл tmp/req_interpretation_dataset.csv).
+
+Обучение:
+python req_interpretation_classifier.py --dataset ../../tmp/req_interpretation_dataset.csv --output ../../tmp/req_interpretation.npz
+
+18.10.2026 Начальная реализация
+"""
+
+import argparse
+import logging
+import zlib
+
+import numpy as np
+
+
+BEG_CHAR = '['
+END_CHAR = ']'
+
+
+def text_features(text, nb_buckets, max_ngram):
+    """Индексы хэшированных признаков: символьные n-граммы длиной 1..max_ngram и слова целиком"""
+    s = BEG_CHAR + ' '.join(text.lower().split()) + END_CHAR
+    features = set()
+    for n in range(1, max_ngram + 1):
+        for i in range(len(s) - n + 1):
+            features.add('c' + s[i: i + n])
+    for word in s[1:-1].split():
+        features.add('w' + word)
+    # Встроенный hash() рандомизирован между процессами, поэтому используем crc32
+    return np.asarray(sorted(zlib.crc32(f.encode('utf-8')) % nb_buckets for f in features), dtype=np.int64)
+
+
+class ReqInterpretationClassifier(object):
+    def __init__(self, nb_buckets=1 << 18, max_ngram=4):
+        self.nb_buckets = nb_buckets
+        self.max_ngram = max_ngram
+        self.weights = np.zeros(nb_buckets, dtype=np.float32)
+        self.bias = 0.0
+        self.logger = logging.getLogger('ReqInterpretationClassifier')
+
+    def load(self, model_path):
+        self.logger.info('Loading req interpretation classifier from "%s"', model_path)
+        data = np.load(model_path)
+        self.weights = data['weights'].astype(np.float32)
+        self.bias = float(data['bias'])
+        self.nb_buckets = int(data['nb_buckets'])
+        self.max_ngram = int(data['max_ngram'])
+
+    def save(self, model_path):
+        np.savez(model_path, weights=self.weights, bias=np.float32(self.bias),
+                 nb_buckets=np.int64(self.nb_buckets), max_ngram=np.int64(self.max_ngram))
+
+    def predict(self, text):
+        """Вероятность того, что реплика нуждается в интерпретации"""
+        x = self.weights[text_features(text, self.nb_buckets, self.max_ngram)].sum() + self.bias
+        return float(1.0 / (1.0 + np.exp(-x)))
+
+    def fit(self, texts, labels, weights=None, nb_epochs=10, batch_size=256, learning_rate=0.5, l2=1e-6):
+        """Обучение логистической регрессии минибатчевым градиентным спуском с adagrad"""
+        x = [text_features(text, self.nb_buckets, self.max_ngram) for text in texts]
+        y = np.asarray(labels, dtype=np.float32)
+        sample_weights = np.ones(len(x), dtype=np.float32) if weights is None else np.asarray(weights, dtype=np.float32)
+
+        self.weights = np.zeros(self.nb_buckets, dtype=np.float32)
+        self.bias = 0.0
+        g2 = np.full(self.nb_buckets, 1e-8, dtype=np.float32)
+        g2_bias = 1e-8
+
+        for epoch in range(nb_epochs):
+            total_loss = 0.0
+            for i0 in np.split(np.random.permutation(len(x)), range(batch_size, len(x), batch_size)):
+                batch_x = [x[i] for i in i0]
+                lens = np.asarray([len(z) for z in batch_x])
+                indeces = np.concatenate(batch_x)
+                offsets = np.concatenate([[0], np.cumsum(lens)[:-1]])
+
+                logits = np.add.reduceat(self.weights[indeces], offsets) + self.bias
+                p = 1.0 / (1.0 + np.exp(-logits))
+                err = (p - y[i0]) * sample_weights[i0]
+                total_loss -= np.sum(sample_weights[i0] * (y[i0] * np.log(p + 1e-8) + (1.0 - y[i0]) * np.log(1.0 - p + 1e-8)))
+
+                grad = np.zeros(self.nb_buckets, dtype=np.float32)
+                np.add.at(grad, indeces, np.repeat(err, lens))
+                grad = grad / len(i0) + l2 * self.weights
+                g2 += grad * grad
+                self.weights -= learning_rate * grad / np.sqrt(g2)
+
+                grad_bias = float(np.mean(err))
+                g2_bias += grad_bias * grad_bias
+                self.bias -= learning_rate * grad_bias / np.sqrt(g2_bias)
+
+            self.logger.info('Epoch %d loss=%f', epoch, total_loss / max(1, len(x)))
+
+
+if __name__ == '__main__':
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description='Обучение классификатора необходимости интерпретации реплик')
+    parser.add_argument('--dataset', type=str, default='../../tmp/req_interpretation_dataset.csv')
+    parser.add_argument('--output', type=str, default='../../tmp/req_interpretation.npz')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--threshold', type=float, default=0.2, help='порог для оценки доли пропущенных интерпретаций')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    np.random.seed(123456789)
+
+    df = pd.read_csv(args.dataset, delimiter='\t', encoding='utf-8')
+    df = df.sample(frac=1.0, random_state=123456789)
+    nb_val = len(df) // 10
+    df_val, df_train = df[:nb_val], df[nb_val:]
+
+    model = ReqInterpretationClassifier()
+    model.fit(df_train.text.values, df_train.label.values, df_train.weight.values, nb_epochs=args.epochs)
+
+    y_pred = np.asarray([model.predict(text) for text in df_val.text.values])
+    y_true = df_val.label.values
+    acc = np.mean((y_pred > 0.5) == (y_true == 1))
+    # Для бота важна доля реплик, нуждающихся в интерпретации, но пропущенных из-за низкой оценки
+    skipped = y_pred < args.threshold
+    missed = np.sum(skipped & (y_true == 1)) / float(max(1, np.sum(y_true == 1)))
+    print('val accuracy={:.4f} skip_rate@{}={:.4f} missed_interpretations={:.4f}'.format(acc, args.threshold, np.mean(skipped), missed))
+
+    model.save(args.output)
+    print('Model saved to "{}"'.format(args.output))
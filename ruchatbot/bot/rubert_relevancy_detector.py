@@ -12,19 +12,58 @@
            а тензор-"скаляр"
 24.03.2022 Разделение кода на варианты с внутренним вызовом rubert и с внешним, чтобы сделать в тренере вариант с предварительным
            прогоном всех сэмплов через rubert.
+18.10.2026 Голова классификатора разделена на премисную, вопросную и объединяющую части, чтобы кэшировать
+           признаки фактов БЗ между вызовами get_most_relevant (см. premise_features_cache.py)
+18.10.2026 В get_most_relevant вопрос прогоняется через rubert один раз, а не копируется на каждую предпосылку в батче
+18.10.2026 Опциональный отбор кандидатов по символьным триграммам перед оценкой релевантности (параметр nb_candidates)
+18.10.2026 Опциональный динамический паддинг с маской внимания и группировкой текстов по длине (dynamic_padding в .cfg)
+18.10.2026 Метод score_matrix для оценки релевантности сразу множества вопросов ко всем предпосылкам
+18.10.2026 Токены фактов могут браться из заранее заполненного хранилища BertTokensStore
+18.10.2026 Поддержка экспортированных в TorchScript rubert и головы классификатора, настройка числа потоков
+18.10.2026 Скоры пар (вопрос, предпосылка) могут браться из общего для всех сессий кэша PairScoresCache
+18.10.2026 Поиск из разных потоков выполняется по очереди под self.lock
+18.10.2026 Поиск не держит self.lock: общие индексы и кэши защищены своими блокировками, прогоны rubert идут параллельно
+18.10.2026 Подготовка батчей и прогон через rubert вынесены в общий с детектором синонимичности RubertBatchingMixin
+18.10.2026 В кэше признаков хранятся только факты БЗ, признаки временных предпосылок хода вычисляются на лету
+18.10.2026 Хэш головы классификатора для кэша признаков считается по явному списку ее подмодулей (head_modules)
+18.10.2026 Ключ модели в кэше скоров пар привязан к хэшам весов rubert и головы классификатора (set_model_id)
+18.10.2026 Динамический паддинг убран: голова классификатора обучена на входах, дополненных до max_len без маски внимания
+           (arch=1 суммирует выходы и на паддинге, arch=2 берет последний шаг LSTM), поэтому скоры зависят от паддинга
 """
 
+import threading
+
 import torch.utils.data
 import torch
 import torch.nn as nn
 import torch.utils.data
 
+from ruchatbot.bot.premise_features_cache import PremiseFeaturesCache, calc_module_hash
+from ruchatbot.bot.trigram_prefilter import TrigramPrefilter
+from ruchatbot.utils.rubert_batching import RubertBatchingMixin
+from ruchatbot.utils.torch_helpers import synchronized
+
 
-class RubertRelevancyDetector0(nn.Module):
-    def __init__(self, device, arch, max_len, sent_emb_size):
+class RubertRelevancyDetector0(RubertBatchingMixin, nn.Module):
+    # Подмодули головы классификатора для каждой архитектуры. Хэш кэша признаков фактов считается только по ним,
+    # а не по всему state_dict, куда попадают и подключенные rubert, и трассированные модели.
+    head_modules = {1: ['norm', 'fc1', 'fc2'],
+                    2: ['rnn1', 'rnn2', 'fc1', 'fc2'],
+                    3: ['conv1', 'conv2', 'fc1']}
+
+    def __init__(self, device, arch, max_len, sent_emb_size, num_threads=None):
         super(RubertRelevancyDetector0, self).__init__()
         self.max_len = max_len
         self.arch = arch
+        self.tokens_store = None
+        # Экспортированные в TorchScript rubert и голова классификатора, см. model_export.py
+        self.traced_bert = None
+        self.traced_head = None
+        # Желаемое число потоков torch для вычислений, None - оставить общую настройку. Число потоков - настройка
+        # всего процесса, поэтому она применяется один раз при загрузке, см. BotCore.load
+        self.num_threads = num_threads
+        # Кэш признаков фактов БЗ пополняется из разных потоков по очереди, чтобы факты не считались дважды
+        self.lock = threading.RLock()
 
         if self.arch == 1:
             self.norm = torch.nn.BatchNorm1d(num_features=sent_emb_size)
@@ -57,19 +96,63 @@ class RubertRelevancyDetector0(nn.Module):
         self.eval()
         return
 
+    def calc_head_hash(self):
+        return calc_module_hash(self, self.head_modules[self.arch])
+
     def forward_0(self, b1, b2):
         """b1 и b2 это результат инференса в rubert"""
+        if self.traced_head is not None:
+            return self.traced_head(b1, b2)
+
+        v1 = self.premise_features(b1)
+        v2 = self.query_features(b2)
+        return self.merge_features(v1, v2)
+
+    def premise_features(self, b1):
+        """Признаки, которые голова классификатора вычисляет только по предпосылке - их можно кэшировать"""
+        if self.traced_head is not None:
+            return self.traced_head.premise_features(b1)
 
         if self.arch == 1:
             w1 = b1.sum(dim=-2)
+            return self.norm(w1)
+        elif self.arch == 2:
+            out1, (hidden1, cell1) = self.rnn1(b1)
+            return out1[:, -1, :]
+        elif self.arch == 3:
+            z1 = b1.transpose(1, 2).contiguous()
+            v1 = self.conv1(z1)
+            return torch.relu(v1).transpose(1, 2).contiguous()
+        else:
+            raise NotImplementedError()
+
+    def query_features(self, b2):
+        """Признаки, которые голова классификатора вычисляет только по вопросу"""
+        if self.traced_head is not None:
+            return self.traced_head.query_features(b2)
+
+        if self.arch == 1:
             w2 = b2.sum(dim=-2)
+            return self.norm(w2)
+        elif self.arch == 2:
+            out2, (hidden2, cell2) = self.rnn2(b2)
+            return out2[:, -1, :]
+        elif self.arch == 3:
+            z2 = b2.transpose(1, 2).contiguous()
+            v2 = self.conv2(z2)
+            return torch.relu(v2).transpose(1, 2).contiguous()
+        else:
+            raise NotImplementedError()
 
-            z1 = self.norm(w1)
-            z2 = self.norm(w2)
+    def merge_features(self, v1, v2):
+        """Финальная часть головы классификатора, объединяющая признаки предпосылки и вопроса"""
+        if self.traced_head is not None:
+            return self.traced_head.merge_features(v1, v2)
 
+        if self.arch == 1:
             #merged = torch.cat((z1, z2, torch.abs(z1 - z2)), dim=-1)
             #merged = torch.cat((z1, z2, torch.abs(z1 - z2), z1 * z2), dim=-1)
-            merged = torch.cat((z1, z2), dim=-1)
+            merged = torch.cat((v1, v2), dim=-1)
 
             merged = self.fc1(merged)
             merged = torch.relu(merged)
@@ -77,12 +160,6 @@ class RubertRelevancyDetector0(nn.Module):
             output = torch.sigmoid(merged)
 
         elif self.arch == 2:
-            out1, (hidden1, cell1) = self.rnn1(b1)
-            v1 = out1[:, -1, :]
-
-            out2, (hidden2, cell2) = self.rnn2(b2)
-            v2 = out2[:, -1, :]
-
             v_sub = torch.sub(v1, v2)
             v_mul = torch.mul(v1, v2)
 
@@ -94,15 +171,6 @@ class RubertRelevancyDetector0(nn.Module):
             output = torch.sigmoid(merged)
 
         elif self.arch == 3:
-            z1 = b1.transpose(1, 2).contiguous()
-            z2 = b2.transpose(1, 2).contiguous()
-
-            v1 = self.conv1(z1)
-            v1 = torch.relu(v1).transpose(1, 2).contiguous()
-
-            v2 = self.conv2(z2)
-            v2 = torch.relu(v2).transpose(1, 2).contiguous()
-
             v_sub = torch.sub(v1, v2)
             v_mul = torch.mul(v1, v2)
 
@@ -116,6 +184,23 @@ class RubertRelevancyDetector0(nn.Module):
 
         return output
 
+    def get_most_relevant_broadcast(self, query, premises, nb_results=1):
+        """Вопрос прогоняется через rubert один раз, его эмбеддинги размножаются на все предпосылки в батче"""
+        query_tokens = self.encode_texts([query])[0]
+        premises_tokens = self.encode_texts([premise for premise, _, _ in premises])
+
+        res = []
+        with torch.no_grad():
+            b2 = self.run_bert(self.pad_batch([query_tokens]))
+            for batch_indeces in self.split_batches(premises_tokens, batch_size=100):
+                b1 = self.run_bert(self.pad_batch([premises_tokens[j] for j in batch_indeces]))
+
+                y = self.forward_0(b1, b2.expand(len(batch_indeces), -1, -1)).view(-1)
+                res.extend((premises[j][0], yi) for (j, yi) in zip(batch_indeces, y.tolist()))
+
+        res = sorted(res, key=lambda z: -z[1])[:nb_results]
+        return [x[0] for x in res], [x[1] for x in res]
+
     def pad_tokens(self, tokens):
         l = len(tokens)
         if l < self.max_len:
@@ -128,15 +213,74 @@ class RubertRelevancyDetector0(nn.Module):
 
 class RubertRelevancyDetector(RubertRelevancyDetector0):
     """Вариант с внутренним вызовом rubert"""
-    def __init__(self, device, arch, max_len, sent_emb_size):
-        super(RubertRelevancyDetector, self).__init__(device, arch, max_len, sent_emb_size)
+    def __init__(self, device, arch, max_len, sent_emb_size, num_threads=None):
+        super(RubertRelevancyDetector, self).__init__(device, arch, max_len, sent_emb_size, num_threads)
         self.bert_tokenizer = None
         self.bert_model = None
+        self.premises_cache = None
+        # Общий для всех детекторов кэш скоров пар (запрос, факт), см. pair_scores_cache.py
+        self.pair_scores_cache = None
+        # Ключ модели в кэше скоров пар, после загрузки весов уточняется в set_model_id
+        self.model_id = 'relevancy'
+        self.prefilter = TrigramPrefilter()
+
+    def set_model_id(self, bert_hash, head_hash):
+        """Скоры в общем кэше скоров пар привязываем к весам, чтобы скоры других весов не использовались"""
+        self.model_id = 'relevancy.{}.{}'.format(bert_hash[:12], head_hash[:12])
+
+    def create_premises_cache(self, bert_hash=None, head_hash=None):
+        """
+        Создаем пустой кэш признаков фактов, привязанный к текущим весам rubert и классификатора.
+        Для экспортированных в TorchScript моделей хэши вычисляются по файлам и передаются явно.
+        """
+        if bert_hash is None:
+            bert_hash = calc_module_hash(self.bert_model)
+        if head_hash is None:
+            head_hash = self.calc_head_hash()
+        self.premises_cache = PremiseFeaturesCache(bert_hash, head_hash)
+        return self.premises_cache
+
+    @synchronized
+    def update_premises_cache(self, premise_texts):
+        """
+        Вычисляем и запоминаем признаки для фактов, которых еще нет в кэше. Вызывается только для фактов БЗ
+        при подготовке профиля, новые факты сессий и временные предпосылки хода в кэш не попадают.
+        """
+        if self.premises_cache is None:
+            return
+
+        missing = self.premises_cache.get_missing(premise_texts)
+        for text, features in zip(missing, self.calc_premise_features(missing)):
+            self.premises_cache.add(text, features)
+
+    def calc_premise_features(self, premise_texts):
+        """Прогоняем предпосылки через rubert и премисную ветку классификатора, признаки возвращаются на cpu"""
+        res = [None] * len(premise_texts)
+        if not premise_texts:
+            return res
+
+        with torch.no_grad():
+            bert_tokens = self.encode_texts(premise_texts)
+            for batch_indeces in self.split_batches(bert_tokens, batch_size=100):
+                v1 = self.premise_features(self.run_bert(self.pad_batch([bert_tokens[i] for i in batch_indeces])))
+                for i, features in zip(batch_indeces, v1):
+                    res[i] = features.cpu()
+
+        return res
+
+    def get_premise_features(self, premise_texts):
+        """
+        Признаки предпосылок: для фактов БЗ берутся из кэша, признаки прочих предпосылок вычисляются
+        на лету и не запоминаются. Возвращается функция, собирающая тензор признаков для части текстов.
+        """
+        missing = self.premises_cache.get_missing(premise_texts)
+        text2features = dict(zip(missing, self.calc_premise_features(missing)))
+        return lambda texts: self.premises_cache.stack_features(texts, self.device, text2features)
 
     def forward(self, x1, x2):
         with torch.no_grad():
-            b1 = self.bert_model(x1)[0]
-            b2 = self.bert_model(x2)[0]
+            b1 = self.run_bert(x1)
+            b2 = self.run_bert(x2)
 
         return self.forward_0(b1, b2)
 
@@ -150,27 +294,120 @@ class RubertRelevancyDetector(RubertRelevancyDetector0):
         y = self.forward(z1, z2)[0].item()
         return y
 
-    def get_most_relevant(self, query, premises, text_utils, nb_results=1):
-        query_t1 = self.pad_tokens(self.bert_tokenizer.encode(query))
+    def get_most_relevant(self, query, premises, text_utils, nb_results=1, nb_candidates=None):
+        """
+        Поиск наиболее релевантных вопросу query фактов среди premises.
+        Если задано nb_candidates, то нейросетью оцениваются только nb_candidates фактов, лексически
+        наиболее похожих на вопрос.
+        """
+        if nb_candidates:
+            premises = self.prefilter.select_candidates(query, premises, nb_candidates)
+
+        if self.pair_scores_cache is None:
+            return self.calc_most_relevant(query, premises, nb_results)
+
+        # Скоры пар, уже вычисленные в этом или других диалогах, берем из общего кэша.
+        premise_texts = [premise for premise, _, _ in premises]
+        rels = self.pair_scores_cache.get_scores(self.model_id, query, premise_texts)
+        missing = [premises[i] for i, rel in enumerate(rels) if rel is None]
+        if missing:
+            texts, missing_rels = self.calc_most_relevant(query, missing, nb_results=len(missing))
+            self.pair_scores_cache.put_scores(self.model_id, query, texts, missing_rels)
+            text2rel = dict(zip(texts, missing_rels))
+            rels = [(text2rel[text] if rel is None else rel) for text, rel in zip(premise_texts, rels)]
+
+        res = sorted(zip(premise_texts, rels), key=lambda z: -z[1])[:nb_results]
+        return [x[0] for x in res], [x[1] for x in res]
 
-        res = []
+    def calc_most_relevant(self, query, premises, nb_results):
+        if self.premises_cache is not None:
+            return self.get_most_relevant_cached(query, premises, nb_results)
+
+        return self.get_most_relevant_broadcast(query, premises, nb_results)
+
+    def calc_prefilter_recall(self, queries, premises, nb_candidates, nb_results=1):
+        """
+        Оценка качества лексического отбора кандидатов: доля фактов из top-nb_results полного перебора,
+        которые попадают и в top-nb_results после отбора nb_candidates кандидатов.
+        """
+        nb_hits = 0
+        nb_total = 0
+        for query in queries:
+            full_premises, _ = self.get_most_relevant(query, premises, None, nb_results=nb_results)
+            prefiltered_premises, _ = self.get_most_relevant(query, premises, None, nb_results=nb_results, nb_candidates=nb_candidates)
+            nb_hits += len(set(full_premises) & set(prefiltered_premises))
+            nb_total += len(full_premises)
+
+        return nb_hits / float(max(1, nb_total))
+
+    def score_matrix(self, queries, premises):
+        """
+        Релевантность всех пар (вопрос, предпосылка) за один проход. Возвращается список строк скоров:
+        строка для каждого вопроса из queries, в строке скоры в порядке premises.
+        """
+        if not queries:
+            return []
+
+        if self.pair_scores_cache is None:
+            return self.calc_score_matrix(queries, premises)
+
+        premise_texts = [premise for premise, _, _ in premises]
+        rows = [self.pair_scores_cache.get_scores(self.model_id, query, premise_texts) for query in queries]
+
+        # Пересчитываем только те вопросы и предпосылки, для которых в кэше нашлись не все скоры.
+        missing_queries = [i for i, row in enumerate(rows) if None in row]
+        if missing_queries:
+            missing_premises = [j for j in range(len(premises)) if any(rows[i][j] is None for i in missing_queries)]
+            missing_rows = self.calc_score_matrix([queries[i] for i in missing_queries], [premises[j] for j in missing_premises])
+            for i, missing_row in zip(missing_queries, missing_rows):
+                self.pair_scores_cache.put_scores(self.model_id, queries[i], [premise_texts[j] for j in missing_premises], missing_row)
+                for j, rel in zip(missing_premises, missing_row):
+                    rows[i][j] = rel
+
+        return rows
+
+    def calc_score_matrix(self, queries, premises):
+        if self.premises_cache is None:
+            rows = []
+            for query in queries:
+                texts, rels = self.get_most_relevant_broadcast(query, premises, nb_results=len(premises))
+                text2rel = dict(zip(texts, rels))
+                rows.append([text2rel[premise] for premise, _, _ in premises])
+            return rows
+
+        premise_texts = [premise for premise, _, _ in premises]
+        stack_features = self.get_premise_features(premise_texts)
+
+        queries_tokens = self.encode_texts(queries)
+        rows = [None] * len(queries)
+        with torch.no_grad():
+            v1 = stack_features(premise_texts)
+            for batch_indeces in self.split_batches(queries_tokens, batch_size=100):
+                v2 = self.query_features(self.run_bert(self.pad_batch([queries_tokens[i] for i in batch_indeces])))
+                for i, v2i in zip(batch_indeces, v2):
+                    y = self.merge_features(v1, v2i.unsqueeze(0).expand((len(premise_texts),) + v2i.shape)).view(-1)
+                    rows[i] = y.tolist()
+
+        return rows
+
+    def get_most_relevant_cached(self, query, premises, nb_results=1):
+        """Через rubert прогоняется только вопрос, признаки предпосылок берутся из кэша"""
+        premise_texts = [premise for premise, _, _ in premises]
+        stack_features = self.get_premise_features(premise_texts)
 
-        batch_size = 100
-        while premises:
-            premises_batch = premises[:batch_size]
-            premises = premises[batch_size:]
-            premises_tx = [self.pad_tokens(self.bert_tokenizer.encode(premise)) for premise, _, _ in premises_batch]
-            query_tx = [query_t1 for _ in range(len(premises_batch))]
+        z2 = self.pad_batch(self.encode_texts([query]))
 
-            z1 = torch.tensor(premises_tx).to(self.device)
-            z2 = torch.tensor(query_tx).to(self.device)
+        res = []
+        with torch.no_grad():
+            b2 = self.run_bert(z2)
+            v2 = self.query_features(b2)
 
-            y = self.forward(z1, z2).squeeze()
-            if len(y.shape) == 0:
-                res.append((premises_batch[0][0], y.item()))
-            else:
-                delta = [(premise[0], yi.item()) for (premise, yi) in zip(premises_batch, y)]
-                res.extend(delta)
+            batch_size = 1000
+            for i in range(0, len(premise_texts), batch_size):
+                texts_batch = premise_texts[i: i+batch_size]
+                v1 = stack_features(texts_batch)
+                y = self.merge_features(v1, v2.expand((len(texts_batch),) + v2.shape[1:])).view(-1)
+                res.extend(zip(texts_batch, y.tolist()))
 
         res = sorted(res, key=lambda z: -z[1])[:nb_results]
         return [x[0] for x in res], [x[1] for x in res]
@@ -178,8 +415,8 @@ class RubertRelevancyDetector(RubertRelevancyDetector0):
 
 class RubertRelevancyDetector_2(RubertRelevancyDetector0):
     """Вариант с внешним вызовом rubert"""
-    def __init__(self, device, arch, max_len, sent_emb_size):
-        super(RubertRelevancyDetector_2, self).__init__(device, arch, max_len, sent_emb_size)
+    def __init__(self, device, arch, max_len, sent_emb_size, num_threads=None):
+        super(RubertRelevancyDetector_2, self).__init__(device, arch, max_len, sent_emb_size, num_threads)
 
     def forward(self, b1, b2):
         return self.forward_0(b1, b2)
@@ -199,30 +436,4 @@ class RubertRelevancyDetector_2(RubertRelevancyDetector0):
         return y
 
     def get_most_relevant(self, query, premises, text_utils, nb_results=1):
-        query_t1 = self.pad_tokens(self.bert_tokenizer.encode(query))
-
-        res = []
-
-        batch_size = 100
-        while premises:
-            premises_batch = premises[:batch_size]
-            premises = premises[batch_size:]
-            premises_tx = [self.pad_tokens(self.bert_tokenizer.encode(premise)) for premise, _, _ in premises_batch]
-            query_tx = [query_t1 for _ in range(len(premises_batch))]
-
-            z1 = torch.tensor(premises_tx).to(self.device)
-            z2 = torch.tensor(query_tx).to(self.device)
-
-            with torch.no_grad():
-                b1 = self.bert_model(z1)[0]
-                b2 = self.bert_model(z2)[0]
-
-            y = self.forward(b1, b2).squeeze()
-            if len(y.shape) == 0:
-                res.append((premises_batch[0][0], y.item()))
-            else:
-                delta = [(premise[0], yi.item()) for (premise, yi) in zip(premises_batch, y)]
-                res.extend(delta)
-
-        res = sorted(res, key=lambda z: -z[1])[:nb_results]
-        return [x[0] for x in res], [x[1] for x in res]
+        return self.get_most_relevant_broadcast(query, premises, nb_results)
@@ -3,17 +3,38 @@
 Используется rugpt (веса не меняются) и добавочные слои для классификатора.
 
 13.03.2022 Скорректирован код обучения, чтобы веса rubert не участвовали в градиентном спуске
+18.10.2026 В get_most_similar проверяемая фраза прогоняется через rubert один раз на весь поиск
+18.10.2026 Опциональный предварительный отбор кандидатов по индексу векторов предложений (см. sentence_vectors_index.py)
+18.10.2026 Опциональный динамический паддинг с маской внимания и группировкой текстов по длине (dynamic_padding в .cfg)
+18.10.2026 Токены фактов могут браться из заранее заполненного хранилища BertTokensStore
+18.10.2026 Поддержка экспортированных в TorchScript rubert и головы классификатора, настройка числа потоков
+18.10.2026 Скоры пар фраз могут браться из общего для всех сессий кэша PairScoresCache
+18.10.2026 Поиск из разных потоков выполняется по очереди под self.lock
+18.10.2026 Поиск не держит self.lock: общие индексы и кэши защищены своими блокировками, прогоны rubert идут параллельно
+18.10.2026 Подготовка батчей и прогон через rubert вынесены в общий с детектором релевантности RubertBatchingMixin
+18.10.2026 Динамический паддинг убран, так как голова классификатора обучена на паддинге до max_len без маски внимания
+18.10.2026 Ключ модели в кэше скоров пар привязан к хэшам весов rubert и головы классификатора (set_model_id)
+18.10.2026 Фразы, которых нет в индексе векторов (факты сессии), больше не добавляются в него при поиске
 """
 
 import collections
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.utils.data
 
+from ruchatbot.bot.premise_features_cache import calc_module_hash
+from ruchatbot.utils.rubert_batching import RubertBatchingMixin
 
-class RubertSynonymyDetector(nn.Module):
-    def __init__(self, device, arch, max_len, sent_emb_size):
+
+class RubertSynonymyDetector(RubertBatchingMixin, nn.Module):
+    # Подмодули головы классификатора для каждой архитектуры, см. calc_head_hash
+    head_modules = {1: ['fc1', 'fc2'],
+                    2: ['rnn', 'fc1', 'fc2'],
+                    3: ['conv1', 'conv2', 'fc1']}
+
+    def __init__(self, device, arch, max_len, sent_emb_size, num_threads=None):
         super(RubertSynonymyDetector, self).__init__()
         self.max_len = max_len
         self.arch = arch
@@ -37,6 +58,26 @@ class RubertSynonymyDetector(nn.Module):
         self.device = device
         self.to(device)
 
+        self.vectors_index = None
+        # Общий для всех детекторов кэш скоров пар (запрос, факт), см. pair_scores_cache.py
+        self.pair_scores_cache = None
+        # Ключ модели в кэше скоров пар, после загрузки весов уточняется в set_model_id
+        self.model_id = 'synonymy'
+        self.tokens_store = None
+        # Экспортированные в TorchScript rubert и голова классификатора, см. model_export.py
+        self.traced_bert = None
+        self.traced_head = None
+        # Желаемое число потоков torch для вычислений, None - оставить общую настройку. Число потоков - настройка
+        # всего процесса, поэтому она применяется один раз при загрузке, см. BotCore.load
+        self.num_threads = num_threads
+
+    def calc_head_hash(self):
+        return calc_module_hash(self, self.head_modules[self.arch])
+
+    def set_model_id(self, bert_hash, head_hash):
+        """Скоры в общем кэше скоров пар привязываем к весам, чтобы скоры других весов не использовались"""
+        self.model_id = 'synonymy.{}.{}'.format(bert_hash[:12], head_hash[:12])
+
     def save_weights(self, weights_path):
         # !!! Не сохраняем веса rubert, так как они не меняются при обучении и одна и та же rubert используется
         # несколькими моделями !!!
@@ -50,8 +91,15 @@ class RubertSynonymyDetector(nn.Module):
 
     def forward(self, x1, x2):
         with torch.no_grad():
-            b1 = self.bert_model(x1)[0]
-            b2 = self.bert_model(x2)[0]
+            b1 = self.run_bert(x1)
+            b2 = self.run_bert(x2)
+
+        return self.forward_0(b1, b2)
+
+    def forward_0(self, b1, b2):
+        """b1 и b2 это результат инференса в rubert"""
+        if self.traced_head is not None:
+            return self.traced_head(b1, b2)
 
         if self.arch == 1:
             w1 = b1.sum(dim=-2)
@@ -126,29 +174,74 @@ class RubertSynonymyDetector(nn.Module):
         y = self.forward(z1, z2)[0].item()
         return y
 
-    def get_most_similar(self, probe_phrase, phrases, text_utils, nb_results=1):
-        tokens1 = self.pad_tokens(self.bert_tokenizer.encode(probe_phrase))
-
-        phrases2 = list(phrases)
-        sims = []
-        batch_size = 100
-        while phrases2:
-            bs = min(batch_size, len(phrases2))
-            batch_phrases = phrases2[:bs]
-            phrases2 = phrases2[bs:]
+    def pool_bert_outputs(self, b, lengths):
+        """Векторы предложений для индекса кандидатов: усреднение выходов rubert по токенам текста без паддинга"""
+        return np.stack([bi[:max(1, min(l, bi.shape[0]))].mean(dim=0).cpu().numpy() for bi, l in zip(b, lengths)])
+
+    def calc_sentence_vectors(self, texts):
+        """Векторы предложений для texts, возвращается словарь текст => вектор"""
+        text2vector = dict()
+        texts = list(texts)
+        tokens = self.encode_texts(texts)
+        for batch_indeces in self.split_batches(tokens, batch_size=100):
+            tokens_batch = [tokens[i] for i in batch_indeces]
+            with torch.no_grad():
+                b = self.run_bert(self.pad_batch(tokens_batch))
+            vectors = self.pool_bert_outputs(b, [len(t) for t in tokens_batch])
+            text2vector.update(zip([texts[i] for i in batch_indeces], vectors))
+        return text2vector
+
+    def update_vectors_index(self, texts):
+        """Добавляем в индекс векторы для текстов, которых там еще нет. Вызывается для фактов БЗ профиля."""
+        text2vector = self.calc_sentence_vectors(text for text in set(texts) if text not in self.vectors_index)
+        if text2vector:
+            self.vectors_index.add(list(text2vector.keys()), np.stack(list(text2vector.values())))
+
+    def get_most_similar(self, probe_phrase, phrases, text_utils, nb_results=1, nb_candidates=None):
+        """
+        Поиск среди phrases наиболее близких по смыслу к probe_phrase.
+        Если задано nb_candidates и подключен индекс векторов предложений, то классификатором
+        проверяются только nb_candidates ближайших по векторам фраз.
+        """
+        # Проверяемая фраза прогоняется через rubert один раз, и только если ее эмбеддинги понадобятся,
+        # они размножаются на весь батч.
+        tokens1 = self.encode_texts([probe_phrase])[0]
+        probe_embeddings = []
+
+        def encode_probe():
+            if not probe_embeddings:
+                probe_embeddings.append(self.run_bert(self.pad_batch([tokens1])))
+            return probe_embeddings[0]
 
-            tx1 = [tokens1 for _ in range(bs)]
-            tx2 = [self.pad_tokens(self.bert_tokenizer.encode(s[0])) for s in batch_phrases]
-
-            z1 = torch.tensor(tx1).to(self.device)
-            z2 = torch.tensor(tx2).to(self.device)
-            yx = self.forward(z1, z2)
-            batch_y = [y.item() for y in yx]
-            sims.extend(batch_y)
+        with torch.no_grad():
+            if nb_candidates and self.vectors_index is not None and len(phrases) > nb_candidates:
+                phrase_texts = [s[0] for s in phrases]
+                # В индексе лежат только факты БЗ профиля (см. BotCore.warmup_facts_cache), векторы прочих фраз,
+                # например новых фактов сессии, вычисляются на лету и в общий индекс не добавляются.
+                extra_vectors = self.calc_sentence_vectors(text for text in set(phrase_texts) if text not in self.vectors_index)
+                query_vector = self.pool_bert_outputs(encode_probe(), [len(tokens1)])[0]
+                candidates = set(self.vectors_index.search(query_vector, phrase_texts, nb_candidates, extra_vectors))
+                phrases = [s for s in phrases if s[0] in candidates]
+
+            # Скоры пар, уже вычисленные в этом или других диалогах, берем из общего кэша.
+            phrase_texts = [s[0] for s in phrases]
+            if self.pair_scores_cache is not None:
+                sims = self.pair_scores_cache.get_scores(self.model_id, probe_phrase, phrase_texts)
+            else:
+                sims = [None] * len(phrases)
+            missing = [i for i, sim in enumerate(sims) if sim is None]
+
+            phrases_tokens = self.encode_texts([phrase_texts[i] for i in missing])
+            for batch_indeces in self.split_batches(phrases_tokens, batch_size=100):
+                b1 = encode_probe()
+                b2 = self.run_bert(self.pad_batch([phrases_tokens[i] for i in batch_indeces]))
+                yx = self.forward_0(b1.expand(len(batch_indeces), -1, -1), b2)
+                for i, y in zip(batch_indeces, yx.view(-1).tolist()):
+                    sims[missing[i]] = y
+
+            if self.pair_scores_cache is not None and missing:
+                self.pair_scores_cache.put_scores(self.model_id, probe_phrase, [phrase_texts[i] for i in missing], [sims[i] for i in missing])
 
         phrase_wx = list(zip(phrases, sims))
         phrase_wx = sorted(phrase_wx, key=lambda z: -z[1])[:nb_results]
         return [s[0] for s, sim in phrase_wx], [sim for s, sim in phrase_wx]
-
-
-
@@ -1,7 +1,258 @@
+"""
+Базовый класс для генеративных моделей на базе rugpt.
+
+18.10.2026 Генерация для нескольких промптов одним батчем (generate_batch) с паддингом слева и маской внимания
+18.10.2026 KV-кэш общих префиксов промптов (PrefixCache) в пределах одного хода диалога
+18.10.2026 Кэш префиксов включается со счетчиком ссылок, чтобы параллельные ходы диалога не выключали его друг у друга
+18.10.2026 Кэш префиксов используется и при генерации через model.generate, его размер растет с числом параллельных ходов
+18.10.2026 Режим остановки генерации на первом переводе строки или </s> (stop_at_newline)
+18.10.2026 Облегченный декодер LeanDecoder с заранее выделенным KV-кэшем и совмещенным top-k/top-p сэмплированием.
+           Сравнение скорости с model.generate: python rugpt_base.py --model ../../tmp/rugpt_chitchat
+18.10.2026 LeanDecoder включается только явно (lean_decoding) и не зависит от кэша префиксов
+18.10.2026 Спекулятивное декодирование с черновой моделью (load_draft_model, sample_speculative)
+18.10.2026 Генерация из разных потоков выполняется по очереди под self.lock
+18.10.2026 Под self.lock остаются только LeanDecoder и черновая модель с их общими буферами, у кэша префиксов
+           своя блокировка, а прогоны model.generate и оценки из разных потоков выполняются параллельно
+"""
+
+import collections
+import threading
+
 import torch
+import torch.nn.functional as F
 import transformers
 from transformers import GPT2LMHeadModel, GPT2Tokenizer
 
+from ruchatbot.utils.torch_helpers import synchronized
+
+
+def normalize_past(past):
+    # Новые версии transformers возвращают объект Cache, приводим его к кортежу тензоров по слоям.
+    if hasattr(past, 'to_legacy_cache'):
+        return past.to_legacy_cache()
+    return past
+
+
+def map_past(past, fn):
+    if isinstance(past, torch.Tensor):
+        return fn(past)
+    return tuple(map_past(x, fn) for x in past)
+
+
+def crop_past(past, seq_len):
+    """Оставляем в past_key_values только первые seq_len позиций"""
+    return map_past(past, lambda t: t[..., :seq_len, :])
+
+
+def expand_past(past, batch_size):
+    """Размножаем past_key_values, вычисленные для одной последовательности, на batch_size строк"""
+    def expand(t):
+        # Тензоры ключей и значений имеют форму [..., batch, heads, seq_len, head_dim]
+        sizes = list(t.shape)
+        sizes[t.dim() - 4] = batch_size
+        return t.expand(*sizes)
+    return map_past(past, expand)
+
+
+def common_prefix_len(sequences):
+    if not sequences:
+        return 0
+    n = min(len(seq) for seq in sequences)
+    first = sequences[0]
+    for seq in sequences[1:]:
+        i = 0
+        while i < n and seq[i] == first[i]:
+            i += 1
+        n = i
+    return n
+
+
+def sample_next_tokens(logits, temperature, top_k, top_p):
+    """
+    Сэмплирование очередных токенов по логитам последней позиции с той же семантикой, что в model.generate:
+    temperature, затем top-k, затем top-p. Все три шага совмещены: одна операция topk вместо сортировки
+    всего словаря, softmax и отсечение top-p делаются только по k отобранным значениям.
+    """
+    if top_k > 0:
+        values, indices = torch.topk(logits, min(top_k, logits.shape[-1]))
+    else:
+        values, indices = torch.sort(logits, descending=True)
+
+    if temperature != 1.0:
+        values = values / temperature
+
+    probs = F.softmax(values, dim=-1)
+    if top_p < 1.0:
+        # Токен, на котором накопленная вероятность превышает top_p, остается в выборке
+        probs = probs.masked_fill(probs.cumsum(dim=-1) - probs > top_p, 0.0)
+
+    choice = torch.multinomial(probs, num_samples=1)
+    return indices.gather(-1, choice).squeeze(-1)
+
+
+def warp_probs(logits, temperature, top_k, top_p):
+    """
+    Распределение, из которого sample_next_tokens выбирает токены: вероятности после temperature, top-k и top-p,
+    развернутые на весь словарь. Нужно для проверки черновых токенов при спекулятивном декодировании.
+    """
+    if top_k > 0:
+        values, indices = torch.topk(logits, min(top_k, logits.shape[-1]))
+    else:
+        values, indices = torch.sort(logits, descending=True)
+
+    if temperature != 1.0:
+        values = values / temperature
+
+    probs = F.softmax(values, dim=-1)
+    if top_p < 1.0:
+        probs = probs.masked_fill(probs.cumsum(dim=-1) - probs > top_p, 0.0)
+        probs = probs / probs.sum(dim=-1, keepdim=True)
+
+    return torch.zeros_like(logits).scatter(-1, indices, probs)
+
+
+class StopTokensCriteria(transformers.StoppingCriteria):
+    """
+    Критерий остановки для model.generate: каждая последовательность считается законченной, как только
+    в ней появился один из стоп-токенов, генерация прекращается, когда закончены все последовательности.
+    """
+    def __init__(self, stop_tokens_mask):
+        super(StopTokensCriteria, self).__init__()
+        self.stop_tokens_mask = stop_tokens_mask
+        self.finished = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        is_stop = self.stop_tokens_mask[input_ids[:, -1]]
+        self.finished = is_stop if self.finished is None else (self.finished | is_stop)
+        return bool(self.finished.all())
+
+
+class LeanDecoder(object):
+    """
+    Облегченный декодер для сэмплирования небольших батчей на CPU. Повторяет вычисления GPT2Model на весах
+    загруженной модели, но:
+    1) ключи и значения внимания пишутся в заранее выделенные буферы, без конкатенации на каждом шаге;
+    2) финальная нормализация и lm_head считаются только для последней позиции;
+    3) нет логит-процессоров и проверок параметров генерации на каждом шаге.
+    Поддерживается только стандартное внимание GPT2, модели с другими вариантами внимания отвергаются при создании декодера.
+    """
+    def __init__(self, model):
+        config = model.config
+        unsupported = [flag for flag, value in [('scale_attn_by_inverse_layer_idx', True), ('reorder_and_upcast_attn', True),
+                                                ('add_cross_attention', True), ('scale_attn_weights', False)]
+                       if getattr(config, flag, not value) == value]
+        if unsupported:
+            raise ValueError('LeanDecoder does not support GPT2 config flags: {}'.format(', '.join(unsupported)))
+
+        self.model = model
+        self.nb_heads = config.n_head
+        self.embed_dim = config.n_embd
+        self.head_dim = config.n_embd // config.n_head
+        self.keys = None
+        self.values = None
+
+    def allocate(self, batch_size, max_len):
+        """Буферы переиспользуются между вызовами, пока их размера хватает"""
+        if self.keys is None or self.keys.shape[1] < batch_size or self.keys.shape[3] < max_len:
+            param = next(self.model.parameters())
+            shape = (len(self.model.transformer.h), batch_size, self.nb_heads, max_len, self.head_dim)
+            self.keys = torch.empty(shape, dtype=param.dtype, device=param.device)
+            self.values = torch.empty(shape, dtype=param.dtype, device=param.device)
+
+    def load_past(self, past, batch_size):
+        """Копируем в буферы past_key_values префикса, вычисленные для одной последовательности"""
+        for ilayer, layer_past in enumerate(past):
+            seq_len = layer_past[0].shape[-2]
+            self.keys[ilayer, :batch_size, :, :seq_len] = layer_past[0]
+            self.values[ilayer, :batch_size, :, :seq_len] = layer_past[1]
+
+    def split_heads(self, x):
+        return x.view(x.shape[0], x.shape[1], self.nb_heads, self.head_dim).transpose(1, 2)
+
+    def forward(self, input_ids, position_ids, attention_mask, start, all_logits=False):
+        """
+        Прогон токенов input_ids [batch, n], занимающих позиции start..start+n в буферах.
+        Возвращает логиты для последней позиции, а при all_logits=True - для всех n позиций.
+        Содержимое буферов после позиции start+n не используется, поэтому откат кэша сводится к выбору start.
+        """
+        transformer = self.model.transformer
+        batch_size, n = input_ids.shape
+        end = start + n
+
+        # Причинная маска вместе с маской паддинга: [batch, 1, n, end]
+        causal_mask = torch.ones((n, end), dtype=torch.bool, device=input_ids.device).tril(diagonal=start)
+        mask = causal_mask.unsqueeze(0).unsqueeze(0) & attention_mask[:, None, None, :end].bool()
+
+        h = transformer.wte(input_ids) + transformer.wpe(position_ids)
+        for ilayer, block in enumerate(transformer.h):
+            x = block.ln_1(h)
+            q, k, v = block.attn.c_attn(x).split(self.embed_dim, dim=2)
+            self.keys[ilayer, :batch_size, :, start:end] = self.split_heads(k)
+            self.values[ilayer, :batch_size, :, start:end] = self.split_heads(v)
+            keys = self.keys[ilayer, :batch_size, :, :end]
+            values = self.values[ilayer, :batch_size, :, :end]
+
+            scores = torch.matmul(self.split_heads(q), keys.transpose(-1, -2)) / (self.head_dim ** 0.5)
+            scores = scores.masked_fill(~mask, torch.finfo(scores.dtype).min)
+            a = torch.matmul(F.softmax(scores, dim=-1), values)
+            a = a.transpose(1, 2).reshape(batch_size, n, self.embed_dim)
+            h = h + block.attn.c_proj(a)
+            h = h + block.mlp(block.ln_2(h))
+
+        if all_logits:
+            return self.model.lm_head(transformer.ln_f(h))
+        return self.model.lm_head(transformer.ln_f(h[:, -1]))
+
+
+class PrefixCache(object):
+    """
+    KV-кэш для префиксов промптов. Для каждого префикса хранятся past_key_values и логарифмы вероятностей
+    его токенов. Префикс может использоваться частично: past_key_values обрезаются до длины общей части.
+    """
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  # кортеж токенов => (past_key_values, logprobs)
+        # Кэшем пользуются генерации из разных потоков, записи тензоров не меняются, так что блокировка
+        # нужна только на время поиска и изменения словаря.
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def find(self, tokens):
+        """Ищем запись с самой длинной общей с tokens начальной частью, возвращаем (длина общей части, past, logprobs)"""
+        with self.lock:
+            best_len, best_key = 0, None
+            for key in self.entries:
+                n = common_prefix_len([key, tokens])
+                if n > best_len:
+                    best_len, best_key = n, key
+
+            if best_key is None:
+                return 0, None, []
+
+            self.entries.move_to_end(best_key)
+            past, logprobs = self.entries[best_key]
+            return best_len, past, logprobs
+
+    def add(self, tokens, past, logprobs):
+        key = tuple(tokens)
+        with self.lock:
+            self.entries[key] = (past, logprobs)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def resize(self, max_entries):
+        with self.lock:
+            self.max_entries = max_entries
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
 
 class RugptBase:
     def __init__(self):
@@ -10,51 +261,473 @@ class RugptBase:
         self.model = None
         self.beam_k = 10
         self.beam_p = 0.9
+        self.pad_token_id = 0
+        self.eos_token_id = None
+        self.newline_token_ids = []
+        self.eos_tokens_mask = None
+        self.newline_tokens_mask = None
+        self.prefix_cache = None
+        # Сколько ходов диалога сейчас используют кэш префиксов и сколько записей кэша приходится на один ход
+        self.prefix_cache_users = 0
+        self.prefix_cache_entries = 8
+        # Использовать облегченный декодер LeanDecoder вместо model.generate, по умолчанию выключено
+        self.lean_decoding = False
+        self.lean_decoder = None
+        # Черновая модель для спекулятивного декодирования, см. load_draft_model
+        self.draft_model = None
+        self.draft_decoder = None
+        self.speculative_k = 4
+        # Счетчик пользователей кэша префиксов и буферы LeanDecoder и черновой модели общие для всех потоков,
+        # они меняются только под этой блокировкой. Прогоны модели без общих буферов идут параллельно.
+        self.lock = threading.RLock()
 
     def load_from_path(self, model_path):
         self.tokenizer = GPT2Tokenizer.from_pretrained(model_path)
         self.tokenizer.add_special_tokens({'bos_token': '<s>', 'eos_token': '</s>', 'pad_token': '<pad>'})
+        self.eos_token_id = self.tokenizer.eos_token_id
         self.model = GPT2LMHeadModel.from_pretrained(model_path)
         self.model.to(self.device)
         self.model.eval()
 
+        # Токены, в которых есть перевод строки (в byte-level BPE он представлен символом Ċ).
+        vocab_size = self.model.config.vocab_size
+        self.newline_token_ids = sorted(token_id for token, token_id in self.tokenizer.get_vocab().items() if 'Ċ' in token and token_id < vocab_size)
+        self.eos_tokens_mask = torch.zeros(vocab_size, dtype=torch.bool, device=self.device)
+        if self.eos_token_id is not None and self.eos_token_id < vocab_size:
+            self.eos_tokens_mask[self.eos_token_id] = True
+        self.newline_tokens_mask = self.eos_tokens_mask.clone()
+        self.newline_tokens_mask[self.newline_token_ids] = True
+
+    def load_draft_model(self, model_path):
+        """
+        Загружаем маленькую черновую модель с тем же словарем (например, см. rugpt_draft_model.py).
+        После этого генерация выполняется спекулятивным декодированием.
+        """
+        self.draft_model = GPT2LMHeadModel.from_pretrained(model_path)
+        self.draft_model.to(self.device)
+        self.draft_model.eval()
+        self.draft_decoder = LeanDecoder(self.draft_model)
+
+    def get_stop_tokens_mask(self, stop_at_newline):
+        return self.newline_tokens_mask if stop_at_newline else self.eos_tokens_mask
+
+    @synchronized
+    def start_prefix_cache(self):
+        """
+        Включаем KV-кэш префиксов промптов. Вызывается в начале обработки реплики, когда все генерации
+        и оценки диалогов используют одну и ту же историю диалога.
+        Ходы разных сессий могут обрабатываться параллельно, поэтому кэш общий для всех начатых ходов
+        и живет, пока не закончится последний из них. Записи кэша привязаны к точным токенам префикса,
+        так что чужие записи не портят результаты. Чтобы сессии не вытесняли записи друг друга, размер кэша
+        равен prefix_cache_entries на каждый идущий ход.
+        """
+        if self.prefix_cache_users == 0:
+            self.prefix_cache = PrefixCache(self.prefix_cache_entries)
+        self.prefix_cache_users += 1
+        self.prefix_cache.resize(self.prefix_cache_entries * self.prefix_cache_users)
+
+    @synchronized
+    def clear_prefix_cache(self):
+        """Заканчиваем использование KV-кэша префиксов, последний ход выключает кэш и освобождает память"""
+        self.prefix_cache_users = max(0, self.prefix_cache_users - 1)
+        if self.prefix_cache_users == 0:
+            self.prefix_cache = None
+        else:
+            self.prefix_cache.resize(self.prefix_cache_entries * self.prefix_cache_users)
+
+    def encode_prefix(self, tokens):
+        """
+        Прогоняем через модель последовательность tokens, используя и пополняя кэш префиксов.
+        Возвращаем past_key_values для tokens, логарифмы вероятностей токенов tokens[1:] и логиты последней позиции.
+        """
+        # Кэш может выключить другой поток, закончивший свой ход, поэтому работаем с одной ссылкой на него.
+        prefix_cache = self.prefix_cache
+        n, past, logprobs = 0, None, []
+        if prefix_cache is not None:
+            n, past, logprobs = prefix_cache.find(tokens)
+
+        # Последний токен общей части прогоняем заново, чтобы получить логиты для предсказания следующего токена.
+        n = max(0, min(n, len(tokens)) - 1)
+        if n > 0:
+            past = crop_past(past, n)
+            logprobs = logprobs[:n]
+        else:
+            past, logprobs = None, []
+
+        input_ids = torch.tensor([tokens[n:]], dtype=torch.long, device=self.device)
+        with torch.no_grad():
+            outputs = self.model(input_ids, past_key_values=past, use_cache=True)
+        logits = outputs[0][0]
+        past = normalize_past(outputs[1])
+
+        new_logprobs = F.log_softmax(logits[:-1], dim=-1).gather(-1, input_ids[0, 1:].unsqueeze(-1)).view(-1)
+        logprobs = logprobs + new_logprobs.tolist()
+
+        if prefix_cache is not None:
+            prefix_cache.add(tokens, past, logprobs)
+
+        return past, logprobs, logits[-1]
+
     def generate_output_from_prompt(self, prompt_text, num_return_sequences, temperature=1.0):
-        repetition_penalty = 1.0
-        stop_token = "</s>"
+        return self.generate_batch([(prompt_text, num_return_sequences)], temperature=temperature)[0]
+
+    def generate_batch(self, prompts, temperature=1.0, stop_at_newline=False):
+        """
+        Генерация продолжений сразу для нескольких промптов одним батчем.
+        Промпты разной длины дополняются слева pad-токенами, которые закрываются маской внимания.
+        По умолчанию генерация делается через model.generate. Облегченный декодер LeanDecoder используется,
+        только если явно включен lean_decoding, а спекулятивное декодирование - если загружена черновая модель.
+        Генерация через model.generate не держит self.lock, декодеры с общими буферами работают под ней.
+
+        :param prompts: список пар (текст промпта, число генерируемых вариантов)
+        :param stop_at_newline: каждая последовательность заканчивается на первом переводе строки или </s>,
+                                возвращается только первая строка продолжения
+        :return: список списков уникальных продолжений, в порядке prompts
+        """
         length = 100
 
-        encoded_prompt = self.tokenizer.encode(prompt_text, add_special_tokens=False, return_tensors="pt")
-        encoded_prompt = encoded_prompt.to(self.device)
+        outputs = [[] for _ in prompts]
+
+        encoded_prompts = [self.tokenizer.encode(prompt_text, add_special_tokens=False) for prompt_text, _ in prompts]
+
+        # Каждый промпт повторяется столько раз, сколько вариантов для него надо сгенерировать.
+        rows = []
+        row2prompt = []
+        for iprompt, (encoded_prompt, (_, num_return_sequences)) in enumerate(zip(encoded_prompts, prompts)):
+            for _ in range(num_return_sequences):
+                rows.append(encoded_prompt)
+                row2prompt.append(iprompt)
+
+        if not row2prompt:
+            return outputs
+
+        if self.draft_model is not None:
+            with self.lock:
+                generated_sequences = self.sample_speculative(rows, length, temperature, stop_at_newline)
+        elif self.lean_decoding:
+            with self.lock:
+                generated_sequences = self.sample_lean(rows, length, temperature, stop_at_newline)
+        else:
+            generated_sequences = self.sample_with_generate(rows, length, temperature, stop_at_newline)
+
+        for iprompt, generated_sequence in zip(row2prompt, generated_sequences):
+            total_sequence = self.decode_generated(generated_sequence, stop_at_newline)
+            if total_sequence and total_sequence not in outputs[iprompt]:
+                outputs[iprompt].append(total_sequence)
+
+        return outputs
+
+    def decode_generated(self, generated_sequence, stop_at_newline=False):
+        stop_token = "</s>"
+
+        text = self.tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=True)
+
+        # Remove all text after the stop token
+        if stop_token in text:
+            text = text[: text.find(stop_token)]
+
+        if stop_at_newline and '\n' in text:
+            text = text[: text.find('\n')]
+
+        return text.strip()
+
+    def encode_common_prefix(self, rows):
+        """
+        Если включен кэш префиксов, то общая начальная часть промптов rows прогоняется через модель (или берется
+        из кэша). Хотя бы один токен каждого промпта остается вне префикса, чтобы получить логиты для первого шага.
+        Возвращаем длину префикса и его past_key_values для одной последовательности.
+        """
+        if self.prefix_cache is None:
+            return 0, None
+
+        prefix_len = min(common_prefix_len(rows), min(len(row) for row in rows) - 1)
+        if prefix_len <= 0:
+            return 0, None
+
+        past, _, _ = self.encode_prefix(rows[0][:prefix_len])
+        return prefix_len, past
+
+    def sample_with_generate(self, rows, length, temperature, stop_at_newline=False):
+        """
+        Сэмплирование продолжений для промптов rows (списков токенов) через model.generate.
+        Общий префикс промптов берется из кэша префиксов (если он включен) и передается в model.generate
+        как past_key_values, различающиеся хвосты промптов дополняются слева паддингом, который закрывается маской.
+        """
+        repetition_penalty = 1.0
+
+        prefix_len, past = self.encode_common_prefix(rows)
+        suffixes = [row[prefix_len:] for row in rows]
+        max_suffix_len = max(len(suffix) for suffix in suffixes)
+        max_prompt_len = prefix_len + max_suffix_len
+        input_ids = []
+        attention_mask = []
+        for row, suffix in zip(rows, suffixes):
+            npad = max_suffix_len - len(suffix)
+            input_ids.append(row[:prefix_len] + [self.pad_token_id] * npad + suffix)
+            attention_mask.append([1] * prefix_len + [0] * npad + [1] * len(suffix))
+
+        input_ids = torch.tensor(input_ids, dtype=torch.long, device=self.device)
+        attention_mask = torch.tensor(attention_mask, dtype=torch.long, device=self.device)
+
+        generate_kwargs = dict()
+        if past is not None:
+            # Позиции токенов model.generate вычисляет по маске внимания, так что дыра паддинга после префикса не мешает
+            generate_kwargs['past_key_values'] = expand_past(past, len(rows))
+        if stop_at_newline:
+            # Законченные последовательности дополняются pad-токенами, генерация прекращается,
+            # когда в каждой последовательности появился перевод строки или </s>.
+            generate_kwargs['eos_token_id'] = self.newline_token_ids + [self.eos_token_id]
+            generate_kwargs['stopping_criteria'] = transformers.StoppingCriteriaList([StopTokensCriteria(self.newline_tokens_mask)])
 
         output_sequences = self.model.generate(
-            input_ids=encoded_prompt,
-            max_length=length + len(encoded_prompt[0]),
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            max_length=length + max_prompt_len,
             temperature=temperature,
             top_k=self.beam_k,
             top_p=self.beam_p,
             repetition_penalty=repetition_penalty,
             do_sample=True,
-            num_return_sequences=num_return_sequences,
-            pad_token_id=0
+            num_return_sequences=1,
+            pad_token_id=self.pad_token_id,
+            **generate_kwargs
         )
 
-        # Remove the batch dimension when returning multiple sequences
-        if len(output_sequences.shape) > 2:
-            output_sequences.squeeze_()
+        # Промпт с паддингом отрезаем, оставляем только сгенерированные токены
+        return [generated_sequence[max_prompt_len:].tolist() for generated_sequence in output_sequences]
+
+    def sample_lean(self, rows, length, temperature, stop_at_newline=False):
+        """
+        Сэмплирование продолжений для промптов rows (списков токенов) облегченным декодером LeanDecoder.
+        Общий префикс всех промптов берется из кэша префиксов (если он включен), различающиеся хвосты промптов
+        дополняются слева паддингом, который закрывается маской.
+        Возвращает списки сгенерированных токенов.
+        """
+        batch_size = len(rows)
+        prefix_len, past, input_ids, attention_mask, position_ids, max_len = self.prepare_lean_inputs(rows, length)
+
+        decoder = self.get_lean_decoder()
+        decoder.allocate(batch_size, max_len)
+        if past is not None:
+            decoder.load_past(past, batch_size)
+
+        # Маска законченных последовательностей: после стоп-токена в последовательность пишутся pad-токены.
+        stop_tokens_mask = self.get_stop_tokens_mask(stop_at_newline)
+        generated = []
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
+        start = prefix_len
+        with torch.no_grad():
+            for _ in range(length):
+                end = start + input_ids.shape[1]
+                logits = decoder.forward(input_ids, position_ids[:, start:end], attention_mask, start)
+
+                next_tokens = sample_next_tokens(logits, temperature, self.beam_k, self.beam_p)
+                next_tokens = next_tokens.masked_fill(finished, self.pad_token_id)
+                generated.append(next_tokens)
+
+                finished = finished | stop_tokens_mask[next_tokens]
+                if finished.all():
+                    break
+
+                input_ids = next_tokens.unsqueeze(-1)
+                start = end
+
+        return torch.stack(generated, dim=1).tolist()
+
+    def prepare_lean_inputs(self, rows, length, extra_len=0):
+        """
+        Готовим входы для LeanDecoder: общий префикс промптов (из кэша префиксов), хвосты промптов с паддингом слева,
+        маску внимания на всю длину генерации и позиции токенов.
+        """
+        batch_size = len(rows)
+
+        prefix_len, past = self.encode_common_prefix(rows)
+        suffixes = [row[prefix_len:] for row in rows]
+        max_suffix_len = max(len(suffix) for suffix in suffixes)
+        max_len = prefix_len + max_suffix_len + length + extra_len
+
+        input_ids = torch.full((batch_size, max_suffix_len), self.pad_token_id, dtype=torch.long)
+        # Маска внимания заводится сразу на всю длину генерации, позиции вычисляются по ней как cumsum(mask)-1
+        attention_mask = torch.ones((batch_size, max_len), dtype=torch.long)
+        for irow, suffix in enumerate(suffixes):
+            npad = max_suffix_len - len(suffix)
+            input_ids[irow, npad:] = torch.tensor(suffix, dtype=torch.long)
+            attention_mask[irow, prefix_len: prefix_len + npad] = 0
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+
+        return prefix_len, past, input_ids, attention_mask, position_ids, max_len
+
+    def sample_speculative(self, rows, length, temperature, stop_at_newline=False):
+        """
+        Спекулятивное сэмплирование: черновая модель предлагает speculative_k токенов, основная модель проверяет
+        их за один проход. Черновой токен x принимается с вероятностью min(1, p(x)/q(x)), где p и q - распределения
+        основной и черновой моделей после temperature/top-k/top-p, на первом отвергнутом токене делается выбор
+        из остаточного распределения max(0, p-q). Поэтому результат распределен так же, как при обычном сэмплировании
+        из основной модели.
+
+        Все строки батча сдвигаются синхронно на m+1 токенов, где m - минимальное по строкам число принятых токенов.
+        Для строк, принявших больше m токенов, (m+1)-й токен - принятый черновой, и точность сохраняется.
+        Кэши обоих декодеров откатываются простым выбором позиции, с которой пишутся следующие токены.
+        """
+        k = self.speculative_k
+        batch_size = len(rows)
+        prefix_len, past, input_ids, attention_mask, position_ids, max_len = self.prepare_lean_inputs(rows, length, extra_len=k + 2)
+
+        decoder = self.get_lean_decoder()
+        decoder.allocate(batch_size, max_len)
+        draft_decoder = self.draft_decoder
+        draft_decoder.allocate(batch_size, max_len)
+
+        def warp(logits):
+            return warp_probs(logits, temperature, self.beam_k, self.beam_p)
+
+        stop_tokens_mask = self.get_stop_tokens_mask(stop_at_newline)
+        generated = []
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
+
+        def emit(tokens):
+            # Добавляем очередной токен каждой строки, после стоп-токена строка заполняется pad-токенами
+            nonlocal finished
+            tokens = tokens.masked_fill(finished, self.pad_token_id)
+            generated.append(tokens)
+            finished = finished | stop_tokens_mask[tokens]
+
+        with torch.no_grad():
+            # Промпт: основная модель продолжает общий префикс из кэша, черновая прогоняет промпт целиком.
+            start = prefix_len + input_ids.shape[1]
+            if past is not None:
+                decoder.load_past(past, batch_size)
+                prefix_ids = torch.tensor([rows[0][:prefix_len]], dtype=torch.long, device=self.device).expand(batch_size, -1)
+                draft_input_ids = torch.cat([prefix_ids, input_ids], dim=1)
+            else:
+                draft_input_ids = input_ids
+            logits = decoder.forward(input_ids, position_ids[:, prefix_len:start], attention_mask, prefix_len)
+            draft_decoder.forward(draft_input_ids, position_ids[:, :start], attention_mask, 0)
+            emit(torch.multinomial(warp(logits), num_samples=1).squeeze(1))
+
+            # Токены, которые каждый из декодеров еще не видел, и позиции, с которых они будут записаны
+            main_pending, main_start = generated[-1].unsqueeze(-1), start
+            draft_pending, draft_start = generated[-1].unsqueeze(-1), start
+
+            while len(generated) < length and not finished.all():
+                # Черновая модель предлагает k токенов
+                draft_tokens = []
+                draft_probs = []
+                step_input, step_start = draft_pending, draft_start
+                for _ in range(k):
+                    step_end = step_start + step_input.shape[1]
+                    q = warp(draft_decoder.forward(step_input, position_ids[:, step_start:step_end], attention_mask, step_start))
+                    step_input = torch.multinomial(q, num_samples=1)
+                    draft_tokens.append(step_input)
+                    draft_probs.append(q)
+                    step_start = step_end
+                x = torch.cat(draft_tokens, dim=1)  # [batch, k]
+                q = torch.stack(draft_probs, dim=1)  # [batch, k, vocab]
+
+                # Основная модель оценивает все черновые токены за один проход
+                main_input = torch.cat([main_pending, x], dim=1)
+                main_end = main_start + main_input.shape[1]
+                logits = decoder.forward(main_input, position_ids[:, main_start:main_end], attention_mask, main_start, all_logits=True)
+                p = warp(logits[:, -(k + 1):])  # [batch, k+1, vocab]
+
+                px = p[:, :k].gather(-1, x.unsqueeze(-1)).squeeze(-1)
+                qx = q.gather(-1, x.unsqueeze(-1)).squeeze(-1)
+                accepted = torch.rand_like(px) * qx < px
+                nb_accepted = accepted.long().cumprod(dim=1).sum(dim=1)
+                m = int(nb_accepted.min())
+
+                if m == k:
+                    next_tokens = torch.multinomial(p[:, k], num_samples=1).squeeze(1)
+                else:
+                    residual = (p[:, m] - q[:, m]).clamp(min=0.0)
+                    residual_sum = residual.sum(dim=-1, keepdim=True)
+                    residual = torch.where(residual_sum > 0, residual / residual_sum.clamp(min=1e-12), p[:, m])
+                    resampled = torch.multinomial(residual, num_samples=1).squeeze(1)
+                    next_tokens = torch.where(nb_accepted > m, x[:, m], resampled)
+
+                for j in range(m):
+                    emit(x[:, j])
+                emit(next_tokens)
+
+                # Откат кэшей: остаются только позиции принятых токенов
+                main_start = main_start + main_pending.shape[1] + m
+                main_pending = next_tokens.unsqueeze(-1)
+                if m == k:
+                    # Черновая модель еще не видела свой последний предложенный токен
+                    draft_start = step_start
+                    draft_pending = torch.cat([x[:, k-1:], next_tokens.unsqueeze(-1)], dim=1)
+                else:
+                    draft_start = draft_start + draft_pending.shape[1] + m
+                    draft_pending = next_tokens.unsqueeze(-1)
+
+        return torch.stack(generated[:length], dim=1).tolist()
+
+    def get_lean_decoder(self):
+        if self.lean_decoder is None or self.lean_decoder.model is not self.model:
+            self.lean_decoder = LeanDecoder(self.model)
+        return self.lean_decoder
+
+
+if __name__ == '__main__':
+    # Сравнение скорости model.generate и облегченного декодера LeanDecoder на типичных для чатбота батчах.
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Бенчмарк декодеров rugpt')
+    parser.add_argument('--model', type=str, default='../../tmp/rugpt_chitchat')
+    parser.add_argument('--prompt', type=str, default='<s>{chitchat}\n- Привет! Как тебя зовут?\n')
+    parser.add_argument('--batch_size', type=int, default=5)
+    parser.add_argument('--length', type=int, default=20, help='число генерируемых токенов')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--branches', type=int, default=4, help='число потоков, одновременно вызывающих generate_batch, как ветки ответа в BotCore')
+    args = parser.parse_args()
+
+    gpt = RugptBase()
+    gpt.load_from_path(args.model)
+    gpt.beam_k = 50
+
+    prompt_tokens = gpt.tokenizer.encode(args.prompt, add_special_tokens=False)
+    rows = [prompt_tokens] * args.batch_size
+
+    # Стоп-токены отключаем, чтобы оба декодера генерировали ровно length токенов.
+    gpt.eos_tokens_mask.zero_()
+    gpt.eos_token_id = None
 
-        generated_sequences = set()
-        for generated_sequence_idx, generated_sequence in enumerate(output_sequences):
-            generated_sequence = generated_sequence.tolist()
+    for engine_name, sample_fn in [('model.generate', gpt.sample_with_generate), ('LeanDecoder', gpt.sample_lean)]:
+        sample_fn(rows, args.length, 1.0)  # прогрев
+        nb_tokens = 0
+        t0 = time.time()
+        for _ in range(args.repeats):
+            generated = sample_fn(rows, args.length, 1.0)
+            nb_tokens += sum(len(seq) for seq in generated)
+        elapsed = time.time() - t0
+        print('{:<16} {:8.1f} tokens/sec  ({:.1f} ms per batch)'.format(engine_name, nb_tokens / elapsed, 1000.0 * elapsed / args.repeats))
+        print('  sample: {}'.format(gpt.decode_generated(generated[0])))
 
-            # Decode text
-            text = self.tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=True)
+    if args.branches > 1:
+        # Ветки ответа BotCore (клаузы интерпретации, читчат) вызывают generate_batch из разных потоков.
+        # Сравниваем время на ход при последовательном выполнении веток и в пуле потоков.
+        import concurrent.futures
 
-            # Remove all text after the stop token
-            if stop_token in text:
-                text = text[: text.find(stop_token)]
+        gpt.lean_decoding = False
+        prompts = [(args.prompt, args.batch_size)]
 
-            total_sequence = text[len(prompt_text):].strip()  # отрезаем промт
-            if total_sequence:
-                generated_sequences.add(total_sequence)
+        def run_turn(pool):
+            if pool is None:
+                for _ in range(args.branches):
+                    gpt.generate_batch(prompts)
+            else:
+                for future in [pool.submit(gpt.generate_batch, prompts) for _ in range(args.branches)]:
+                    future.result()
 
-        return list(generated_sequences)
+        print('torch threads: {}, branches: {}'.format(torch.get_num_threads(), args.branches))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.branches) as pool:
+            for mode_name, mode_pool in [('sequential', None), ('thread pool', pool)]:
+                run_turn(mode_pool)  # прогрев
+                t0 = time.time()
+                for _ in range(args.repeats):
+                    run_turn(mode_pool)
+                elapsed = time.time() - t0
+                print('{:<16} {:8.1f} ms per turn'.format(mode_name, 1000.0 * elapsed / args.repeats))
@@ -4,14 +4,33 @@
 04-03-2022 Сдеоланы отдельные методы generate_autoquestions, generate_chitchat, generate_confabulations,
            generate_interpretations, формирующие внутри себя правильные форматы входных данных для генеративной
            модели.
+18.10.2026 Батчевые варианты generate_chitchat_batch и generate_interpretations_batch: несколько контекстов
+           обрабатываются одним вызовом генеративной модели.
+18.10.2026 score_dialogues оценивает диалоги батчами с паддингом и маскированием loss
+18.10.2026 score_dialogues и генерация используют KV-кэш общих префиксов, см. RugptBase.start_prefix_cache
+18.10.2026 Генерация однострочных результатов останавливается на первом переводе строки
+18.10.2026 predict_contradictions - оценка противоречия утверждения предпосылке за один проход модели, без сэмплирования
+18.10.2026 Адаптивная генерация вариантов волнами с остановкой по числу уникальных реплик
+18.10.2026 Оценка диалогов и противоречий из разных потоков выполняется по очереди под self.lock
+18.10.2026 Оценка диалогов и противоречий не держит self.lock: общий у потоков только кэш префиксов со своей блокировкой
+18.10.2026 Параметры калибровки противоречий сохраняются рядом с моделью, см. contradiction_calibration.py
 """
 
+import io
+import json
 import logging
 import math
+import os
 
+import numpy as np
 import torch
+import torch.nn.functional as F
 
-from ruchatbot.bot.rugpt_base import RugptBase
+from ruchatbot.bot.rugpt_base import RugptBase, common_prefix_len, expand_past
+
+
+def get_contradiction_calibration_path(model_path):
+    return os.path.join(model_path, 'contradiction_calibration.json')
 
 
 class RugptChitchat(RugptBase):
@@ -21,13 +40,32 @@ class RugptChitchat(RugptBase):
         self.beam_p = 0.9
         self.temperature = 1.0
 
+        # Первые слова ответов для оценки противоречий в predict_contradictions
+        self.negative_answer_words = ['нет', 'не', 'неправда', 'никогда', 'ничего']
+        self.affirmative_answer_words = ['да', 'конечно', 'верно', 'правда', 'ага', 'угу', 'разумеется']
+        self.polarity_token_ids = None
+        # Параметры логистической калибровки (a, b) для отношения масс отрицательных и утвердительных ответов
+        self.contradiction_calibration = (1.0, 0.0)
+
+        # Адаптивная генерация вариантов волнами, см. generate_replies_adaptive_batch
+        self.sampling_wave_size = 2
+        self.min_sampling_yield = 0.5
+        self.nb_samples_generated = 0
+        self.nb_samples_kept = 0
+
+        # Размеры батчей для score_dialogues. На CPU выгоднее небольшие батчи из текстов близкой длины.
+        if self.device.type == 'cpu':
+            self.score_batch_size = 8
+            self.score_batch_tokens = 2048
+        else:
+            self.score_batch_size = 32
+            self.score_batch_tokens = 16384
+
     def load(self, model_path):
         logging.debug('Start loading generative model from "%s"', model_path)
         self.load_from_path(model_path)
 
-    def generate_chitchat(self, context_replies, num_return_sequences):
-        outputs = set()
-
+    def format_dialog(self, context_replies):
         input_dialog = []
         for r in context_replies:
             if r.startswith('[') or r.startswith('{'):
@@ -39,97 +77,277 @@ class RugptChitchat(RugptBase):
             else:
                 # Обычные реплики без начального "- "
                 input_dialog.append('- ' + r)
+        return input_dialog
+
+    def generate_replies_batch(self, header, contexts):
+        """
+        Генерация реплик для нескольких контекстов одним батчем. Из каждого результата берем первую строку.
+        :param header: метка режима генерации, например {chitchat}
+        :param contexts: список пар (реплики контекста, число генерируемых вариантов)
+        """
+        prompts = [('<s>' + header + '\n' + '\n'.join(self.format_dialog(context_replies)) + '\n', num_return_sequences)
+                   for context_replies, num_return_sequences in contexts]
+        batch_outputs = []
+        for raw_outputs in self.generate_batch(prompts, temperature=self.temperature, stop_at_newline=True):
+            outputs = []
+            for o in raw_outputs:
+                lines = o.split('\n')
+                line1 = lines[0].strip()
+                if line1.startswith('-'):
+                    line1 = line1[1:].strip()
+                if line1 not in outputs:
+                    outputs.append(line1)
+            batch_outputs.append(outputs)
+
+        return batch_outputs
+
+    def generate_replies_adaptive_batch(self, header, contexts, target_unique, max_samples):
+        """
+        Генерация реплик волнами по sampling_wave_size вариантов. Для контекста генерация прекращается, когда набрано
+        target_unique различных реплик, сгенерировано max_samples вариантов или очередная волна дала слишком мало
+        новых реплик (доля меньше min_sampling_yield). Промпты повторных волн берутся из кэша префиксов, если он включен.
+        Если target_unique не меньше max_samples, то все max_samples вариантов генерируются одним вызовом, как в generate_replies_batch.
+        """
+        if target_unique >= max_samples:
+            batch_outputs = self.generate_replies_batch(header, [(context, max_samples) for context in contexts])
+            self.count_samples(max_samples * len(contexts), sum(len(outputs) for outputs in batch_outputs))
+            return batch_outputs
+
+        batch_outputs = [[] for _ in contexts]
+        nb_generated = [0] * len(contexts)
+        active = list(range(len(contexts)))
+        while active:
+            wave = [(i, min(self.sampling_wave_size, max_samples - nb_generated[i])) for i in active]
+            wave_outputs = self.generate_replies_batch(header, [(contexts[i], n) for i, n in wave])
+
+            active = []
+            for (i, n), outputs in zip(wave, wave_outputs):
+                nb_generated[i] += n
+                new_outputs = [o for o in outputs if o not in batch_outputs[i]]
+                batch_outputs[i].extend(new_outputs)
+                if len(batch_outputs[i]) < target_unique and nb_generated[i] < max_samples \
+                        and len(new_outputs) >= self.min_sampling_yield * n:
+                    active.append(i)
+
+        self.count_samples(sum(nb_generated), sum(len(outputs) for outputs in batch_outputs))
+        return batch_outputs
+
+    def count_samples(self, nb_generated, nb_kept):
+        """Статистика адаптивной генерации, ее пополняют ветки ответа из разных потоков"""
+        with self.lock:
+            self.nb_samples_generated += nb_generated
+            self.nb_samples_kept += nb_kept
+
+    def get_sampling_yield(self):
+        """Доля уникальных реплик среди всех сгенерированных в адаптивном режиме"""
+        with self.lock:
+            return self.nb_samples_kept / float(max(1, self.nb_samples_generated))
+
+    def generate_chitchat(self, context_replies, num_return_sequences):
+        return self.generate_chitchat_batch([(context_replies, num_return_sequences)])[0]
 
-        prompt_text = '<s>{chitchat}\n' + '\n'.join(input_dialog) + '\n'
-        raw_outputs = self.generate_output_from_prompt(prompt_text, num_return_sequences, temperature=self.temperature)
-        for o in raw_outputs:
-            lines = o.split('\n')
-            line1 = lines[0].strip()
-            if line1.startswith('-'):
-                line1 = line1[1:].strip()
-            outputs.add(line1)
+    def generate_chitchat_batch(self, contexts):
+        return self.generate_replies_batch('{chitchat}', contexts)
 
-        return list(outputs)
+    def generate_chitchat_adaptive(self, context_replies, target_unique, max_samples):
+        return self.generate_replies_adaptive_batch('{chitchat}', [context_replies], target_unique, max_samples)[0]
+
+    def generate_chitchat_adaptive_batch(self, contexts, target_unique, max_samples):
+        return self.generate_replies_adaptive_batch('{chitchat}', contexts, target_unique, max_samples)
 
     def score_dialogues(self, dialogues):
-        # из-за разной длины текстов придется выполнять вычисления по 1 тексту за раз :(
-        scores = []
-        for dialog in dialogues:
-            encoded_text = self.tokenizer.encode('<s>{chitchat}\n' + '\n'.join(dialog))
-            t = torch.tensor(encoded_text, dtype=torch.long, device=self.device).unsqueeze(0)
+        """
+        Оценка диалогов генеративной моделью: exp(-loss), где loss - средняя кросс-энтропия по токенам диалога.
+        Диалоги сортируются по длине и обрабатываются батчами с паддингом справа, паддинг исключается из loss
+        с помощью маски, так что скор диалога не зависит от соседей по батчу.
+        Если включен кэш префиксов, то общая для всех диалогов начальная часть прогоняется через модель один раз.
+        """
+        encoded_texts = [self.tokenizer.encode('<s>{chitchat}\n' + '\n'.join(dialog)) for dialog in dialogues]
+        scores = [None] * len(dialogues)
+        if not encoded_texts:
+            return scores
+
+        prefix_len = 0
+        prefix_past = None
+        prefix_logits = None
+        prefix_loss = 0.0
+        if self.prefix_cache is not None:
+            prefix_len = min(common_prefix_len(encoded_texts), min(len(tokens) for tokens in encoded_texts) - 1)
+            if prefix_len > 0:
+                prefix_past, prefix_logprobs, prefix_logits = self.encode_prefix(encoded_texts[0][:prefix_len])
+                prefix_loss = -sum(prefix_logprobs)
+
+        suffixes = [tokens[prefix_len:] for tokens in encoded_texts]
+        for batch_indeces in self.split_score_batches(suffixes):
+            seq_len = max(len(suffixes[i]) for i in batch_indeces)
+            input_ids = torch.full((len(batch_indeces), seq_len), self.pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(batch_indeces), prefix_len + seq_len), dtype=torch.long)
+            attention_mask[:, :prefix_len] = 1
+            for row, i in enumerate(batch_indeces):
+                input_ids[row, :len(suffixes[i])] = torch.tensor(suffixes[i], dtype=torch.long)
+                attention_mask[row, prefix_len: prefix_len + len(suffixes[i])] = 1
+            input_ids = input_ids.to(self.device)
+            attention_mask = attention_mask.to(self.device)
+
             with torch.no_grad():
-                loss = self.model(t, labels=t)
-            #perplexity = math.exp(loss[0].item())
-            score = loss[0].item()
-            scores.append(math.exp(-score))
+                if prefix_past is not None:
+                    past = expand_past(prefix_past, len(batch_indeces))
+                    logits = self.model(input_ids, past_key_values=past, attention_mask=attention_mask)[0]
+                    # Первый токен хвоста предсказывается по логитам последней позиции префикса
+                    shift_logits = torch.cat([prefix_logits.expand(len(batch_indeces), 1, -1), logits[:, :-1, :]], dim=1)
+                    shift_labels = input_ids
+                    shift_mask = attention_mask[:, prefix_len:].float()
+                else:
+                    logits = self.model(input_ids, attention_mask=attention_mask)[0]
+                    # Как и в GPT2LMHeadModel, токен t предсказывается по логитам позиции t-1
+                    shift_logits = logits[:, :-1, :]
+                    shift_labels = input_ids[:, 1:]
+                    shift_mask = attention_mask[:, 1:].float()
+
+                token_losses = F.cross_entropy(shift_logits.reshape(-1, shift_logits.shape[-1]), shift_labels.reshape(-1), reduction='none')
+                token_losses = token_losses.view(shift_labels.shape) * shift_mask
+                nb_tokens = shift_mask.sum(dim=1) + max(0, prefix_len - 1)
+                losses = (token_losses.sum(dim=1) + prefix_loss) / nb_tokens.clamp(min=1.0)
+
+            for i, loss in zip(batch_indeces, losses.tolist()):
+                scores[i] = math.exp(-loss)
 
         return scores
 
-    def generate_autoquestions(self, context_replies, num_return_sequences):
-        outputs = set()
+    def split_score_batches(self, encoded_texts):
+        """
+        Разбиваем тексты на батчи для score_dialogues. Тексты близкой длины попадают в один батч, размер батча
+        ограничен числом текстов и общим числом токенов с учетом паддинга.
+        """
+        batches = []
+        batch = []
+        batch_len = 0
+        for i in sorted(range(len(encoded_texts)), key=lambda i: len(encoded_texts[i])):
+            seq_len = max(batch_len, len(encoded_texts[i]))
+            if batch and (len(batch) >= self.score_batch_size or seq_len * (len(batch) + 1) > self.score_batch_tokens):
+                batches.append(batch)
+                batch = []
+                seq_len = len(encoded_texts[i])
+            batch.append(i)
+            batch_len = seq_len
 
-        input_dialog = []
-        for r in context_replies:
-            if r.startswith('[') or r.startswith('{'):
-                input_dialog.append(r)
-            elif r.startswith('-'):
-                # Обычные реплики, в начале которых уже стоит тире
-                input_dialog.append(r)
-            else:
-                # Обычные реплики без начального "- "
-                input_dialog.append('- ' + r)
+        if batch:
+            batches.append(batch)
 
-        prompt_text = '<s>{autoquestion}\n' + '\n'.join(input_dialog) + '\n'
-        raw_outputs = self.generate_output_from_prompt(prompt_text, num_return_sequences, temperature=self.temperature)
-        for o in raw_outputs:
-            lines = o.split('\n')
-            line1 = lines[0].strip()
-            if line1.startswith('-'):
-                line1 = line1[1:].strip()
-            outputs.add(line1)
+        return batches
 
-        return list(outputs)
+    def get_polarity_token_ids(self):
+        """Токены, которыми начинаются отрицательные и утвердительные ответы. Берем только однотокенные слова."""
+        if self.polarity_token_ids is None:
+            # Список собираем целиком и только потом запоминаем, чтобы другие потоки не увидели его недостроенным
+            polarity_token_ids = []
+            for words in [self.negative_answer_words, self.affirmative_answer_words]:
+                token_ids = set()
+                for word in words:
+                    for variant in [word, word.capitalize()]:
+                        ids = self.tokenizer.encode(' ' + variant, add_special_tokens=False)
+                        if len(ids) == 1:
+                            token_ids.add(ids[0])
+                polarity_token_ids.append(sorted(token_ids))
+            self.polarity_token_ids = polarity_token_ids
+        return self.polarity_token_ids
 
-    def generate_confabulations(self, context_replies, num_return_sequences):
-        outputs = set()
+    def score_answer_polarity(self, contexts):
+        """
+        Для каждого контекста читчата за один проход модели вычисляем вероятностную массу отрицательных
+        и утвердительных первых слов ответной реплики. Возвращается список пар (p_negative, p_affirmative).
+        """
+        if not contexts:
+            return []
 
-        input_dialog = []
-        for r in context_replies:
-            if r.startswith('[') or r.startswith('{'):
-                input_dialog.append(r)
-            elif r.startswith('-'):
-                # Обычные реплики, в начале которых уже стоит тире
-                input_dialog.append(r)
-            else:
-                # Обычные реплики без начального "- "
-                input_dialog.append('- ' + r)
+        negative_ids, affirmative_ids = self.get_polarity_token_ids()
+
+        # Промпт заканчивается тире, с которого начинается ответная реплика, так что следующий токен - первое слово ответа.
+        encoded_prompts = [self.tokenizer.encode('<s>{chitchat}\n' + '\n'.join(self.format_dialog(context_replies)) + '\n-', add_special_tokens=False)
+                           for context_replies in contexts]
+
+        res = [None] * len(contexts)
+        for batch_indeces in self.split_score_batches(encoded_prompts):
+            seq_len = max(len(encoded_prompts[i]) for i in batch_indeces)
+            input_ids = torch.full((len(batch_indeces), seq_len), self.pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(batch_indeces), seq_len), dtype=torch.long)
+            for row, i in enumerate(batch_indeces):
+                input_ids[row, :len(encoded_prompts[i])] = torch.tensor(encoded_prompts[i], dtype=torch.long)
+                attention_mask[row, :len(encoded_prompts[i])] = 1
+            last_positions = torch.tensor([len(encoded_prompts[i]) - 1 for i in batch_indeces], dtype=torch.long)
+
+            with torch.no_grad():
+                logits = self.model(input_ids.to(self.device), attention_mask=attention_mask.to(self.device))[0]
+                probs = F.softmax(logits[torch.arange(len(batch_indeces)), last_positions.to(self.device)], dim=-1)
+                p_negative = probs[:, negative_ids].sum(dim=-1)
+                p_affirmative = probs[:, affirmative_ids].sum(dim=-1)
+
+            for i, pn, pa in zip(batch_indeces, p_negative.tolist(), p_affirmative.tolist()):
+                res[i] = (pn, pa)
 
-        prompt_text = '<s>{confabulation}\n' + '\n'.join(input_dialog) + '\n'
-        raw_outputs = self.generate_output_from_prompt(prompt_text, num_return_sequences, temperature=self.temperature)
-        for o in raw_outputs:
-            lines = o.split('\n')
-            line1 = lines[0].strip()
-            if line1.startswith('-'):
-                line1 = line1[1:].strip()
-            outputs.add(line1)
+        return res
 
-        return list(outputs)
+    def predict_contradictions(self, premise_assertions):
+        """
+        Вероятность того, что утверждение противоречит предпосылке. Модель спрашивается в режиме PQA:
+        "[предпосылка.] утверждение?", и сравнивается масса отрицательных и утвердительных ответов.
+        Отношение масс калибруется логистической функцией с параметрами contradiction_calibration (см. fit_contradiction_calibration).
+        Параметры подбираются скриптом contradiction_calibration.py и загружаются в BotCore.load.
+
+        :param premise_assertions: список пар (предпосылка, утверждение)
+        """
+        contexts = [['[' + premise + '.] ' + assertion + '?'] for premise, assertion in premise_assertions]
+        a, b = self.contradiction_calibration
+        res = []
+        for p_negative, p_affirmative in self.score_answer_polarity(contexts):
+            log_odds = math.log(p_negative + 1e-8) - math.log(p_affirmative + 1e-8)
+            res.append(1.0 / (1.0 + math.exp(-(a * log_odds + b))))
+        return res
+
+    def fit_contradiction_calibration(self, premise_assertions, labels, nb_iterations=200, learning_rate=0.1):
+        """
+        Подбор параметров калибровки predict_contradictions (Platt scaling) по размеченным примерам.
+        :param labels: 1 - утверждение противоречит предпосылке, 0 - нет
+        """
+        contexts = [['[' + premise + '.] ' + assertion + '?'] for premise, assertion in premise_assertions]
+        x = np.asarray([math.log(pn + 1e-8) - math.log(pa + 1e-8) for pn, pa in self.score_answer_polarity(contexts)])
+        y = np.asarray(labels, dtype=np.float64)
+
+        a, b = 1.0, 0.0
+        for _ in range(nb_iterations):
+            p = 1.0 / (1.0 + np.exp(-(a * x + b)))
+            a -= learning_rate * np.mean((p - y) * x)
+            b -= learning_rate * np.mean(p - y)
+
+        self.contradiction_calibration = (a, b)
+        return self.contradiction_calibration
+
+    def save_contradiction_calibration(self, calibration_path):
+        with io.open(calibration_path, 'w', encoding='utf-8') as wrt:
+            a, b = self.contradiction_calibration
+            json.dump({'a': a, 'b': b}, wrt, indent=4)
+
+    def load_contradiction_calibration(self, calibration_path):
+        with io.open(calibration_path, 'r', encoding='utf-8') as rdr:
+            data = json.load(rdr)
+            self.contradiction_calibration = (float(data['a']), float(data['b']))
+
+    def generate_autoquestions(self, context_replies, num_return_sequences):
+        return self.generate_replies_batch('{autoquestion}', [(context_replies, num_return_sequences)])[0]
+
+    def generate_confabulations(self, context_replies, num_return_sequences):
+        return self.generate_replies_batch('{confabulation}', [(context_replies, num_return_sequences)])[0]
+
+    def generate_confabulations_adaptive(self, context_replies, target_unique, max_samples):
+        return self.generate_replies_adaptive_batch('{confabulation}', [context_replies], target_unique, max_samples)[0]
 
     def generate_interpretations(self, context_replies, num_return_sequences):
-        input_context = []
-        for r in context_replies:
-            if r.startswith('[') or r.startswith('{'):
-                input_context.append(r)
-            elif r.startswith('-'):
-                # Обычные реплики, в начале которых уже стоит тире
-                input_context.append(r)
-            else:
-                # Обычные реплики без начального "- "
-                input_context.append('- ' + r)
+        return self.generate_interpretations_batch([(context_replies, num_return_sequences)])[0]
 
-        prompt_text = '<s>' + '\n'.join(input_context) + ' #'
-        outputs = self.generate_output_from_prompt(prompt_text, num_return_sequences, temperature=self.temperature)
-        return list(set(outputs))
+    def generate_interpretations_batch(self, contexts):
+        prompts = [('<s>' + '\n'.join(self.format_dialog(context_replies)) + ' #', num_return_sequences)
+                   for context_replies, num_return_sequences in contexts]
+        return self.generate_batch(prompts, temperature=self.temperature, stop_at_newline=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,62 @@
+"""
+Построение черновой модели для спекулятивного декодирования в RugptBase.
+
+Черновая модель - копия rugpt_chitchat, в которой оставлено только несколько трансформерных блоков
+(равномерно по глубине, первый и последний блоки сохраняются). Эмбеддинги, финальная нормализация и lm_head
+берутся из исходной модели, так что словарь совпадает. Такую модель желательно дообучить (или дистиллировать)
+на том же датасете, что и rugpt_chitchat: чем ближе ее распределения к основной модели, тем больше черновых
+токенов принимается.
+
+Результат сохраняется в каталог rugpt_chitchat_draft рядом с rugpt_chitchat, откуда его подхватывает BotCore.load.
+
+Запуск:
+python rugpt_draft_model.py --model ../../tmp/rugpt_chitchat --output ../../tmp/rugpt_chitchat_draft --nb_layers 4
+
+18.10.2026 Начальная реализация
+"""
+
+import argparse
+import logging
+
+import torch.nn as nn
+from transformers import GPT2LMHeadModel, GPT2Tokenizer
+
+
+def select_layers(nb_layers, nb_keep):
+    """Индексы оставляемых блоков, равномерно от первого до последнего"""
+    if nb_keep >= nb_layers:
+        return list(range(nb_layers))
+    if nb_keep == 1:
+        return [nb_layers - 1]
+    return sorted(set(round(i * (nb_layers - 1) / (nb_keep - 1)) for i in range(nb_keep)))
+
+
+def build_draft_model(model_path, nb_layers):
+    model = GPT2LMHeadModel.from_pretrained(model_path)
+    keep = select_layers(len(model.transformer.h), nb_layers)
+    logging.info('Keeping transformer blocks %s of %d', keep, len(model.transformer.h))
+
+    model.transformer.h = nn.ModuleList([model.transformer.h[i] for i in keep])
+    for ilayer, block in enumerate(model.transformer.h):
+        # В новых версиях transformers блок внимания знает свой номер слоя для работы с кэшем
+        if hasattr(block.attn, 'layer_idx'):
+            block.attn.layer_idx = ilayer
+    model.config.n_layer = len(keep)
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Построение черновой модели для спекулятивного декодирования')
+    parser.add_argument('--model', type=str, default='../../tmp/rugpt_chitchat')
+    parser.add_argument('--output', type=str, default='../../tmp/rugpt_chitchat_draft')
+    parser.add_argument('--nb_layers', type=int, default=4, help='сколько трансформерных блоков оставить')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    draft_model = build_draft_model(args.model, args.nb_layers)
+    draft_model.save_pretrained(args.output)
+    GPT2Tokenizer.from_pretrained(args.model).save_pretrained(args.output)
+
+    nb_params = sum(p.numel() for p in draft_model.parameters())
+    print('Draft model with {} blocks ({:.1f}M parameters) saved to "{}"'.format(draft_model.config.n_layer, nb_params / 1e6, args.output))
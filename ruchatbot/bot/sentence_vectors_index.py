@@ -0,0 +1,144 @@
+"""
+Индекс векторов предложений для быстрого поиска кандидатов в детекторе синонимичности.
+
+Вектор предложения - усредненные по токенам выходы rubert, нормированные на единичную длину.
+Для небольших баз знаний поиск делается полным перебором через умножение матриц. Когда векторов
+становится много, строится кластеризация (IVF): векторы распределяются по кластерам k-means,
+а при поиске просматриваются только несколько ближайших к запросу кластеров.
+
+Найденные кандидаты потом перепроверяются классификатором детектора синонимичности.
+
+18.10.2026 Начальная реализация для RubertSynonymyDetector
+18.10.2026 Кластерный поиск просматривает дополнительные кластеры, пока не наберет top_k разрешенных текстов
+18.10.2026 Добавление и поиск выполняются под своей блокировкой, так как поиск идет из нескольких потоков
+18.10.2026 Кластеризацию можно построить заранее (update_clusters), например при загрузке профиля
+18.10.2026 В индексе хранятся только факты БЗ профиля, векторы прочих текстов передаются в search и не запоминаются
+"""
+
+import logging
+import threading
+
+import numpy as np
+
+
+class SentenceVectorsIndex(object):
+    def __init__(self, ivf_min_size=10000, nb_probes=8):
+        """
+        :param ivf_min_size: при таком и большем числе векторов используется кластерный поиск, иначе полный перебор
+        :param nb_probes: сколько ближайших кластеров просматривать при кластерном поиске как минимум; если в них
+                          меньше top_k разрешенных текстов, просматриваются следующие по близости кластеры
+        """
+        self.ivf_min_size = ivf_min_size
+        self.nb_probes = nb_probes
+        self.texts = []
+        self.text2index = dict()
+        self.vectors = None
+        self.centroids = None
+        self.cluster2indeces = None
+        self.nb_clustered = 0
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('SentenceVectorsIndex')
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __contains__(self, text):
+        return text in self.text2index
+
+    def add(self, texts, vectors):
+        """Добавляем тексты и их векторы, vectors - numpy матрица формы (len(texts), dim)"""
+        vectors = vectors.astype(np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-8)
+
+        with self.lock:
+            self._add(texts, vectors)
+
+    def _add(self, texts, vectors):
+        new_rows = []
+        for text, vector in zip(texts, vectors):
+            if text not in self.text2index:
+                self.text2index[text] = len(self.texts)
+                self.texts.append(text)
+                new_rows.append(vector)
+
+        if new_rows:
+            new_rows = np.stack(new_rows)
+            self.vectors = new_rows if self.vectors is None else np.concatenate((self.vectors, new_rows), axis=0)
+
+            if self.centroids is not None:
+                # Новые векторы приписываем к ближайшим кластерам; при большом приросте кластеризацию перестроим.
+                first_index = len(self.texts) - len(new_rows)
+                for i, cluster in enumerate(np.argmax(new_rows @ self.centroids.T, axis=-1), start=first_index):
+                    self.cluster2indeces[cluster] = np.append(self.cluster2indeces[cluster], i)
+
+    def update_clusters(self):
+        """Строим кластеризацию заранее, если для этого набралось достаточно векторов (иначе она строится при поиске)"""
+        with self.lock:
+            if len(self.texts) >= self.ivf_min_size:
+                self._update_clusters()
+
+    def _update_clusters(self):
+        # При большом приросте числа векторов с прошлой кластеризации она перестраивается
+        if self.centroids is None or len(self.texts) > 1.2 * self.nb_clustered:
+            self.build_clusters()
+
+    def build_clusters(self, nb_iterations=10):
+        nb_clusters = int(np.sqrt(len(self.texts)))
+        self.logger.debug('Building %d clusters for %d vectors', nb_clusters, len(self.texts))
+        rng = np.random.RandomState(123456)
+        centroids = self.vectors[rng.choice(len(self.texts), nb_clusters, replace=False)]
+        for _ in range(nb_iterations):
+            assignment = np.argmax(self.vectors @ centroids.T, axis=-1)
+            for cluster in range(nb_clusters):
+                members = self.vectors[assignment == cluster]
+                if len(members) > 0:
+                    centroid = members.sum(axis=0)
+                    centroids[cluster] = centroid / max(np.linalg.norm(centroid), 1e-8)
+
+        assignment = np.argmax(self.vectors @ centroids.T, axis=-1)
+        self.centroids = centroids
+        self.cluster2indeces = [np.nonzero(assignment == cluster)[0] for cluster in range(nb_clusters)]
+        self.nb_clustered = len(self.texts)
+
+    def search(self, query_vector, allowed_texts, top_k, extra_vectors=None):
+        """
+        Поиск top_k ближайших к query_vector текстов среди allowed_texts.
+        :param extra_vectors: словарь текст => вектор для разрешенных текстов, которых нет в индексе (например, фактов
+                              сессии). Эти векторы участвуют только в этом поиске и в индекс не добавляются.
+        """
+        query_vector = query_vector.astype(np.float32)
+        query_vector /= max(np.linalg.norm(query_vector), 1e-8)
+
+        with self.lock:
+            texts, sims = self._search(query_vector, allowed_texts, top_k)
+
+        if extra_vectors:
+            vectors = np.stack(list(extra_vectors.values())).astype(np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-8)
+            texts = texts + list(extra_vectors.keys())
+            sims = np.concatenate((sims, vectors @ query_vector))
+
+        best = np.argsort(-sims)[:top_k]
+        return [texts[i] for i in best]
+
+    def _search(self, query_vector, allowed_texts, top_k):
+        """Кандидаты из индекса: список текстов и их близостей к запросу"""
+        allowed = set(self.text2index[text] for text in allowed_texts if text in self.text2index)
+        if len(self.texts) < self.ivf_min_size or len(allowed) <= top_k:
+            row_indeces = np.array(sorted(allowed), dtype=np.int64)
+        else:
+            self._update_clusters()
+
+            # В индексе лежат все варианты всех фактов, а разрешена обычно только небольшая их часть,
+            # поэтому в ближайших кластерах разрешенных текстов может не хватить.
+            found = []
+            for nb_probed, cluster in enumerate(np.argsort(-(self.centroids @ query_vector)), start=1):
+                found.extend(i for i in self.cluster2indeces[cluster] if i in allowed)
+                if nb_probed >= self.nb_probes and len(found) >= top_k:
+                    break
+            row_indeces = np.array(found, dtype=np.int64)
+
+        if len(row_indeces) == 0:
+            return [], np.zeros(0, dtype=np.float32)
+
+        return [self.texts[i] for i in row_indeces], self.vectors[row_indeces] @ query_vector
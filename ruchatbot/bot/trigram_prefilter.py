@@ -0,0 +1,74 @@
+"""
+Быстрый лексический отбор кандидатов перед тяжелой нейросетевой оценкой релевантности.
+
+По аналогии с CorpusSearcher из preparation/corpus_searcher.py строится инвертированный индекс
+символьных триграмм фактов. Для запроса берутся N фактов с наибольшим числом общих триграмм,
+и только они затем оцениваются моделью rubert+классификатор.
+
+18.10.2026 Начальная реализация для RubertRelevancyDetector
+18.10.2026 Индекс пополняется и читается под своей блокировкой, так как поиск идет из нескольких потоков
+18.10.2026 В индексе только факты БЗ профиля (add_texts), триграммы прочих текстов считаются при поиске и не запоминаются
+"""
+
+import collections
+import math
+import threading
+
+
+BEG_CHAR = '['
+END_CHAR = ']'
+
+
+def text_shingles(text):
+    s = BEG_CHAR + text.lower() + END_CHAR
+    return set(''.join(z) for z in zip(s, s[1:], s[2:]))
+
+
+class TrigramPrefilter(object):
+    def __init__(self):
+        self.shingle2texts = collections.defaultdict(set)
+        self.text2nb_shingles = dict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.text2nb_shingles)
+
+    def add_texts(self, texts):
+        """Добавляем в индекс тексты фактов БЗ профиля"""
+        with self.lock:
+            for text in texts:
+                if text not in self.text2nb_shingles:
+                    shingles = text_shingles(text)
+                    self.text2nb_shingles[text] = len(shingles)
+                    for shingle in shingles:
+                        self.shingle2texts[shingle].add(text)
+
+    def select_candidates(self, query, premises, nb_candidates):
+        """
+        Из списка фактов premises (кортежи в формате enumerate_facts) отбираем не более nb_candidates
+        лексически наиболее похожих на query. Порядок фактов в результате сохраняется исходный.
+        """
+        if not nb_candidates or len(premises) <= nb_candidates:
+            return premises
+
+        query_shingles = text_shingles(query)
+        text2hits = collections.Counter()
+        with self.lock:
+            for shingle in query_shingles:
+                if shingle in self.shingle2texts:
+                    text2hits.update(self.shingle2texts[shingle])
+            nb_shingles = [self.text2nb_shingles.get(premise[0]) for premise in premises]
+
+        # Нормируем число совпавших триграмм на длины, чтобы длинные факты не получали преимущество.
+        norm = math.sqrt(max(1, len(query_shingles)))
+        scores = []
+        for premise, nb in zip(premises, nb_shingles):
+            if nb is None:
+                # Факты сессии и временные предпосылки хода в общий индекс не попадают, их триграммы считаем здесь
+                shingles = text_shingles(premise[0])
+                nb_hits, nb = len(shingles & query_shingles), len(shingles)
+            else:
+                nb_hits = text2hits.get(premise[0], 0)
+            scores.append(nb_hits / (norm * math.sqrt(max(1, nb))))
+        best_indeces = sorted(range(len(premises)), key=lambda i: -scores[i])[:nb_candidates]
+        return [premises[i] for i in sorted(best_indeces)]
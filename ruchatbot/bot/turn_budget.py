@@ -0,0 +1,47 @@
+"""
+Бюджет времени на обработку одной реплики собеседника.
+
+Перед запуском необязательной дорогой стадии (конфабуляция, дополнительные контексты интерпретатора,
+оценка маловероятных кандидатов, глубокая валидация) BotCore спрашивает, хватит ли на нее оставшегося времени.
+Если не хватает, стадия пропускается или сокращается, а ее название запоминается для лога.
+
+18.10.2026 Начальная реализация
+"""
+
+import threading
+import time
+
+
+class TurnBudget(object):
+    def __init__(self, budget_seconds=None):
+        """
+        :param budget_seconds: время на ход в секундах, None или 0 - без ограничения
+        """
+        self.budget_seconds = budget_seconds
+        self.started = time.monotonic()
+        self.degraded_stages = []
+        self.lock = threading.Lock()
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        if not self.budget_seconds:
+            return float('inf')
+        return self.budget_seconds - self.elapsed()
+
+    def allows(self, stage, min_seconds):
+        """
+        Можно ли запускать стадию stage, которой нужно не меньше min_seconds. Если нельзя, то стадия
+        считается деградировавшей.
+        """
+        if self.remaining() >= min_seconds:
+            return True
+
+        with self.lock:
+            if stage not in self.degraded_stages:
+                self.degraded_stages.append(stage)
+        return False
+
+    def __repr__(self):
+        return 'elapsed={:.3f} budget={} degraded=[{}]'.format(self.elapsed(), self.budget_seconds, ', '.join(self.degraded_stages))
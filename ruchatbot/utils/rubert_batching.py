@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Общий для детекторов на базе rubert код подготовки батчей и прогона текстов через rubert.
+
+Класс-примесь ожидает у детектора атрибуты max_len, device, bert_tokenizer, tokens_store, bert_model и traced_bert.
+
+18.10.2026 Вынесено из RubertRelevancyDetector и RubertSynonymyDetector
+18.10.2026 Убран динамический паддинг: головы классификаторов обучены на паддинге до max_len без маски внимания
+"""
+
+import numpy as np
+import torch
+
+
+class RubertBatchingMixin(object):
+    def split_batches(self, tokens_list, batch_size):
+        """Разбиваем индексы текстов на батчи не более чем по batch_size текстов"""
+        indeces = list(range(len(tokens_list)))
+        return [indeces[i: i+batch_size] for i in range(0, len(indeces), batch_size)]
+
+    def pad_batch(self, tokens_batch):
+        """
+        Готовим входной тензор для rubert из списков (или numpy-массивов) токенов. Головы классификаторов обучены
+        на текстах, дополненных нулями до max_len без маски внимания, поэтому так же готовятся и все входы при инференсе.
+        """
+        ids = np.zeros((len(tokens_batch), self.max_len), dtype=np.int64)
+        for i, tokens in enumerate(tokens_batch):
+            l = min(len(tokens), self.max_len)
+            ids[i, :l] = tokens[:l]
+        return torch.from_numpy(ids).to(self.device)
+
+    def encode_texts(self, texts):
+        """Токенизация текстов; если подключено хранилище токенов, то токены фактов берутся готовыми"""
+        if self.tokens_store is not None:
+            return self.tokens_store.encode_batch(texts)
+        return [self.bert_tokenizer.encode(text) for text in texts]
+
+    def run_bert(self, z):
+        if self.traced_bert is not None:
+            # Трассированный rubert экспортирован с маской внимания на входе, паддинг в нем не маскируется, как и при обучении
+            return self.traced_bert(z, torch.ones_like(z))
+        return self.bert_model(z)[0]
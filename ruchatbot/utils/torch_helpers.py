@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+import functools
+
+
+def synchronized(method):
+    """Декоратор для методов моделей, которые используют общие кэши и буферы: вызовы из разных потоков выполняются по очереди под self.lock"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
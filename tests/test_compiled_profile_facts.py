@@ -0,0 +1,138 @@
+"""
+Скомпилированный кэш БЗ профиля: загрузка из кэша дает те же факты и токены, что и разбор текстовых файлов,
+а изменение исходных файлов делает кэш и общую для процесса БЗ устаревшими.
+"""
+
+import io
+import os
+
+from ruchatbot.bot import profile_facts_reader
+from ruchatbot.bot.profile_facts_reader import ProfileKnowledgeBase, get_profile_knowledge_base
+
+
+PROFILE_FACTS = '''# комментарий
+## profile_section: 1s
+Меня зовут $name|Мое имя $name
+Я живу в Москве
+## import "common_facts.txt"
+## profile_section: 2s
+Я люблю зеленый чай|Мой любимый напиток - чай|Я пью чай
+'''
+
+COMMON_FACTS = '''Я чатбот
+# комментарий
+Мне нравится общаться
+'''
+
+
+class TextUtilsStub(object):
+    def canonize_text(self, s):
+        return s
+
+
+class BertTokenizerStub(object):
+    name_or_path = 'tokenizer-stub'
+
+    def __init__(self):
+        self.nb_calls = 0
+
+    def __call__(self, texts, add_special_tokens=True):
+        self.nb_calls += 1
+        return {'input_ids': [[2] + [len(word) for word in text.split()] + [3] for text in texts]}
+
+
+def write_text(path, text):
+    with io.open(str(path), 'w', encoding='utf-8') as wrt:
+        wrt.write(text)
+
+
+def touch_later(path):
+    # Сдвигаем время модификации явно, так как на некоторых ФС его разрешение грубое
+    st = os.stat(str(path))
+    os.utime(str(path), ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def make_profile(tmp_path):
+    write_text(tmp_path / 'facts.txt', PROFILE_FACTS)
+    write_text(tmp_path / 'common_facts.txt', COMMON_FACTS)
+    write_text(tmp_path / 'profile.json', '{"name": "Вика"}')
+    return str(tmp_path / 'facts.txt'), str(tmp_path / 'profile.json'), str(tmp_path / 'profile_facts.bin')
+
+
+def test_compiled_facts_match_parsed(tmp_path):
+    profile_path, config_path, compiled_path = make_profile(tmp_path)
+    constants = {'name': 'Вика'}
+
+    parsed = ProfileKnowledgeBase(profile_path, constants, config_path)
+    parsed.load(TextUtilsStub())
+    assert [entry[0] for entry in parsed.entries] == [('Меня зовут Вика', 'Мое имя Вика'), ('Я живу в Москве',),
+                                                      ('Я чатбот',), ('Мне нравится общаться',),
+                                                      ('Я люблю зеленый чай', 'Мой любимый напиток - чай', 'Я пью чай')]
+    assert len(parsed.source_mtimes) == 3
+
+    tokenizer = BertTokenizerStub()
+    parsed.save_compiled(compiled_path, tokenizer)
+
+    compiled = ProfileKnowledgeBase.load_compiled(compiled_path, profile_path, constants, config_path, tokenizer)
+    assert compiled is not None
+    assert compiled.entries == parsed.entries
+    assert compiled.variant_entries == parsed.variant_entries == [0, 4]
+
+    expected_tokens = tokenizer(list(parsed.enumerate_all_texts()))['input_ids']
+    for text, tokens in zip(parsed.enumerate_all_texts(), expected_tokens):
+        assert compiled.text_tokens[text].tolist() == tokens
+
+    choices = compiled.choose_variants()
+    assert [fact[0] for fact in compiled.enumerate_facts(choices)] == [fact[0] for fact in parsed.enumerate_facts(choices)]
+
+    # Кэш для других констант или другого токенизатора не подходит
+    assert ProfileKnowledgeBase.load_compiled(compiled_path, profile_path, {'name': 'Лена'}, config_path) is None
+    other_tokenizer = BertTokenizerStub()
+    other_tokenizer.name_or_path = 'other-tokenizer'
+    assert ProfileKnowledgeBase.load_compiled(compiled_path, profile_path, constants, config_path, other_tokenizer) is None
+
+
+def test_changed_sources_invalidate_cache(tmp_path):
+    profile_path, config_path, compiled_path = make_profile(tmp_path)
+    constants = {'name': 'Вика'}
+    tokenizer = BertTokenizerStub()
+
+    knowledge_base = ProfileKnowledgeBase(profile_path, constants, config_path)
+    knowledge_base.load(TextUtilsStub())
+    knowledge_base.save_compiled(compiled_path, tokenizer)
+
+    # Изменение импортируемого файла тоже должно учитываться
+    write_text(tmp_path / 'common_facts.txt', COMMON_FACTS + 'Я умею шутить\n')
+    touch_later(tmp_path / 'common_facts.txt')
+    assert knowledge_base.is_stale()
+    assert ProfileKnowledgeBase.load_compiled(compiled_path, profile_path, constants, config_path, tokenizer) is None
+
+
+def test_shared_knowledge_base_is_reloaded_after_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(profile_facts_reader, '_knowledge_bases', dict())
+    monkeypatch.setattr(profile_facts_reader, '_compiled_settings', dict())
+
+    profile_path, config_path, compiled_path = make_profile(tmp_path)
+    constants = {'name': 'Вика'}
+    text_utils = TextUtilsStub()
+    tokenizer = BertTokenizerStub()
+
+    # Первая загрузка - разбор текста и компиляция кэша
+    kb1 = get_profile_knowledge_base(profile_path, constants, text_utils, compiled_path, config_path, tokenizer)
+    assert kb1.compiled_mm is None and os.path.exists(compiled_path)
+    assert get_profile_knowledge_base(profile_path, constants, text_utils) is kb1
+
+    # Новый процесс: БЗ читается из актуального кэша без повторной токенизации
+    monkeypatch.setattr(profile_facts_reader, '_knowledge_bases', dict())
+    nb_calls = tokenizer.nb_calls
+    kb2 = get_profile_knowledge_base(profile_path, constants, text_utils, compiled_path, config_path, tokenizer)
+    assert kb2.compiled_mm is not None and kb2.entries == kb1.entries
+    assert tokenizer.nb_calls == nb_calls
+
+    # После изменения файла фактов БЗ перечитывается, кэш пересобирается
+    write_text(tmp_path / 'facts.txt', PROFILE_FACTS + 'Я учусь в университете\n')
+    touch_later(tmp_path / 'facts.txt')
+    kb3 = get_profile_knowledge_base(profile_path, constants, text_utils)
+    assert kb3 is not kb2 and kb3.compiled_mm is None
+    assert kb3.entries[-1][0] == ('Я учусь в университете',)
+    assert ProfileKnowledgeBase.load_compiled(compiled_path, profile_path, constants, config_path, tokenizer).entries == kb3.entries
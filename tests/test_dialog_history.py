@@ -0,0 +1,116 @@
+"""
+Инкрементно поддерживаемые шаги диалога в DialogHistory должны давать те же контексты, что и полный проход по истории.
+"""
+
+import random
+
+import pytest
+
+from ruchatbot.bot.dialog_history import DialogHistory
+
+
+def naive_steps(messages, get_text):
+    # Исходный алгоритм: полный проход по всем репликам со склейкой подряд идущих реплик одной стороны
+    steps = []
+    for i, message in enumerate(messages):
+        msg_text = get_text(i, message)
+        prev_side = messages[i-1].who if i > 0 else ''
+        if prev_side != message.who:
+            steps.append(msg_text)
+        else:
+            s = steps[-1]
+            if s[-1] not in '.?!;:':
+                s += '.'
+            steps[-1] = s + ' ' + msg_text
+    return steps
+
+
+def naive_interpreter_contexts(messages):
+    messages2 = [m for m in messages if not m.is_command()]
+
+    def get_text(i, message):
+        msg_text = message.get_interpretation()
+        return message.get_text() if msg_text is None else msg_text
+
+    steps = naive_steps(messages2, get_text)
+    contexts = set(' | '.join(steps[-n:]) for n in range(2, 4))
+    return sorted(list(contexts), key=lambda s: -len(s))
+
+
+def naive_entailment_context(messages):
+    return ' | '.join(naive_steps(messages, lambda i, message: message.get_text())[-2:])
+
+
+def naive_chitchat_context(messages, last_utterance_interpretation, max_depth, include_commands):
+    def get_text(i, message):
+        if i == len(messages)-1 and last_utterance_interpretation:
+            return last_utterance_interpretation
+        return message.get_text()
+
+    # Склейка смотрит на соседа в полной истории, поэтому команды пропускаются уже после вычисления prev_side
+    steps = []
+    for i, message in enumerate(messages):
+        if not include_commands and message.is_command():
+            continue
+        msg_text = get_text(i, message)
+        prev_side = messages[i-1].who if i > 0 else ''
+        if prev_side != message.who:
+            steps.append(msg_text)
+        else:
+            s = steps[-1]
+            if s[-1] not in '.?!;:':
+                s += '.'
+            steps[-1] = s + ' ' + msg_text
+    return steps[-max_depth:]
+
+
+def random_dialog(rng, nb_messages):
+    dialog = DialogHistory('test')
+    for i in range(nb_messages):
+        who = rng.choice('HHBBX')
+        text = 'реплика {}{}'.format(i, rng.choice(['', '.', '?']))
+        if who == 'H':
+            dialog.add_human_message(text)
+        elif who == 'B':
+            dialog.add_bot_message(text, self_interpretation=rng.choice([None, 'интерпретация {}'.format(i)]))
+        else:
+            dialog.add_command('[команда {}]'.format(i))
+
+        if who == 'H' and rng.random() < 0.5:
+            dialog.set_last_message_interpretation('интерпретация {}'.format(i))
+    return dialog
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_incremental_contexts_match_full_rebuild(seed):
+    rng = random.Random(seed)
+    # Длина истории - и меньше, и больше буфера шагов
+    dialog = random_dialog(rng, rng.randint(1, 40))
+    messages = list(dialog.messages)
+
+    assert dialog.constuct_interpreter_contexts() == naive_interpreter_contexts(messages)
+    assert dialog.construct_entailment_context() == naive_entailment_context(messages)
+    for include_commands in (False, True):
+        for last_interpretation in (None, 'моя интерпретация'):
+            expected = naive_chitchat_context(messages, last_interpretation, 10, include_commands)
+            assert dialog.construct_chitchat_context(last_interpretation, None, max_depth=10, include_commands=include_commands) == expected
+
+
+def test_chitchat_context_labels():
+    dialog = DialogHistory('test')
+    dialog.add_human_message('привет')
+    dialog.add_bot_message('привет!')
+    dialog.add_human_message('как дела?')
+    assert dialog.construct_chitchat_context(None, ['метка', 'другая метка.']) == ['привет', 'привет!', 'как дела?', '[метка. другая метка.]']
+
+
+def test_message_buffer_is_bounded():
+    dialog = DialogHistory('test')
+    for i in range(DialogHistory.max_messages * 2):
+        dialog.add_human_message('реплика {}'.format(i))
+        dialog.add_bot_message('ответ {}'.format(i))
+
+    assert len(dialog) == DialogHistory.max_messages * 4
+    assert len(dialog.messages) == DialogHistory.max_messages
+    assert len(dialog.all_steps) == DialogHistory.max_context_depth
+    assert dialog.pop_reply() == 'ответ 0'
@@ -0,0 +1,66 @@
+"""
+Сравнение облегченного декодера LeanDecoder с прямым прогоном GPT2LMHeadModel на маленькой случайной модели.
+"""
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+from ruchatbot.bot.rugpt_base import LeanDecoder
+
+
+def make_model(**config_kwargs):
+    torch.manual_seed(123)
+    config = transformers.GPT2Config(vocab_size=60, n_positions=64, n_embd=32, n_layer=2, n_head=4, **config_kwargs)
+    model = transformers.GPT2LMHeadModel(config)
+    model.eval()
+    return model
+
+
+def test_prompt_logits_match_model():
+    model = make_model()
+    decoder = LeanDecoder(model)
+
+    # Вторая строка дополнена слева двумя pad-токенами
+    input_ids = torch.tensor([[5, 6, 7, 8, 9], [0, 0, 11, 12, 13]])
+    attention_mask = torch.tensor([[1, 1, 1, 1, 1], [0, 0, 1, 1, 1]])
+    position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+
+    with torch.no_grad():
+        expected = model(input_ids, attention_mask=attention_mask, position_ids=position_ids)[0]
+        decoder.allocate(2, 5)
+        actual = decoder.forward(input_ids, position_ids, attention_mask, 0, all_logits=True)
+
+    # Логиты на позициях паддинга не используются
+    assert torch.allclose(actual[0], expected[0], atol=1e-5)
+    assert torch.allclose(actual[1, 2:], expected[1, 2:], atol=1e-5)
+
+
+def test_incremental_steps_match_model():
+    model = make_model()
+    decoder = LeanDecoder(model)
+
+    tokens = torch.tensor([[3, 14, 15, 9, 26, 5, 35, 8]])
+    attention_mask = torch.ones_like(tokens)
+    position_ids = torch.arange(tokens.shape[1]).unsqueeze(0)
+
+    with torch.no_grad():
+        expected = model(tokens)[0]
+        decoder.allocate(1, tokens.shape[1])
+        # Промпт из 5 токенов, затем по одному токену на шаг с записью в буферы
+        logits = [decoder.forward(tokens[:, :5], position_ids[:, :5], attention_mask, 0)]
+        for i in range(5, tokens.shape[1]):
+            logits.append(decoder.forward(tokens[:, i:i+1], position_ids[:, i:i+1], attention_mask, i))
+
+    for step, step_logits in enumerate(logits):
+        assert torch.allclose(step_logits[0], expected[0, 4 + step], atol=1e-5)
+
+
+@pytest.mark.parametrize('flag,value', [('scale_attn_by_inverse_layer_idx', True),
+                                        ('reorder_and_upcast_attn', True),
+                                        ('scale_attn_weights', False)])
+def test_unsupported_config_flags(flag, value):
+    model = make_model(**{flag: value})
+    with pytest.raises(ValueError):
+        LeanDecoder(model)
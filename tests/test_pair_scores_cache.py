@@ -0,0 +1,44 @@
+"""
+Общий кэш скоров пар (запрос, факт): LRU-вытеснение, инвалидация по фактам и статистика попаданий.
+"""
+
+from ruchatbot.bot.pair_scores_cache import PairScoresCache
+
+
+def test_get_and_put_scores():
+    cache = PairScoresCache()
+    assert cache.get_scores('relevancy', 'как тебя зовут?', ['меня зовут Вика', 'я люблю чай']) == [None, None]
+
+    cache.put_scores('relevancy', 'как тебя зовут?', ['меня зовут Вика'], [0.9])
+    # Лишние пробелы в запросе не влияют на ключ, а другая модель скоров не видит
+    assert cache.get_scores('relevancy', ' как  тебя зовут? ', ['меня зовут Вика', 'я люблю чай']) == [0.9, None]
+    assert cache.get_scores('synonymy', 'как тебя зовут?', ['меня зовут Вика']) == [None]
+
+    assert cache.get_hit_rate('relevancy') == 1 / 4.0
+    assert cache.get_hit_rate() == 1 / 5.0
+
+
+def test_lru_eviction():
+    cache = PairScoresCache(max_size=2)
+    cache.put_scores('relevancy', 'q', ['f1', 'f2'], [0.1, 0.2])
+    # f1 использовался последним, поэтому вытесняется f2
+    cache.get_scores('relevancy', 'q', ['f1'])
+    cache.put_scores('relevancy', 'q', ['f3'], [0.3])
+
+    assert len(cache) == 2
+    assert cache.get_scores('relevancy', 'q', ['f1', 'f2', 'f3']) == [0.1, None, 0.3]
+    assert 'f2' not in cache.fact2keys
+
+
+def test_invalidate_facts():
+    cache = PairScoresCache()
+    cache.put_scores('relevancy', 'q1', ['f1', 'f2'], [0.1, 0.2])
+    cache.put_scores('synonymy', 'q2', ['f1'], [0.5])
+
+    cache.invalidate_facts(['f1'])
+    assert cache.get_scores('relevancy', 'q1', ['f1', 'f2']) == [None, 0.2]
+    assert cache.get_scores('synonymy', 'q2', ['f1']) == [None]
+    assert len(cache) == 1
+
+    cache.clear()
+    assert len(cache) == 0
@@ -0,0 +1,122 @@
+"""
+Кэш префиксов промптов генеративной модели: вспомогательные функции, PrefixCache и генерация через model.generate
+с past_key_values общего префикса.
+"""
+
+import concurrent.futures
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+from ruchatbot.bot.rugpt_base import RugptBase, PrefixCache, common_prefix_len, crop_past, expand_past
+
+
+def test_common_prefix_len():
+    assert common_prefix_len([]) == 0
+    assert common_prefix_len([[1, 2, 3]]) == 3
+    assert common_prefix_len([[1, 2, 3], [1, 2, 4], [1, 2]]) == 2
+    assert common_prefix_len([[1, 2], [3, 2]]) == 0
+    assert common_prefix_len([(1, 2, 3), [1, 2, 3, 4]]) == 3
+
+
+def make_past(nb_layers=2, seq_len=6):
+    return tuple((torch.randn(1, 4, seq_len, 8), torch.randn(1, 4, seq_len, 8)) for _ in range(nb_layers))
+
+
+def test_crop_and_expand_past():
+    past = make_past()
+    cropped = crop_past(past, 4)
+    assert len(cropped) == 2
+    for (k, v), (k0, v0) in zip(cropped, past):
+        assert k.shape == (1, 4, 4, 8) and v.shape == (1, 4, 4, 8)
+        assert torch.equal(k, k0[:, :, :4]) and torch.equal(v, v0[:, :, :4])
+
+    expanded = expand_past(cropped, 3)
+    for k, v in expanded:
+        assert k.shape == (3, 4, 4, 8)
+        assert torch.equal(k[2], k[0])
+
+
+def test_prefix_cache_lru():
+    cache = PrefixCache(max_entries=2)
+    cache.add([1, 2, 3], 'past123', [0.1, 0.2])
+    cache.add([1, 5], 'past15', [0.3])
+
+    n, past, logprobs = cache.find([1, 2, 3, 4])
+    assert (n, past, logprobs) == (3, 'past123', [0.1, 0.2])
+    assert cache.find([7, 8]) == (0, None, [])
+
+    # [1, 2, 3] только что использовался, поэтому вытесняется [1, 5]
+    cache.add([9], 'past9', [])
+    assert cache.find([1, 5])[1] == 'past123'
+    assert len(cache) == 2
+
+    cache.resize(1)
+    assert len(cache) == 1
+
+
+def make_gpt():
+    torch.manual_seed(123)
+    config = transformers.GPT2Config(vocab_size=60, n_positions=64, n_embd=32, n_layer=2, n_head=4)
+    gpt = RugptBase()
+    gpt.device = torch.device('cpu')
+    gpt.model = transformers.GPT2LMHeadModel(config)
+    gpt.model.eval()
+    gpt.eos_tokens_mask = torch.zeros(config.vocab_size, dtype=torch.bool)
+    # top_k=1 делает сэмплирование детерминированным
+    gpt.beam_k = 1
+    return gpt
+
+
+def test_prefix_cache_reference_counting():
+    gpt = make_gpt()
+    gpt.start_prefix_cache()
+    gpt.start_prefix_cache()
+    assert gpt.prefix_cache.max_entries == 2 * gpt.prefix_cache_entries
+
+    gpt.clear_prefix_cache()
+    assert gpt.prefix_cache is not None
+    assert gpt.prefix_cache.max_entries == gpt.prefix_cache_entries
+
+    gpt.clear_prefix_cache()
+    assert gpt.prefix_cache is None
+
+
+def test_generate_with_prefix_cache_matches_plain_generate():
+    gpt = make_gpt()
+    rows = [[5, 6, 7, 8, 9, 10], [5, 6, 7, 8, 11], [5, 6, 7, 8, 12, 13, 14]]
+
+    expected = gpt.sample_with_generate(rows, 8, 1.0)
+
+    gpt.start_prefix_cache()
+    try:
+        actual = gpt.sample_with_generate(rows, 8, 1.0)
+        assert len(gpt.prefix_cache) == 1
+        # Повторный вызов берет префикс из кэша
+        assert gpt.sample_with_generate(rows, 8, 1.0) == expected
+    finally:
+        gpt.clear_prefix_cache()
+
+    assert actual == expected
+
+
+def test_generate_from_several_threads():
+    gpt = make_gpt()
+    rows = [[5, 6, 7, 8, 9, 10], [5, 6, 7, 8, 11]]
+    expected = gpt.sample_with_generate(rows, 8, 1.0)
+
+    # Как ветки ответа BotCore: каждый поток начинает и заканчивает свой ход, генерация идет без общей блокировки модели
+    def run_turn(_):
+        gpt.start_prefix_cache()
+        try:
+            return gpt.sample_with_generate(rows, 8, 1.0)
+        finally:
+            gpt.clear_prefix_cache()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(run_turn, range(16)))
+
+    assert all(result == expected for result in results)
+    assert gpt.prefix_cache_users == 0 and gpt.prefix_cache is None
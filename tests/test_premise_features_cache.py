@@ -0,0 +1,40 @@
+"""
+Кэш признаков фактов БЗ детектора релевантности: привязка к хэшам весов rubert и головы классификатора.
+"""
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from ruchatbot.bot.premise_features_cache import PremiseFeaturesCache
+from ruchatbot.bot.rubert_relevancy_detector import RubertRelevancyDetector
+
+
+@pytest.mark.parametrize('arch', [1, 2, 3])
+def test_head_hash_covers_only_head_weights(arch):
+    torch.manual_seed(123)
+    detector = RubertRelevancyDetector(device=torch.device('cpu'), arch=arch, max_len=16, sent_emb_size=8)
+    head_hash = detector.calc_head_hash()
+
+    # Подключенные rubert и трассированные модели не меняют хэш головы
+    detector.bert_model = torch.nn.Linear(8, 8)
+    detector.traced_bert = torch.nn.Linear(8, 8)
+    assert detector.calc_head_hash() == head_hash
+
+    with torch.no_grad():
+        detector.fc1.weight.add_(1.0)
+    assert detector.calc_head_hash() != head_hash
+
+
+def test_cache_is_dropped_when_weights_change(tmp_path):
+    cache_path = str(tmp_path / 'premises_cache.pt')
+    cache = PremiseFeaturesCache('bert1', 'head1')
+    cache.add('кошка спит', torch.ones(4))
+    cache.save(cache_path)
+
+    loaded = PremiseFeaturesCache('bert1', 'head1')
+    assert loaded.load(cache_path)
+    assert torch.equal(loaded.stack_features(['кошка спит'], torch.device('cpu')), torch.ones(1, 4))
+
+    assert not PremiseFeaturesCache('bert2', 'head1').load(cache_path)
+    assert not PremiseFeaturesCache('bert1', 'head2').load(cache_path)
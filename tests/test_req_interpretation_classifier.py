@@ -0,0 +1,62 @@
+"""
+Классификатор необходимости интерпретации реплик: обучение, предсказание и сохранение модели.
+"""
+
+import numpy as np
+
+from ruchatbot.bot.req_interpretation_classifier import ReqInterpretationClassifier, text_features
+
+
+# 1 - реплика неполная (анафора, эллипсис), нужна интерпретация; 0 - самодостаточная
+SAMPLES = [('а ты?', 1), ('почему?', 1), ('и я тоже', 1), ('а он?', 1), ('зачем?', 1), ('а где?', 1),
+           ('а тебе?', 1), ('тоже', 1), ('и она', 1), ('а почему?', 1), ('а кто?', 1), ('он тоже', 1),
+           ('я люблю кошек', 0), ('как тебя зовут?', 0), ('где ты живешь?', 0), ('сколько тебе лет?', 0),
+           ('я работаю программистом', 0), ('какой твой любимый цвет?', 0), ('я живу в москве', 0),
+           ('ты любишь зеленый чай?', 0), ('меня зовут вика', 0), ('чем ты занимаешься?', 0),
+           ('у меня есть собака', 0), ('какую музыку ты слушаешь?', 0)]
+
+
+def train_model():
+    np.random.seed(123)
+    model = ReqInterpretationClassifier(nb_buckets=1 << 12)
+    texts, labels = zip(*SAMPLES)
+    model.fit(texts, labels, nb_epochs=30, batch_size=8)
+    return model
+
+
+def test_text_features_are_deterministic():
+    x1 = text_features('Как  тебя зовут?', 1 << 12, 4)
+    x2 = text_features('как тебя зовут?', 1 << 12, 4)
+    assert np.array_equal(x1, x2)
+    assert x1.dtype == np.int64 and np.all(x1 < (1 << 12)) and np.all(np.diff(x1) >= 0)
+
+
+def test_fit_and_predict():
+    model = train_model()
+    predictions = [model.predict(text) for text, _ in SAMPLES]
+    assert all(0.0 < p < 1.0 for p in predictions)
+    assert np.mean([(p > 0.5) == (label == 1) for p, (_, label) in zip(predictions, SAMPLES)]) >= 0.9
+
+    # Неполные реплики, которых не было в обучении
+    assert model.predict('а ты где?') > model.predict('я люблю собак')
+
+
+def test_sample_weights():
+    # Нулевой вес примеров класса 1 - модель не должна их выучить
+    np.random.seed(123)
+    model = ReqInterpretationClassifier(nb_buckets=1 << 12)
+    texts, labels = zip(*SAMPLES)
+    model.fit(texts, labels, weights=[1.0 - label for label in labels], nb_epochs=30, batch_size=8)
+    assert all(model.predict(text) < 0.5 for text, _ in SAMPLES)
+
+
+def test_save_and_load(tmp_path):
+    model = train_model()
+    model_path = str(tmp_path / 'req_interpretation.npz')
+    model.save(model_path)
+
+    loaded = ReqInterpretationClassifier()
+    loaded.load(model_path)
+    assert loaded.nb_buckets == model.nb_buckets and loaded.max_ngram == model.max_ngram
+    for text, _ in SAMPLES:
+        assert abs(loaded.predict(text) - model.predict(text)) < 1e-6
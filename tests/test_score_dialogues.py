@@ -0,0 +1,90 @@
+"""
+Батчевая оценка диалогов в RugptChitchat.score_dialogues: скоры совпадают с поштучным exp(-loss) модели
+и не зависят от соседей по батчу, в том числе при использовании кэша префиксов.
+"""
+
+import math
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+from ruchatbot.bot.rugpt_chitchat2 import RugptChitchat
+
+
+VOCAB_SIZE = 64
+
+
+class CharTokenizerStub(object):
+    """Посимвольный токенизатор: для проверки батчинга важны только разные длины и общие префиксы текстов"""
+    def encode(self, text):
+        return [1 + ord(c) % (VOCAB_SIZE - 1) for c in text]
+
+
+DIALOGUES = [['- Привет!', '- Привет, как дела?'],
+             ['- Привет!', '- Здравствуй.'],
+             ['- Привет!', '- Привет, как тебя зовут? Меня зовут Вика, а тебя?', '- Коля.'],
+             ['- Привет!', '- Ку'],
+             ['- Как дела?', '- Хорошо, спасибо. А у тебя?']]
+
+
+def make_chitchat():
+    torch.manual_seed(123)
+    config = transformers.GPT2Config(vocab_size=VOCAB_SIZE, n_positions=128, n_embd=32, n_layer=2, n_head=4)
+    chitchat = RugptChitchat()
+    chitchat.device = torch.device('cpu')
+    chitchat.tokenizer = CharTokenizerStub()
+    chitchat.model = transformers.GPT2LMHeadModel(config)
+    chitchat.model.eval()
+    return chitchat
+
+
+def reference_scores(chitchat, dialogues):
+    # Исходная реализация: каждый диалог отдельно, loss считает сама модель
+    scores = []
+    for dialog in dialogues:
+        t = torch.tensor([chitchat.tokenizer.encode('<s>{chitchat}\n' + '\n'.join(dialog))])
+        with torch.no_grad():
+            loss = chitchat.model(t, labels=t)[0]
+        scores.append(math.exp(-loss.item()))
+    return scores
+
+
+@pytest.mark.parametrize('use_prefix_cache', [False, True])
+@pytest.mark.parametrize('score_batch_size', [1, 2, 8])
+def test_batched_scores_match_reference(use_prefix_cache, score_batch_size):
+    chitchat = make_chitchat()
+    chitchat.score_batch_size = score_batch_size
+    expected = reference_scores(chitchat, DIALOGUES)
+
+    if use_prefix_cache:
+        chitchat.start_prefix_cache()
+    try:
+        actual = chitchat.score_dialogues(DIALOGUES)
+        # Скор диалога не зависит от того, с какими диалогами он оценивается
+        single = [chitchat.score_dialogues([dialog])[0] for dialog in DIALOGUES]
+    finally:
+        if use_prefix_cache:
+            chitchat.clear_prefix_cache()
+
+    assert actual == pytest.approx(expected, rel=1e-5)
+    assert single == pytest.approx(expected, rel=1e-5)
+
+
+def test_empty_dialogues():
+    assert make_chitchat().score_dialogues([]) == []
+
+
+def test_split_score_batches():
+    chitchat = make_chitchat()
+    chitchat.score_batch_size = 3
+    chitchat.score_batch_tokens = 20
+    texts = [[0] * n for n in (9, 2, 5, 3, 4, 8)]
+
+    batches = chitchat.split_score_batches(texts)
+    # Тексты близкой длины вместе, размер батча с паддингом не больше 20 токенов
+    assert batches == [[1, 3, 4], [2, 5], [0]]
+    for batch in batches:
+        assert len(batch) <= 3
+        assert max(len(texts[i]) for i in batch) * len(batch) <= 20
@@ -0,0 +1,65 @@
+"""
+Индекс векторов предложений для отбора кандидатов в детекторе синонимичности.
+"""
+
+import numpy as np
+
+from ruchatbot.bot.sentence_vectors_index import SentenceVectorsIndex
+
+
+def make_index(nb_texts=200, dim=16, **kwargs):
+    rng = np.random.RandomState(123)
+    texts = ['факт {}'.format(i) for i in range(nb_texts)]
+    vectors = rng.randn(nb_texts, dim)
+    index = SentenceVectorsIndex(**kwargs)
+    index.add(texts, vectors)
+    return index, texts, vectors
+
+
+def brute_force(vectors, texts, query, allowed, top_k):
+    normed = vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+    sims = normed @ (query / np.linalg.norm(query))
+    rows = sorted((i for i, text in enumerate(texts) if text in allowed), key=lambda i: -sims[i])
+    return [texts[i] for i in rows[:top_k]]
+
+
+def test_exact_search_matches_brute_force():
+    index, texts, vectors = make_index()
+    query = vectors[7] + 0.1
+    allowed = set(texts[::2])
+    assert index.search(query, sorted(allowed), 5) == brute_force(vectors, texts, query, allowed, 5)
+
+
+def test_add_skips_known_texts():
+    index, texts, vectors = make_index(nb_texts=10)
+    index.add(texts[:3], vectors[:3] * 2.0)
+    assert len(index) == 10
+    assert 'факт 3' in index and 'другой факт' not in index
+
+
+def test_clustered_search_finds_enough_allowed_texts():
+    index, texts, vectors = make_index(ivf_min_size=50, nb_probes=1)
+    index.update_clusters()
+    assert index.centroids is not None and index.nb_clustered == len(texts)
+
+    # Разрешено мало текстов, в ближайшем кластере их может не быть, но поиск должен набрать top_k
+    allowed = texts[::10]
+    found = index.search(vectors[0], allowed, 5)
+    assert len(found) == 5 and set(found) <= set(allowed)
+    assert found[0] == 'факт 0'
+
+
+def test_update_clusters_skips_small_index():
+    index, _, _ = make_index(nb_texts=20, ivf_min_size=50)
+    index.update_clusters()
+    assert index.centroids is None
+
+
+def test_extra_vectors_are_searched_but_not_stored():
+    index, texts, vectors = make_index(nb_texts=20)
+    query = vectors[3]
+    extra_vectors = {'факт сессии': query * 3.0}
+
+    found = index.search(query, texts + ['факт сессии'], 2, extra_vectors)
+    assert set(found) == {'факт 3', 'факт сессии'}
+    assert 'факт сессии' not in index and len(index) == 20
@@ -0,0 +1,94 @@
+"""
+Спекулятивное декодирование с черновой моделью: при жадном выборе совпадает с обычным декодированием,
+при сэмплировании распределение токенов совпадает с распределением основной модели.
+"""
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+from ruchatbot.bot.rugpt_base import RugptBase, LeanDecoder
+
+
+VOCAB_SIZE = 8
+
+
+def make_model(seed, n_layer):
+    torch.manual_seed(seed)
+    # Крупный разброс весов делает распределения неравномерными, иначе случайные модели почти неотличимы
+    config = transformers.GPT2Config(vocab_size=VOCAB_SIZE, n_positions=64, n_embd=32, n_layer=n_layer, n_head=4,
+                                     initializer_range=0.5)
+    model = transformers.GPT2LMHeadModel(config)
+    model.eval()
+    return model
+
+
+def make_gpt(with_draft=True):
+    gpt = RugptBase()
+    gpt.device = torch.device('cpu')
+    gpt.model = make_model(123, 2)
+    gpt.eos_tokens_mask = torch.zeros(VOCAB_SIZE, dtype=torch.bool)
+    if with_draft:
+        # Черновая модель со своими случайными весами, чтобы часть черновых токенов отвергалась
+        gpt.draft_model = make_model(456, 1)
+        gpt.draft_decoder = LeanDecoder(gpt.draft_model)
+    gpt.speculative_k = 3
+    return gpt
+
+
+@pytest.mark.parametrize('use_prefix_cache', [False, True])
+def test_greedy_speculative_matches_lean(use_prefix_cache):
+    gpt = make_gpt()
+    gpt.beam_k = 1
+    # Строка с токеном 7 после генерации заполняется pad-токенами
+    gpt.eos_tokens_mask[7] = True
+    rows = [[1, 2, 3, 4, 5], [1, 2, 3, 6], [1, 2, 3, 4, 5, 6, 1, 2]]
+
+    expected = gpt.sample_lean(rows, 12, 1.0)
+    if use_prefix_cache:
+        gpt.start_prefix_cache()
+    try:
+        actual = gpt.sample_speculative(rows, 12, 1.0)
+    finally:
+        if use_prefix_cache:
+            gpt.clear_prefix_cache()
+
+    assert actual == expected
+    assert all(len(row) == 12 for row in actual)
+
+
+def exact_marginals(model, prompt, length):
+    """Точные распределения токенов на каждой позиции генерации, перебором всех продолжений"""
+    marginals = []
+    prefixes = [(tuple(), 1.0)]
+    with torch.no_grad():
+        for _ in range(length):
+            input_ids = torch.tensor([list(prompt) + list(prefix) for prefix, _ in prefixes])
+            probs = torch.softmax(model(input_ids)[0][:, -1], dim=-1)
+            marginal = torch.zeros(VOCAB_SIZE, dtype=torch.float64)
+            next_prefixes = []
+            for (prefix, p_prefix), p in zip(prefixes, probs.double()):
+                marginal += p_prefix * p
+                next_prefixes.extend((prefix + (token,), p_prefix * float(p[token])) for token in range(VOCAB_SIZE))
+            marginals.append(marginal)
+            prefixes = next_prefixes
+    return marginals
+
+
+def test_sampled_tokens_follow_main_model_distribution():
+    gpt = make_gpt()
+    # Без top-k/top-p: сравниваем с полным распределением основной модели
+    gpt.beam_k = 0
+    gpt.beam_p = 1.0
+    prompt = [1, 2, 3]
+    nb_samples = 4000
+    length = 3
+
+    torch.manual_seed(789)
+    generated = torch.tensor(gpt.sample_speculative([prompt] * nb_samples, length, 1.0))
+
+    for pos, expected in enumerate(exact_marginals(gpt.model, prompt, length)):
+        observed = torch.bincount(generated[:, pos], minlength=VOCAB_SIZE).double() / nb_samples
+        total_variation = 0.5 * float((observed - expected).abs().sum())
+        assert total_variation < 0.05, 'position {}: {}'.format(pos, total_variation)
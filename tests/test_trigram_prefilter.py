@@ -0,0 +1,53 @@
+"""
+Лексический отбор кандидатов по символьным триграммам перед оценкой релевантности.
+"""
+
+from ruchatbot.bot.trigram_prefilter import TrigramPrefilter, text_shingles
+
+
+FACTS = ['Меня зовут Вика.', 'Я живу в Москве.', 'Мне 25 лет.', 'Я люблю зеленый чай.', 'Я работаю программистом.',
+         'У меня есть кошка Мурка.', 'Я учусь в университете.', 'Мой любимый цвет - синий.']
+
+QUERIES = [('как тебя зовут?', 'Меня зовут Вика.'),
+           ('где ты живешь?', 'Я живу в Москве.'),
+           ('сколько тебе лет?', 'Мне 25 лет.'),
+           ('какой чай ты любишь?', 'Я люблю зеленый чай.'),
+           ('кем ты работаешь?', 'Я работаю программистом.'),
+           ('у тебя есть кошка?', 'У меня есть кошка Мурка.')]
+
+
+def make_premises(texts):
+    # Формат enumerate_facts: (текст, модальность, метка)
+    return [(text, 'unknown', None) for text in texts]
+
+
+def test_text_shingles():
+    assert text_shingles('Да') == {'[да', 'да]'}
+
+
+def test_small_lists_are_kept():
+    prefilter = TrigramPrefilter()
+    premises = make_premises(FACTS[:3])
+    assert prefilter.select_candidates('как тебя зовут?', premises, 3) is premises
+    assert prefilter.select_candidates('как тебя зовут?', premises, None) is premises
+
+
+def test_recall_with_indexed_and_unindexed_facts():
+    # Часть фактов в индексе (БЗ профиля), часть нет (факты сессии) - оценки должны быть одинаковыми
+    indexed = TrigramPrefilter()
+    indexed.add_texts(FACTS[:4])
+    unindexed = TrigramPrefilter()
+    premises = make_premises(FACTS)
+
+    nb_hits = 0
+    for query, relevant_fact in QUERIES:
+        candidates = indexed.select_candidates(query, premises, 3)
+        assert candidates == unindexed.select_candidates(query, premises, 3)
+        # Исходный порядок фактов сохраняется
+        assert candidates == [premise for premise in premises if premise in candidates]
+        nb_hits += relevant_fact in [premise[0] for premise in candidates]
+
+    assert nb_hits / float(len(QUERIES)) >= 0.8
+
+    # Тексты не из БЗ в индекс не добавляются
+    assert len(indexed) == 4 and len(unindexed) == 0
@@ -0,0 +1,65 @@
+"""
+Бюджет времени на ход: необязательные стадии пропускаются при нехватке времени и запоминаются для лога.
+"""
+
+import threading
+
+from ruchatbot.bot import turn_budget
+from ruchatbot.bot.turn_budget import TurnBudget
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_unlimited_budget(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(turn_budget.time, 'monotonic', clock)
+
+    for budget_seconds in (None, 0):
+        budget = TurnBudget(budget_seconds)
+        clock.now += 1000.0
+        assert budget.remaining() == float('inf')
+        assert budget.allows('confabulation', 10.0)
+        assert budget.degraded_stages == []
+
+
+def test_stages_degrade_when_time_runs_out(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(turn_budget.time, 'monotonic', clock)
+
+    budget = TurnBudget(2.0)
+    assert budget.allows('extra_interpretations', 0.5)
+
+    clock.now += 1.7
+    assert abs(budget.remaining() - 0.3) < 1e-6
+    assert budget.allows('deep_validation', 0.2)
+    assert not budget.allows('confabulation', 0.5)
+    assert not budget.allows('scoring', 0.5)
+    # Повторный отказ той же стадии не дублируется в логе
+    assert not budget.allows('confabulation', 0.5)
+
+    assert budget.degraded_stages == ['confabulation', 'scoring']
+    assert repr(budget) == 'elapsed=1.700 budget=2.0 degraded=[confabulation, scoring]'
+
+
+def test_degraded_stages_from_several_threads():
+    # Ветки ответа проверяют бюджет из потоков пула, каждая стадия должна попасть в список ровно один раз
+    budget = TurnBudget(0.001)
+    stages = ['stage{}'.format(i) for i in range(10)]
+
+    def worker():
+        for stage in stages:
+            budget.allows(stage, 1.0)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(budget.degraded_stages) == sorted(stages)